@@ -12,6 +12,7 @@ from termcolor import colored
 from helixer.core.scripts import ParameterParser
 from helixer.core.data import prioritized_models, report_if_current_not_best, identify_current, set_model_path
 from helixer.prediction.HybridModel import HybridModel
+from helixer.core.cpu_workers import predict_with_cpu_workers
 from helixer.export.exporter import HelixerFastaToH5Controller
 
 
@@ -64,6 +65,31 @@ class HelixerParameterParser(ParameterParser):
                                           'quality if overlapping is enabled. Smaller values may lead to better '
                                           'predictions but will take longer. Has to be smaller than subsequence_length '
                                           '(Default is subsequence_length * 3 / 4)')
+        self.pred_group.add_argument('--overlap-mode', type=str, choices=['full', 'boundary'],
+                                     help="'full' overlaps sliding windows (every --overlap-offset) over the whole "
+                                          "sequence, about doubling the prediction time. 'boundary' predicts every "
+                                          "subsequence once and replaces only its ends beyond --overlap-core-length "
+                                          "by the prediction of one extra window centered on each junction of "
+                                          "subsequences (about 1.5x the time of --no-overlap with the default "
+                                          "--overlap-core-length, less with a longer one). (Default is full.)")
+        self.pred_group.add_argument('--cpu-workers', type=int,
+                                     help='Predict on CPU only, with this many worker processes, each pinned to its '
+                                          'share of the available cores and predicting its share of whole '
+                                          'sequences. Scales better than one process on nodes with many cores and '
+                                          'no GPU; the --batch-size applies per worker. (Default is 1: a single '
+                                          'process, which uses a GPU if available.)')
+        self.pred_group.add_argument('--cpu-inference', action='store_true',
+                                     help='Predict on CPU only, with TensorFlow threads set for the available cores '
+                                          'and the --batch-size replaced by the one with the best throughput when '
+                                          'timing the first batches. Applies to each of the --cpu-workers, which '
+                                          'also enable oneDNN where TensorFlow has it (unless '
+                                          'TF_ENABLE_ONEDNN_OPTS=0 is set).')
+        self.pred_group.add_argument('--compiled-model-cache', action='store_true',
+                                     help='Export a compiled form of the model (a TensorFlow SavedModel) next to the '
+                                          'model file (or, if that is not writable, to the cache directory of the '
+                                          'user) on the first run, and load it in later runs, which start quicker. '
+                                          'Keyed by the md5 sum of the model file. Only used on a single device '
+                                          '(one GPU or CPU), with several GPUs the model is loaded as usual.')
 
         self.post_group = self.parser.add_argument_group("Post-processing parameters")
         self.post_group.add_argument('--window-size', type=int,
@@ -93,6 +119,10 @@ class HelixerParameterParser(ParameterParser):
             'no_overlap': False,
             'overlap_offset': None,
             'overlap_core_length': None,
+            'overlap_mode': 'full',
+            'cpu_workers': 1,
+            'cpu_inference': False,
+            'compiled_model_cache': False,
             'window_size': 100,
             'edge_threshold': 0.1,
             'peak_threshold': 0.8,
@@ -237,16 +267,24 @@ def main():
             '--verbose',
             '--load-model-path', args.model_filepath,
             '--test-data', tmp_genome_h5_path,
-            '--prediction-output-path', tmp_pred_h5_path,
             '--val-test-batch-size', str(args.batch_size),
             '--overlap-offset', str(args.overlap_offset),
             '--core-length', str(args.overlap_core_length),
+            '--overlap-mode', args.overlap_mode,
             '--compression', str(args.compression)
         ]
         if args.overlap:
             hybrid_model_args.append('--overlap')
-        model = HybridModel(cli_args=hybrid_model_args)
-        model.run()
+        if args.cpu_inference:
+            hybrid_model_args.append('--cpu-inference')
+        if args.compiled_model_cache:
+            hybrid_model_args.append('--compiled-model-cache')
+        if args.cpu_workers > 1:
+            predict_with_cpu_workers(hybrid_model_args, tmp_genome_h5_path, tmp_pred_h5_path, args.cpu_workers,
+                                     tmp_dirname)
+        else:
+            model = HybridModel(cli_args=hybrid_model_args + ['--prediction-output-path', tmp_pred_h5_path])
+            model.run()
 
         print(colored('Neural network prediction done. Starting post processing.', 'green'))
 
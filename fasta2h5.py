@@ -20,4 +20,5 @@ if __name__ == '__main__':
     args = pp.get_args()
     controller = HelixerFastaToH5Controller(args.fasta_path, args.h5_output_path)
     controller.export_fasta_to_h5(chunk_size=args.subsequence_length, compression=args.compression,
-                                  multiprocess=not args.no_multiprocess, species=args.species, write_by=args.write_by)
+                                  multiprocess=not args.no_multiprocess, species=args.species, write_by=args.write_by,
+                                  fix_reverse_strand_padding=args.fix_reverse_strand_padding)
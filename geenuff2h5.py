@@ -20,7 +20,8 @@ def main(args):
     controller = HelixerExportController(args.input_db_path, args.h5_output_path, match_existing=match_existing,
                                          h5_group=h5_group)
     controller.export(chunk_size=args.subsequence_length, write_by=write_by, modes=modes, compression=args.compression,
-                      multiprocess=not args.no_multiprocess)
+                      multiprocess=not args.no_multiprocess,
+                      fix_reverse_strand_padding=args.fix_reverse_strand_padding)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,159 @@
+"""compact storage of the compressed samples of one dataset, shareable between processes"""
+
+import os
+import sys
+import json
+import tempfile
+import weakref
+import numpy as np
+from multiprocessing import shared_memory
+
+
+BACKINGS = ['memory', 'shm', 'mmap']
+
+
+def _release(shm=None, path=None):
+    """cleanup of the backing of an arena, only ever called for the process that created it"""
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+
+
+def _attach_shm(name):
+    """attaches to existing shared memory, which is only ever unlinked by the process that created it"""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # before 3.13 attaching registers the name with the resource tracker again. The processes receiving an arena
+    # are started by multiprocessing and share the tracker of the creating process, which keeps a set of names:
+    # the registration is a no-op there, whereas unregistering would drop the one of the creating process (whose
+    # unlink then fails in the tracker with a KeyError)
+    return shared_memory.SharedMemory(name=name)
+
+
+class CompressedArena(object):
+    """All compressed samples of one dataset in one contiguous buffer, delineated by an offsets array.
+
+    Samples are added block wise with extend() and the arena is then finalize()d into its backing, which is
+    either plain memory, POSIX shared memory (backing='shm') or a memory mapped file in arena_dir
+    (backing='mmap'). The latter two can be attached to by other processes without copying the data.
+    With backing='mmap' the blocks are written to the file right away, so that the compressed data
+    never has to fit into memory as a whole.
+    """
+    def __init__(self, name, dtype, backing='memory', arena_dir=None):
+        assert backing in BACKINGS, f'unknown arena backing {backing}, choose from {BACKINGS}'
+        self.name = name
+        self.dtype = dtype
+        self.backing = backing
+        self.arena_dir = arena_dir
+        self.buffer = None
+        self.offsets = None
+        self._blocks = []
+        self._lengths = []
+        self._shm = None
+        self._path = None
+
+    def extend(self, encoded_samples):
+        """add a block of compressed samples (bytes like), only before finalizing"""
+        assert self.buffer is None, 'can not extend a finalized arena'
+        if self.backing == 'mmap':
+            if self._path is None:
+                self._create_file()
+            with open(self._path, 'ab') as f:
+                f.write(b''.join(encoded_samples))
+        else:
+            self._blocks.append(b''.join(encoded_samples))
+        self._lengths.extend(len(e) for e in encoded_samples)
+
+    def _create_file(self):
+        fd, self._path = tempfile.mkstemp(prefix='helixer_arena_', suffix='.bin', dir=self.arena_dir)
+        os.close(fd)
+        weakref.finalize(self, _release, path=self._path)
+
+    def finalize(self):
+        """copy all added blocks into one contiguous buffer of the chosen backing"""
+        offsets = np.zeros(len(self._lengths) + 1, dtype=np.int64)
+        np.cumsum(self._lengths, out=offsets[1:])
+        size = int(offsets[-1])
+        if self.backing == 'shm':
+            # size 0 is not allowed for shared memory
+            self._shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+            buffer = np.ndarray((size,), dtype=np.uint8, buffer=self._shm.buf)
+        elif self.backing == 'mmap':
+            # everything is in the file already, it just needs to be mapped
+            if self._path is None:
+                self._create_file()
+            if size == 0:
+                # an empty file can not be memory mapped
+                with open(self._path, 'ab') as f:
+                    f.write(b'\0')
+            buffer = np.memmap(self._path, dtype=np.uint8, mode='r', shape=(max(size, 1),))[:size]
+        else:
+            buffer = np.empty((size,), dtype=np.uint8)
+
+        start = 0
+        while self._blocks:
+            block = self._blocks.pop(0)  # release memory block by block
+            buffer[start:start + len(block)] = np.frombuffer(block, dtype=np.uint8)
+            start += len(block)
+
+        self.buffer = buffer
+        self.offsets = offsets
+        self._lengths = []
+        if self.backing == 'shm':
+            weakref.finalize(self, _release, shm=self._shm)
+
+    def save(self, path_prefix):
+        """write the finalized arena to {path_prefix}.bin (raw buffer), .offsets.npy and .json (meta info)"""
+        assert self.buffer is not None, 'can only save a finalized arena'
+        self.buffer.tofile(f'{path_prefix}.bin')
+        np.save(f'{path_prefix}.offsets.npy', self.offsets)
+        with open(f'{path_prefix}.json', 'w') as f:
+            json.dump({'name': self.name, 'dtype': np.dtype(self.dtype).str}, f)
+
+    @classmethod
+    def load(cls, path_prefix):
+        """memory map an arena previously written with save(), the files are left in place on cleanup"""
+        with open(f'{path_prefix}.json') as f:
+            meta = json.load(f)
+        arena = cls(meta['name'], np.dtype(meta['dtype']), backing='mmap')
+        arena.offsets = np.load(f'{path_prefix}.offsets.npy')
+        arena._path = f'{path_prefix}.bin'
+        size = int(arena.offsets[-1])
+        arena.buffer = np.memmap(arena._path, dtype=np.uint8, mode='r', shape=(max(size, 1),))[:size]
+        return arena
+
+    def __len__(self):
+        if self.offsets is None:
+            return len(self._lengths)
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """compressed bytes of sample i, as a zero copy view into the buffer"""
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]]
+
+    @property
+    def nbytes(self):
+        if self.offsets is None:
+            return sum(self._lengths)
+        return int(self.offsets[-1])
+
+    def __getstate__(self):
+        # shared backings are re-attached (not copied) in the receiving process
+        state = self.__dict__.copy()
+        if self.backing == 'shm':
+            state['buffer'] = None
+            state['_shm'] = self._shm.name
+        elif self.backing == 'mmap':
+            state['buffer'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        size = int(self.offsets[-1])
+        if self.backing == 'shm':
+            self._shm = _attach_shm(state['_shm'])
+            self.buffer = np.ndarray((size,), dtype=np.uint8, buffer=self._shm.buf)
+        elif self.backing == 'mmap':
+            self.buffer = np.memmap(self._path, dtype=np.uint8, mode='r', shape=(max(size, 1),))[:size]
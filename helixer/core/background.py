@@ -0,0 +1,66 @@
+"""writing (e.g. to h5 files) in a background thread, while the main thread goes on computing"""
+
+import queue
+import threading
+
+
+class BackgroundWriter(object):
+    """Calls write(*args) for every submit(*args) in a background thread, in the order submitted.
+
+    At most max_queued submitted items wait to be written, so submit() blocks while the writing falls behind.
+    With max_queued=0 everything is written right away in the calling thread. An exception raised by write
+    is raised again in the calling thread by the next submit() or by close(), the items submitted after
+    the failure are dropped.
+    """
+    def __init__(self, write, max_queued=4):
+        self.write = write
+        self.max_queued = max_queued
+        self._error = None
+        self._thread = None
+        if max_queued > 0:
+            self._queue = queue.Queue(maxsize=max_queued)
+            self._thread = threading.Thread(target=self._run, name='background_writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            args = self._queue.get()
+            if args is None:
+                return
+            if self._error is None:
+                try:
+                    self.write(*args)
+                except BaseException as e:
+                    # keeps taking items from the queue, so that submit() never blocks forever
+                    self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, *args):
+        if self._thread is None:
+            self.write(*args)
+            return
+        self._raise_error()
+        self._queue.put(args)
+
+    def close(self):
+        """waits until everything submitted is written"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._thread is not None and self._thread.is_alive():
+            # an error in the calling thread: stop writing, but keep that error
+            self._error = exc_value
+            self._queue.put(None)
+            self._thread.join()
@@ -0,0 +1,74 @@
+"""keeps batches in their final form, so that data that never changes (e.g. validation) is prepared only once"""
+
+import os
+import shutil
+import tempfile
+import weakref
+import numpy as np
+
+
+BACKINGS = ['memory', 'disk']
+
+
+def _flatten(batch, arrays):
+    """replaces the arrays of a (nested) list/tuple batch by their index in arrays, keeping the list/tuple types"""
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_flatten(e, arrays) for e in batch)
+    if batch is None:
+        return None
+    arrays.append(batch)
+    return len(arrays) - 1
+
+
+def _unflatten(structure, arrays):
+    if isinstance(structure, (list, tuple)):
+        return type(structure)(_unflatten(e, arrays) for e in structure)
+    if structure is None:
+        return None
+    return arrays[structure]
+
+
+class BatchCache(object):
+    """Batches in the order they were appended, either in memory or as .npy files in a temporary directory
+    in cache_dir (backing='disk'), which are memory mapped (read only) when iterating."""
+    def __init__(self, backing='memory', cache_dir=None):
+        assert backing in BACKINGS, f'unknown batch cache backing {backing}, choose from {BACKINGS}'
+        self.backing = backing
+        self.cache_dir = cache_dir
+        self.complete = False  # set when all batches were appended
+        self._batches = []
+        self._dir = None
+
+    def append(self, batch):
+        if self.backing == 'memory':
+            self._batches.append(batch)
+            return
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp(prefix='helixer_batches_', dir=self.cache_dir)
+            weakref.finalize(self, shutil.rmtree, self._dir, ignore_errors=True)
+        arrays = []
+        structure = _flatten(batch, arrays)
+        for i, array in enumerate(arrays):
+            np.save(os.path.join(self._dir, f'{len(self._batches)}_{i}.npy'), array)
+        self._batches.append((structure, len(arrays)))
+
+    def clear(self):
+        if self._dir is not None:
+            for name in os.listdir(self._dir):
+                os.remove(os.path.join(self._dir, name))
+        self._batches = []
+        self.complete = False
+
+    def __len__(self):
+        return len(self._batches)
+
+    def __getitem__(self, idx):
+        if self.backing == 'memory':
+            return self._batches[idx]
+        structure, n_arrays = self._batches[idx]
+        arrays = [np.load(os.path.join(self._dir, f'{idx}_{i}.npy'), mmap_mode='r') for i in range(n_arrays)]
+        return _unflatten(structure, arrays)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
@@ -0,0 +1,138 @@
+"""predicting on CPU: the TensorFlow configuration for the available cores, and several worker processes, each
+pinned to its own cores and predicting a shard of whole sequences (see helixer.core.shards), with the partial
+predictions merged into one predictions file"""
+
+import os
+import sys
+import time
+import subprocess
+import h5py
+
+from helixer.core import shards
+from helixer.core.helpers import get_contiguous_ranges
+
+
+def available_cpus():
+    """the cores this process may run on (e.g. as restricted by a job scheduler)"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def split_cpus(cpus, n_workers):
+    """splits cpus into n_workers disjoint sets of neighbouring cores, the first sets get one core more on
+    uneven splits"""
+    assert 0 < n_workers <= len(cpus), f'need at least one core per worker, {n_workers} workers for {len(cpus)} cores'
+    per_worker, extra = divmod(len(cpus), n_workers)
+    out = []
+    start = 0
+    for i in range(n_workers):
+        end = start + per_worker + (i < extra)
+        out.append(cpus[start:end])
+        start = end
+    return out
+
+
+def tf_threads(n_cpus):
+    """intra-op and inter-op threads of TensorFlow on n_cpus cores: all cores for the operations themselves and
+    two operations at a time (e.g. the forward and backward LSTM)"""
+    return n_cpus, min(2, n_cpus)
+
+
+def onednn_enabled():
+    """whether TensorFlow uses oneDNN, as set by TF_ENABLE_ONEDNN_OPTS when it was imported (or the default of the
+    build), False for builds without it"""
+    try:
+        from tensorflow.python.util import _pywrap_util_port
+        return bool(_pywrap_util_port.IsMklEnabled())
+    except (ImportError, AttributeError):
+        return False
+
+
+def resident_memory():
+    """the memory of this process currently in RAM (in bytes), None where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+
+def worker_command(hybrid_model_args, index, n_workers, n_cpus, output_path):
+    intra_op_threads, inter_op_threads = tf_threads(n_cpus)
+    cmd = [sys.executable, '-m', 'helixer.prediction.HybridModel'] + list(hybrid_model_args) + [
+        '--prediction-output-path', output_path,
+        '--intra-op-threads', str(intra_op_threads),
+        '--inter-op-threads', str(inter_op_threads),
+    ]
+    if n_workers > 1:
+        cmd += ['--shard', f'{index}/{n_workers}']
+    return cmd
+
+
+def worker_env(n_cpus):
+    env = dict(os.environ)
+    env['CUDA_VISIBLE_DEVICES'] = ''  # CPU only, the workers would compete for a GPU
+    env['OMP_NUM_THREADS'] = str(n_cpus)
+    # read by TensorFlow when imported in the worker, an explicit TF_ENABLE_ONEDNN_OPTS=0 is kept
+    env.setdefault('TF_ENABLE_ONEDNN_OPTS', '1')
+    return env
+
+
+def _pin(cpus):
+    if hasattr(os, 'sched_setaffinity'):
+        return lambda: os.sched_setaffinity(0, cpus)
+    return None
+
+
+def predict_with_cpu_workers(hybrid_model_args, test_data_path, output_path, n_workers, tmp_dir):
+    """runs HybridModel predictions (hybrid_model_args without --prediction-output-path) in n_workers processes,
+    each on its share of the available cores and with its share of the sequences in test_data_path, and merges
+    their predictions into output_path. The output of every worker goes to a log file in tmp_dir."""
+    with h5py.File(test_data_path, 'r') as h5:
+        n_ranges = len(list(get_contiguous_ranges(h5)))
+    cpus = available_cpus()
+    # every worker needs at least one sequence and one core
+    n_workers = min(n_workers, n_ranges, len(cpus))
+    cpu_sets = split_cpus(cpus, n_workers)
+    print(f'Predicting with {n_workers} CPU worker processes on {len(cpus)} cores')
+
+    processes, shard_paths, log_paths = [], [], []
+    try:
+        for i, cpu_set in enumerate(cpu_sets):
+            # a single worker writes the predictions file directly
+            shard_paths.append(os.path.join(tmp_dir, f'predictions_shard_{i}.h5') if n_workers > 1 else output_path)
+            log_paths.append(os.path.join(tmp_dir, f'prediction_worker_{i}.log'))
+            cmd = worker_command(hybrid_model_args, i, n_workers, len(cpu_set), shard_paths[i])
+            with open(log_paths[i], 'w') as log:
+                processes.append(subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT,
+                                                  env=worker_env(len(cpu_set)), preexec_fn=_pin(cpu_set)))
+            print(f'worker {i} started on cores {cpu_set[0]}-{cpu_set[-1]}')
+
+        start_time = time.time()
+        running = set(range(n_workers))
+        while running:
+            for i in sorted(running):
+                returncode = processes[i].poll()
+                if returncode is None:
+                    continue
+                running.remove(i)
+                if returncode != 0:
+                    with open(log_paths[i]) as log:
+                        print(log.read(), file=sys.stderr)
+                    raise RuntimeError(f'prediction worker {i} failed with exit code {returncode}, its output is '
+                                       f'shown above')
+                print(f'worker {i} done after {time.time() - start_time:.1f}s')
+            if running:
+                time.sleep(1)
+    finally:
+        # on failure (or interruption) stop the remaining workers
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+    if n_workers > 1:
+        shards.merge_shards(shard_paths, output_path)
+        for path in shard_paths:
+            os.remove(path)
@@ -0,0 +1,62 @@
+"""reading row chunked h5 datasets chunk by chunk, with the decompression happening outside of h5py"""
+
+import zlib
+import h5py
+import numpy as np
+
+
+# filters that can be undone here, all other filters (e.g. lzf) require reading through h5py
+SUPPORTED_FILTERS = {h5py.h5z.FILTER_DEFLATE, h5py.h5z.FILTER_SHUFFLE}
+
+
+def _filter_pipeline(dset):
+    plist = dset.id.get_create_plist()
+    return [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+
+
+def _unshuffle(data, itemsize):
+    """reverts the byte shuffle filter of HDF5, which stores the first bytes of all elements, then the second..."""
+    return np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1).T.tobytes()
+
+
+class DirectChunkReader(object):
+    """Reads rows of a dataset chunked by row (as exported by Helixer) as raw chunks and decompresses them itself.
+
+    Raw chunk reads are quick, while the decompression, which h5py does single threaded and while holding its
+    lock, can then happen in parallel threads (zlib releases the GIL). The rows are found at
+    dset[prefix + (row,)], e.g. prefix=(0,) reads rows of the first prediction in 'data/predictions'.
+    """
+    def __init__(self, dset, prefix=()):
+        assert self.supports(dset, prefix), f'{dset.name} is not chunked by row or has unsupported filters'
+        self.dset = dset
+        self.prefix = tuple(prefix)
+        self.row_shape = dset.shape[len(self.prefix) + 1:]
+        self.filters = _filter_pipeline(dset)
+
+    @staticmethod
+    def supports(dset, prefix=()):
+        row_chunks = (1,) * (len(prefix) + 1) + dset.shape[len(prefix) + 1:]
+        return dset.chunks == row_chunks and set(_filter_pipeline(dset)) <= SUPPORTED_FILTERS
+
+    def _decode(self, filter_mask, data, out):
+        # the filters are undone in reverse order, skipping those that were not applied to this chunk
+        for i in reversed(range(len(self.filters))):
+            if filter_mask & (1 << i):
+                continue
+            if self.filters[i] == h5py.h5z.FILTER_DEFLATE:
+                data = zlib.decompress(data)
+            else:
+                data = _unshuffle(data, self.dset.dtype.itemsize)
+        out[...] = np.frombuffer(data, dtype=self.dset.dtype).reshape(self.row_shape)
+
+    def read(self, rows, pool=None):
+        """returns the given rows as one array, decompressed by the threads of pool if one is given"""
+        out = np.empty((len(rows),) + self.row_shape, dtype=self.dset.dtype)
+        n_zeros = (0,) * len(self.row_shape)
+        raw_chunks = [self.dset.id.read_direct_chunk(self.prefix + (int(row),) + n_zeros) for row in rows]
+        if pool is None:
+            for j, (filter_mask, data) in enumerate(raw_chunks):
+                self._decode(filter_mask, data, out[j])
+        else:
+            list(pool.map(lambda j: self._decode(*raw_chunks[j], out[j]), range(len(rows))))
+        return out
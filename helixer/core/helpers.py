@@ -147,6 +147,17 @@ def divvy_by_confidence(one_class_chunk, step_key, pad=5, stability_threshold=0.
             end_of_last_yield = end
             cdiff_at_last_yield = cumulative_diffs[end]
 
+
+def md5sum(path, block_size=2 ** 24):
+    """md5 checksum of the content of the file at path"""
+    import hashlib
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
 def file_stem(path):
     """Returns the file name without extension"""
     import os
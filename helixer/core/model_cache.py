@@ -0,0 +1,71 @@
+"""a compiled form of the keras .h5 model(s) used for predictions: a TensorFlow SavedModel with just the weights and
+the traced prediction function for a fixed input signature, kept in the model directory (or the cache directory of
+the user) and keyed by the md5 sum of the model file(s), so that later runs neither rebuild the keras model nor
+trace its prediction function again"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import appdirs
+import tensorflow as tf
+
+from helixer.core.helpers import md5sum
+
+USER_CACHE_DIR = os.path.join(appdirs.user_cache_dir('Helixer'), 'compiled_models')
+
+
+def cache_paths(model_paths, mode=''):
+    """where the compiled model of model_paths is looked for and exported to, in this order: next to the (first)
+    model and, e.g. for a shared read only model directory, in the cache directory of the user; mode distinguishes
+    models combined in different ways (e.g. an ensemble from a shared backbone of the same .h5 files)"""
+    key = ','.join(md5sum(path) for path in model_paths)
+    if len(model_paths) > 1 or mode:
+        key = hashlib.md5(f'{mode}:{key}'.encode()).hexdigest()
+    name = os.path.splitext(os.path.basename(model_paths[0]))[0]
+    # the SavedModel format of one TensorFlow version is not necessarily loaded by an older one
+    name = f'{name}.compiled_{key}_tf{tf.__version__}'
+    return [os.path.join(os.path.dirname(os.path.abspath(model_paths[0])), name), os.path.join(USER_CACHE_DIR, name)]
+
+
+def export(model, path):
+    """traces the prediction of the keras model for its input shapes (any batch size and sequence length) and
+    saves it with the weights to path; several processes exporting the same model at once is fine"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    module = tf.Module()
+    module.weights = list(model.weights)
+    module.n_params = tf.Variable(model.count_params(), dtype=tf.int64, trainable=False)
+    signature = [tf.TensorSpec(shape=inp.shape, dtype=inp.dtype) for inp in model.inputs]
+    module.serve = tf.function(lambda *inputs: model(list(inputs) if len(inputs) > 1 else inputs[0], training=False),
+                               input_signature=signature)
+    # written next to the final path and then renamed, so that a cache is either complete or absent
+    tmp_path = tempfile.mkdtemp(prefix=f'.{os.path.basename(path)}.', dir=os.path.dirname(path))
+    try:
+        tf.saved_model.save(module, tmp_path)
+        os.rename(tmp_path, path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+class CompiledModel(object):
+    """a model loaded from the cache, used instead of the keras model where only predict_on_batch() is needed"""
+    def __init__(self, path):
+        self.path = path
+        self._module = tf.saved_model.load(path)
+
+    def predict_on_batch(self, x):
+        inputs = x if isinstance(x, (list, tuple)) else [x]
+        outputs = self._module.serve(*inputs)
+        if isinstance(outputs, (list, tuple)):
+            outputs = [output.numpy() for output in outputs]
+            return outputs[0] if len(outputs) == 1 else outputs
+        return outputs.numpy()
+
+    def count_params(self):
+        return int(self._module.n_params.numpy())
+
+    def summary(self):
+        print(f'compiled model {self.path} with {self.count_params():,} parameters')
@@ -7,18 +7,26 @@ import math
 import sys
 
 
+def _sub_batch_size(n_chunks, overlap_offset, chunk_size):
+    """number of sliding windows for n_chunks original chunks (see SubBatch._mk_sliding_coordinates)"""
+    seq_length = n_chunks * chunk_size
+    n_windows = (seq_length - chunk_size) // overlap_offset + 1
+    # + 1 for the final window of an uneven fit, works elementwise for arrays of n_chunks as well
+    return n_windows + ((n_windows - 1) * overlap_offset + chunk_size < seq_length)
+
+
+def _strided_windows(array, start, n_windows, window_length, step):
+    """writable view of n_windows (overlapping) windows into array, the i-th starting at row start + i * step"""
+    return np.lib.stride_tricks.as_strided(array[start:], shape=(n_windows, window_length) + array.shape[1:],
+                                           strides=(step * array.strides[0],) + array.strides)
+
+
 def _n_ori_chunks_from_batch_chunks(max_batch_size, overlap_offset, chunk_size):
     """check max number of original (non overlapped) chunks that fit in overlapped batch_size (or remaining)"""
-    # this is going to be empirical for A simplicity and B maintainability
     end = 0
-    empirical_bs = 0
-    while empirical_bs <= max_batch_size:
+    while _sub_batch_size(end + 1, overlap_offset, chunk_size) <= max_batch_size:
         end += 1
-        sb = SubBatch(tuple(range(end)), edge_handle_start=False, edge_handle_end=False, is_plus_strand=True,
-                      overlap_offset=overlap_offset, chunk_size=chunk_size)
-        empirical_bs = sb.sub_batch_size
-
-    return end - 1  # the while loop only breaks _after_ overshooting max
+    return end
 
 
 class SubBatch:
@@ -68,41 +76,70 @@ class SubBatch:
             out.append((self.seq_length - self.chunk_size, self.seq_length))
         return tuple(out)
 
-    def mk_sliding_overlaps_for_data_sub_batch(self, data_sub_batch):
-        """makes sliding window of input data (x, or coverage data)"""
+    def mk_sliding_overlaps_for_data_sub_batch(self, data_sub_batch, out=None):
+        """makes sliding window of input data (x, or coverage data)
+
+        The evenly spaced windows are a strided view into data_sub_batch, so when the final window does not
+        need special handling, nothing is copied. Otherwise, or if out is given, the windows are written to out
+        (allocated if necessary, shape (sub_batch_size, chunk_size, ...)).
+        """
         # combine first 2 dimensions (i.e. merge chunks)
-        dat = data_sub_batch.reshape([np.prod(data_sub_batch.shape[:2])] + list(data_sub_batch.shape[2:]))
-        sliding_dat = [dat[start:end] for start, end in self.sliding_coordinates]
-        return sliding_dat
+        dat = data_sub_batch.reshape((-1,) + data_sub_batch.shape[2:])
+        n_even = (self.seq_length - self.chunk_size) // self.overlap_offset + 1
+        windows = np.lib.stride_tricks.sliding_window_view(dat, self.chunk_size, axis=0)[::self.overlap_offset]
+        # sliding_window_view puts the window dimension last, move it back to the front (still just a view)
+        windows = np.moveaxis(windows, -1, 1)
+        if out is None:
+            if n_even == self.sub_batch_size:
+                return windows
+            out = np.empty((self.sub_batch_size,) + windows.shape[1:], dtype=dat.dtype)
+        out[:n_even] = windows
+        if n_even < self.sub_batch_size:
+            out[n_even] = dat[self.seq_length - self.chunk_size:]
+        return out
 
     def _overlap_preds(self, preds, core_length):
         """take sliding-window predictions, and overlap (w/end clipping) to generate original coordinate predictions"""
         trim_by = (self.chunk_size - core_length) // 2
-        ydim = preds[0].shape[-1]
+        if trim_by < 0:  # sanity check only
+            raise ValueError('invalid trim value: {}. Maybe core_length {} > chunk_size {}?'.format(
+                trim_by, core_length, self.chunk_size))
+        preds = np.asarray(preds)
+        ydim = preds.shape[-1]
         if ydim == self.chunk_size:
             ydim = 1
-        preds_out = np.zeros(shape=(self.seq_length, ydim))
-        counts = np.zeros(shape=(self.seq_length, 1))
-
-        len_preds = len(preds)
-        for i, chunk, start_end in zip(range(len_preds), preds, self.sliding_coordinates):
-            start, end = start_end
-            # cut to core, (but not sequence ends)
-            if trim_by > 0:
-                if i > 0:  # all except first seq
-                    start += trim_by
-                    chunk = chunk[trim_by:]
-                if i < len_preds - 1:  # all except last seq
-                    end -= trim_by
-                    chunk = chunk[:-trim_by]
-            elif trim_by < 0:  # sanity check only
-                raise ValueError('invalid trim value: {}. Maybe core_length {} > chunk_size {}?'.format(
-                    trim_by, core_length, chunk.shape[0]))
-            sub_counts = counts[start:end]
-            # average weighted by number of predictions counted at position so far
-            preds_out[start:end] = (preds_out[start:end] * sub_counts + chunk) / (sub_counts + 1)
-            # increment counted so far
-            counts[start:end] += 1
+        preds = preds.reshape((len(preds), self.chunk_size, ydim))
+        n_preds = len(preds)
+        if n_preds == 1:
+            return preds.astype(np.float32).reshape((len(self.h5_indices), self.chunk_size, ydim))
+
+        # sums and counts of the predictions at every position, the average is taken at the very end
+        preds_out = np.zeros(shape=(self.seq_length, ydim), dtype=np.float32)
+        counts = np.zeros(shape=(self.seq_length, 1), dtype=np.float32)
+
+        # the sequence ends are kept as they are, i.e. the first window is only trimmed at its end ...
+        preds_out[:self.chunk_size - trim_by] += preds[0, :self.chunk_size - trim_by]
+        counts[:self.chunk_size - trim_by] += 1
+        # ... and the last one (which might not be evenly spaced) only at its start
+        last_start = self.sliding_coordinates[-1][0]
+        preds_out[last_start + trim_by:] += preds[-1, trim_by:]
+        counts[last_start + trim_by:] += 1
+
+        # all windows in between are evenly spaced and trimmed to the same core on both sides. They are added
+        # through a strided view, in which every depth-th window starts after the previous one ended, so that
+        # every addition below covers each position at most once
+        n_mid = n_preds - 2
+        if n_mid > 0:
+            core = self.chunk_size - 2 * trim_by
+            depth = math.ceil(core / self.overlap_offset)
+            mid_preds = preds[1:-1, trim_by:self.chunk_size - trim_by]
+            start = self.overlap_offset + trim_by
+            mid_sums = _strided_windows(preds_out, start, n_mid, core, self.overlap_offset)
+            mid_counts = _strided_windows(counts, start, n_mid, core, self.overlap_offset)
+            for i in range(depth):
+                mid_sums[i::depth] += mid_preds[i::depth]
+                mid_counts[i::depth] += 1
+        preds_out /= counts
         preds_out = preds_out.reshape((len(self.h5_indices), self.chunk_size, ydim))
         return preds_out
 
@@ -139,12 +176,18 @@ class OverlapSeqHelper(object):
         assert core_length > 0
         assert overlap_offset > 0
 
+        self.chunk_size = chunk_size
+        self.overlap_offset = overlap_offset
         # contiguous ranges should be created by .helpers.get_contiguous_ranges
-        self.sliding_batches = self._mk_sliding_batches(contiguous_ranges=contiguous_ranges,
-                                                        chunk_size=chunk_size,
-                                                        overlap_offset=overlap_offset)
+        # only the coordinates of the sub batches are kept, the SubBatch objects are created for one batch at a time
+        self._plan, self._batch_starts = self._mk_sliding_batches(contiguous_ranges=contiguous_ranges,
+                                                                  chunk_size=chunk_size,
+                                                                  overlap_offset=overlap_offset)
+        self._cached_batch = (None, None)
 
     def _mk_sliding_batches(self, contiguous_ranges, chunk_size, overlap_offset):
+        """plans the sub batches, returns their coordinates (one row each, see sub_batches_of_batch())
+        and the index of the first sub batch of every batch (plus the total number at the end)"""
         # max_n_chunks is the number of chunks that will go into overlapping
         # before any sliding window, before any dropping or clipping
         max_n_chunks = _n_ori_chunks_from_batch_chunks(self.max_batch_size, overlap_offset, chunk_size)
@@ -155,68 +198,89 @@ class OverlapSeqHelper(object):
                                  "b) increase overlap_offset, or c) don't overlap"
         step = max_n_chunks - 2   # -2 bc ends will be cropped
         # most of these will effectively be final batches, but short seqs/ends may be grouped together (for efficiency)
-        sub_batches = []
-
+        plan = []
         for crange in contiguous_ranges:
             # step through sequence so that non-edges can have 1-chunk cropped off start/end
             # and regenerate original sequence with a simple concatenation there after
-            for i in range(crange['start_i'], crange['end_i'], step):
-                sub_batch_start = max(i - 1, crange['start_i'])  # pad 1 left (except seq edge)
-                keep_start = max(i, crange['start_i'])
-                keep_end = min(i + step, crange['end_i'])
-                sub_batch_end = min(i + step + 1, crange['end_i'])   # pad 1 right (except seq edge)
-                h5_indices = tuple(range(sub_batch_start, sub_batch_end))
-                sub_batches.append(
-                    SubBatch(h5_indices, is_plus_strand=crange['is_plus_strand'],
-                             edge_handle_start=i == crange['start_i'],
-                             edge_handle_end=i + step + 1 > crange['end_i'],
-                             keep_start=keep_start,
-                             keep_end=keep_end,
-                             overlap_offset=overlap_offset, chunk_size=chunk_size)
-                )
+            i = np.arange(crange['start_i'], crange['end_i'], step)
+            plan.append(np.stack([
+                np.maximum(i - 1, crange['start_i']),  # sub batch start, pad 1 left (except seq edge)
+                np.minimum(i + step + 1, crange['end_i']),  # sub batch end, pad 1 right (except seq edge)
+                i,  # keep start
+                np.minimum(i + step, crange['end_i']),  # keep end
+                i == crange['start_i'],  # edge handle start
+                i + step + 1 > crange['end_i'],  # edge handle end
+                np.full(len(i), crange['is_plus_strand']),
+            ], axis=1).astype(np.int64))
+        plan = np.concatenate(plan) if plan else np.zeros((0, 7), dtype=np.int64)
 
         # group into final batches, so as to keep total size <= max_batch_size
         # i.e. achieve consistent (& user adjustable) memory usage on graphics card
-        sliding_batches = []
-        batch = []
+        sizes = _sub_batch_size(plan[:, 1] - plan[:, 0], overlap_offset, chunk_size)
+        batch_starts = [0]
         batch_total_size = 0
-        for sb in sub_batches:
-            if batch_total_size + sb.sub_batch_size <= self.max_batch_size:
-                batch.append(sb)
-                batch_total_size += sb.sub_batch_size
+        for i, size in enumerate(sizes.tolist()):
+            if batch_total_size + size <= self.max_batch_size:
+                batch_total_size += size
             else:
-                sliding_batches.append(batch)
-                batch = [sb]
-                batch_total_size = sb.sub_batch_size
-        sliding_batches.append(batch)
-        return sliding_batches
+                batch_starts.append(i)
+                batch_total_size = size
+        # without any sub batches (e.g. a prediction shard without sequences) there are no batches
+        if len(plan):
+            batch_starts.append(len(plan))
+        return plan, np.array(batch_starts)
+
+    def sub_batches_of_batch(self, batch_idx):
+        """the SubBatch objects of the batch at {batch_idx}, created on demand"""
+        cached_idx, sub_batches = self._cached_batch
+        if cached_idx == batch_idx:
+            return sub_batches
+        sub_batches = []
+        for sb_start, sb_end, keep_start, keep_end, edge_start, edge_end, is_plus_strand in \
+                self._plan[self._batch_starts[batch_idx]:self._batch_starts[batch_idx + 1]].tolist():
+            sub_batches.append(
+                SubBatch(tuple(range(sb_start, sb_end)), is_plus_strand=bool(is_plus_strand),
+                         edge_handle_start=bool(edge_start),
+                         edge_handle_end=bool(edge_end),
+                         keep_start=keep_start,
+                         keep_end=keep_end,
+                         overlap_offset=self.overlap_offset, chunk_size=self.chunk_size)
+            )
+        self._cached_batch = (batch_idx, sub_batches)
+        return sub_batches
 
     def adjusted_epoch_length(self):
         """number of batches per epoch (given that we're overlapping)"""
-        return len(self.sliding_batches)
+        return len(self._batch_starts) - 1
 
     def h5_indices_of_batch(self, batch_idx):
         """concatenate indices from sub batches to give all indices for the batch at {batch_idx}"""
-        sub_batches = self.sliding_batches[batch_idx]
-        h5_indices = []
-        for sb in sub_batches:
-            h5_indices += sb.h5_indices
-        return np.array(h5_indices)
+        plan = self._plan[self._batch_starts[batch_idx]:self._batch_starts[batch_idx + 1]]
+        return np.concatenate([np.arange(start, end) for start, end in plan[:, :2]])
+
+    def n_chunks_of_batch(self, batch_idx):
+        """number of chunks predicted by the batch at {batch_idx}, i.e. without the padding for overlapping"""
+        plan = self._plan[self._batch_starts[batch_idx]:self._batch_starts[batch_idx + 1]]
+        return int(np.sum(plan[:, 3] - plan[:, 2]))
 
     def make_input(self, batch_idx, data_batch):
         """make sliding input for prediction and overlapping (i.e. for X, maybe also for coverage)"""
-        sub_batches = self.sliding_batches[batch_idx]
-        sb_input_lengths = [len(sb.h5_indices) for sb in sub_batches]
-        sb_input_starts = np.cumsum(sb_input_lengths) - sb_input_lengths
-        x_as_list = []
-        for start, length, sb in zip(sb_input_starts, sb_input_lengths, sub_batches):
-            x_as_list.append(sb.mk_sliding_overlaps_for_data_sub_batch(data_batch[start:(start + length)]))
-        sliding_input = np.concatenate(x_as_list)
+        sub_batches = self.sub_batches_of_batch(batch_idx)
+        sliding_input = np.empty((sum(sb.sub_batch_size for sb in sub_batches),) + data_batch.shape[1:],
+                                 dtype=data_batch.dtype)
+        # the windows of every sub batch are written straight into the batch
+        start, out_start = 0, 0
+        for sb in sub_batches:
+            length = len(sb.h5_indices)
+            sb.mk_sliding_overlaps_for_data_sub_batch(data_batch[start:(start + length)],
+                                                      out=sliding_input[out_start:(out_start + sb.sub_batch_size)])
+            start += length
+            out_start += sb.sub_batch_size
         return sliding_input
 
     def overlap_predictions(self, batch_idx, predictions):
         """overlapping of sliding predictions to regenerate original dimensions"""
-        sub_batches = self.sliding_batches[batch_idx]
+        sub_batches = self.sub_batches_of_batch(batch_idx)
         sub_batch_lengths = [sb.sub_batch_size for sb in sub_batches]
         sub_batch_starts = np.cumsum(sub_batch_lengths) - sub_batch_lengths
         out = []
@@ -232,10 +296,172 @@ class OverlapSeqHelper(object):
 
     def subset_input(self, batch_idx, y_true_or_sw):
         """generate subset from data corresponding to _final_ predictions, i.e. to run y_true through during eval"""
-        sub_batches = self.sliding_batches[batch_idx]
+        sub_batches = self.sub_batches_of_batch(batch_idx)
         sb_input_lengths = [len(sb.h5_indices) for sb in sub_batches]
         sb_input_starts = np.cumsum(sb_input_lengths) - sb_input_lengths
         dat_as_list = []
         for start, length, sb in zip(sb_input_starts, sb_input_lengths, sub_batches):
             dat_as_list.append(sb.edge_handle(y_true_or_sw[start:(start + length)]))
         return np.concatenate(dat_as_list)
+
+
+class BoundarySeqHelper(object):
+    """overlap-ready batching that predicts every chunk once, plus one window centered on each chunk junction
+
+    Only the ends of the chunk predictions, which would be cropped when overlapping (everything outside of
+    core_length), are replaced by the center of the junction windows. The junction windows are just long
+    enough for their own trimmed center to cover the cropped ends on both sides of the junction
+    (4 * trim, trim = (chunk_size - core_length) // 2) and are packed into rows of chunk_size, so that the
+    batches keep the shape of the chunks and the model predicts chunk_size / window_length junctions per row.
+
+    The batch at batch_idx is arranged as follows. h5_indices_of_batch() holds segments of consecutive
+    chunks of one contiguous range, each with the chunk before and after as context, unless at the edge of
+    the contiguous range. make_input() turns them into the chunks of all segments without the context
+    (predicted as they are) followed by the rows of packed junction windows.
+    """
+    def __init__(self, contiguous_ranges, chunk_size, max_batch_size, core_length):
+        self.chunk_size = chunk_size
+        self.max_batch_size = max_batch_size
+        self.trim_by = (chunk_size - core_length) // 2
+        assert self.trim_by > 0, 'with core_length >= chunk_size there is nothing to overlap at the chunk junctions'
+        self.windows_per_row = max(chunk_size // (4 * self.trim_by), 1)
+        # even, so that the windows can be centered on the junction
+        self.window_length = chunk_size // self.windows_per_row // 2 * 2
+        # distance from the junction up to which the junction window is used (its own ends are cropped as well)
+        self.reach = self.window_length // 2 - self.trim_by
+        if self.reach < self.trim_by:
+            print(f'core_length {core_length} is too short for the junction windows to cover all cropped '
+                  f'chunk ends, only {self.reach} instead of {self.trim_by} bp on each side of the junction',
+                  file=sys.stderr)
+        # contiguous ranges should be created by .helpers.get_contiguous_ranges
+        self._plan, self._batch_starts = self._mk_boundary_batches(contiguous_ranges)
+
+    def _n_rows(self, n_chunks, n_junctions):
+        return n_chunks + math.ceil(n_junctions / self.windows_per_row)
+
+    def _mk_boundary_batches(self, contiguous_ranges):
+        """plans the segments, returns their coordinates (context start, start, end, context end; one row each)
+        and the index of the first segment of every batch (plus the total number at the end)"""
+        # the most chunks per segment, so that a segment with context at both ends fits into one batch
+        step = 0
+        while self._n_rows(step + 1, step + 2) <= self.max_batch_size:
+            step += 1
+        assert step >= 1, 'batch_size is set too small to overlap at the chunk junctions, set it to at least ' \
+                          f'{self._n_rows(1, 2)}'
+        plan = []
+        for crange in contiguous_ranges:
+            i = np.arange(crange['start_i'], crange['end_i'], step)
+            end = np.minimum(i + step, crange['end_i'])
+            plan.append(np.stack([np.maximum(i - 1, crange['start_i']), i, end,
+                                  np.minimum(end + 1, crange['end_i'])], axis=1))
+        plan = np.concatenate(plan).astype(np.int64) if plan else np.zeros((0, 4), dtype=np.int64)
+
+        # group into final batches, so as to keep the number of rows (chunks + packed junctions) <= max_batch_size
+        n_chunks = plan[:, 2] - plan[:, 1]
+        n_junctions = plan[:, 3] - plan[:, 0] - 1
+        batch_starts = [0]
+        batch_chunks, batch_junctions = 0, 0
+        for i, (chunks, junctions) in enumerate(zip(n_chunks.tolist(), n_junctions.tolist())):
+            if self._n_rows(batch_chunks + chunks, batch_junctions + junctions) <= self.max_batch_size:
+                batch_chunks += chunks
+                batch_junctions += junctions
+            else:
+                batch_starts.append(i)
+                batch_chunks, batch_junctions = chunks, junctions
+        # without any segments (e.g. a prediction shard without sequences) there are no batches
+        if len(plan):
+            batch_starts.append(len(plan))
+        return plan, np.array(batch_starts)
+
+    def _segments(self, batch_idx):
+        return self._plan[self._batch_starts[batch_idx]:self._batch_starts[batch_idx + 1]].tolist()
+
+    def adjusted_epoch_length(self):
+        """number of batches per epoch (given that we're overlapping)"""
+        return len(self._batch_starts) - 1
+
+    def h5_indices_of_batch(self, batch_idx):
+        """concatenate indices (including context) from the segments to give all indices for the batch"""
+        return np.concatenate([np.arange(ctx_start, ctx_end) for ctx_start, _, _, ctx_end in self._segments(batch_idx)])
+
+    def n_chunks_of_batch(self, batch_idx):
+        """number of chunks predicted by the batch at {batch_idx}, i.e. without the context"""
+        return sum(end - start for _, start, end, _ in self._segments(batch_idx))
+
+    def make_input(self, batch_idx, data_batch):
+        """make input of chunks and packed junction windows (i.e. for X, maybe also for coverage)"""
+        chunks, windows = [], []
+        half = self.window_length // 2
+        start = 0
+        for ctx_start, seg_start, seg_end, ctx_end in self._segments(batch_idx):
+            length = ctx_end - ctx_start
+            seg = data_batch[start:start + length]
+            start += length
+            chunks.append(seg[seg_start - ctx_start:seg_end - ctx_start])
+            if length > 1:
+                # combine first 2 dimensions (i.e. merge chunks), the windows are a strided view
+                dat = seg.reshape((-1,) + seg.shape[2:])
+                seg_windows = np.lib.stride_tricks.sliding_window_view(dat, self.window_length, axis=0)
+                windows.append(np.moveaxis(seg_windows[self.chunk_size - half::self.chunk_size], -1, 1))
+        chunks = np.concatenate(chunks)
+        if not windows:
+            return chunks
+        windows = np.concatenate(windows)
+        # pack the windows into rows of chunk_size, whatever is left over at the end of the rows is padding
+        n_rows = math.ceil(len(windows) / self.windows_per_row)
+        packed = np.zeros((n_rows * self.windows_per_row,) + windows.shape[1:], dtype=data_batch.dtype)
+        packed[:len(windows)] = windows
+        rows = np.zeros((n_rows,) + data_batch.shape[1:], dtype=data_batch.dtype)
+        rows[:, :self.windows_per_row * self.window_length] = packed.reshape(
+            (n_rows, self.windows_per_row * self.window_length) + windows.shape[2:])
+        return np.concatenate([chunks, rows])
+
+    def overlap_predictions(self, batch_idx, predictions):
+        """replace the cropped ends of the chunk predictions by the centers of the junction predictions"""
+        segments = self._segments(batch_idx)
+        n_chunks = sum(seg_end - seg_start for _, seg_start, seg_end, _ in segments)
+        chunk_preds = predictions[:n_chunks]
+        packed_length = self.windows_per_row * self.window_length
+        window_preds = predictions[n_chunks:, :packed_length].reshape(
+            (-1, self.window_length) + predictions.shape[2:])
+        half, reach = self.window_length // 2, self.reach
+        # the part of the cropped chunk ends the junction windows can replace
+        cut = min(self.trim_by, reach)
+
+        out = []
+        chunk_i, window_i = 0, 0
+        for ctx_start, seg_start, seg_end, ctx_end in segments:
+            n_seg_chunks, n_junctions = seg_end - seg_start, ctx_end - ctx_start - 1
+            seg_preds = chunk_preds[chunk_i:chunk_i + n_seg_chunks]
+            chunk_i += n_seg_chunks
+            if n_junctions == 0:
+                out.append(seg_preds.astype(np.float32))
+                continue
+            junction_preds = window_preds[window_i:window_i + n_junctions, half - reach:half + reach]
+            window_i += n_junctions
+            # sums and counts along the segment, padded by reach on both sides for the junctions at the segment
+            # ends, whose windows reach into the context
+            seq_length = n_seg_chunks * self.chunk_size
+            sums = np.zeros((seq_length + 2 * reach,) + seg_preds.shape[2:], dtype=np.float32)
+            counts = np.zeros((seq_length + 2 * reach,) + (1,) * (seg_preds.ndim - 2), dtype=np.float32)
+            sums[reach:reach + seq_length] = seg_preds.reshape((seq_length,) + seg_preds.shape[2:])
+            counts[reach:reach + seq_length] = 1
+            # position of the first junction in the padded coordinates
+            first = reach if seg_start > ctx_start else reach + self.chunk_size
+            # the junctions are chunk_size apart, and 2 * reach < chunk_size, so the windows never overlap
+            for array in (sums, counts):
+                _strided_windows(array, first - cut, n_junctions, 2 * cut, self.chunk_size)[:] = 0
+            _strided_windows(sums, first - reach, n_junctions, 2 * reach, self.chunk_size)[:] += junction_preds
+            _strided_windows(counts, first - reach, n_junctions, 2 * reach, self.chunk_size)[:] += 1
+            seg_out = sums[reach:reach + seq_length] / counts[reach:reach + seq_length]
+            out.append(seg_out.reshape(seg_preds.shape))
+        return np.concatenate(out)
+
+    def subset_input(self, batch_idx, y_true_or_sw):
+        """generate subset from data corresponding to _final_ predictions, i.e. to run y_true through during eval"""
+        dat_as_list = []
+        start = 0
+        for ctx_start, seg_start, seg_end, ctx_end in self._segments(batch_idx):
+            dat_as_list.append(y_true_or_sw[start + seg_start - ctx_start:start + seg_end - ctx_start])
+            start += ctx_end - ctx_start
+        return np.concatenate(dat_as_list)
@@ -76,6 +76,11 @@ class ExportParameterParser(ParameterParser):
         super().__init__(config_file_path)
         self.io_group.add_argument('--h5-output-path', type=str, required=True,
                                    help='HDF5 output file for the encoded data. Must end with ".h5"')
+        self.data_group.add_argument('--fix-reverse-strand-padding', action='store_true',
+                                     help='Write padded minus strand subsequences with the padding at the start, '
+                                          'which is the layout used during training and prediction. Saves moving '
+                                          'the padding every time the data is loaded.')
+        self.defaults['fix_reverse_strand_padding'] = False
 
     def check_args(self, args):
         assert args.h5_output_path.endswith('.h5'), '--output-path must end with ".h5"'
@@ -0,0 +1,105 @@
+"""splitting predictions into shards of whole contiguous ranges and merging the shards back together"""
+
+import h5py
+import numpy as np
+
+
+def parse_shard(shard):
+    """'i/N' -> (i, N), with i counting from 0"""
+    try:
+        index, n_shards = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise ValueError(f'a shard is given as i/N (e.g. 0/4), not {shard}')
+    assert n_shards > 0 and 0 <= index < n_shards, f'shard {shard}: i/N needs 0 <= i < N'
+    return index, n_shards
+
+
+def assign_ranges(contiguous_ranges, n_shards):
+    """distributes whole contiguous ranges (from helpers.get_contiguous_ranges) over n_shards, balanced by the
+    number of chunks: the longest range goes first to the shard with the fewest chunks so far (the lowest
+    index on ties). Every shard gets its ranges in the original order."""
+    contiguous_ranges = list(contiguous_ranges)
+    lengths = [crange['end_i'] - crange['start_i'] for crange in contiguous_ranges]
+    loads = [0] * n_shards
+    shards = [[] for _ in range(n_shards)]
+    # sorting is stable, so ranges of equal length are assigned in their original order
+    for i in sorted(range(len(contiguous_ranges)), key=lambda i: -lengths[i]):
+        shard = loads.index(min(loads))
+        shards[shard].append(i)
+        loads[shard] += lengths[i]
+    return [[contiguous_ranges[i] for i in sorted(shard)] for shard in shards]
+
+
+def shard_mask(shard_ranges, n_rows):
+    """boolean mask of the rows of the ranges of one shard"""
+    mask = np.zeros(n_rows, dtype=bool)
+    for crange in shard_ranges:
+        mask[crange['start_i']:crange['end_i']] = True
+    return mask
+
+
+def loaded_ranges(shard_ranges):
+    """the ranges of a shard with start_i / end_i counted in the rows loaded for the shard only"""
+    out = []
+    start = 0
+    for crange in shard_ranges:
+        end = start + crange['end_i'] - crange['start_i']
+        out.append(dict(crange, start_i=start, end_i=end))
+        start = end
+    return out
+
+
+def _datasets(h5):
+    names = []
+    h5.visititems(lambda name, obj: names.append(name) if isinstance(obj, h5py.Dataset) else None)
+    return names
+
+
+def merge_shards(shard_paths, output_path, block_rows=1000):
+    """assembles the partial prediction files of all shards of a prediction into one predictions file with the
+    rows in the original order of the test data, the datasets keep the chunking and compression of the shards"""
+    shard_files = [h5py.File(path, 'r') for path in shard_paths]
+    try:
+        shards = [parse_shard(h5.attrs['shard']) for h5 in shard_files]
+        n_shards = shards[0][1]
+        assert sorted(shards) == [(i, n_shards) for i in range(n_shards)], \
+            f'need each of the {n_shards} shards exactly once, got {sorted(shards)}'
+        for key in ['n_rows_total', 'test_data_path', 'model_path']:
+            values = {str(h5.attrs[key]) for h5 in shard_files}
+            assert len(values) == 1, f'the shards differ in {key}: {values}'
+        n_rows = int(shard_files[0].attrs['n_rows_total'])
+        covered = np.zeros(n_rows, dtype=np.int64)
+        for h5 in shard_files:
+            for start, end in h5.attrs['shard_rows']:
+                covered[start:end] += 1
+        assert np.all(covered == 1), 'the shards do not cover every row of the test data exactly once'
+
+        with h5py.File(output_path, 'w') as out:
+            for h5 in shard_files:
+                for name in _datasets(h5):
+                    dset = h5[name]
+                    if name not in out:
+                        out.create_dataset(name, shape=(n_rows,) + dset.shape[1:], dtype=dset.dtype,
+                                           chunks=(min(dset.chunks[0], n_rows),) + dset.chunks[1:],
+                                           compression=dset.compression, compression_opts=dset.compression_opts,
+                                           shuffle=dset.shuffle)
+                    # the rows of a shard are its ranges one after another
+                    shard_start = 0
+                    for start, end in h5.attrs['shard_rows']:
+                        for block_start in range(start, end, block_rows):
+                            block_end = min(block_start + block_rows, end)
+                            offset = shard_start + block_start - start
+                            out[name][block_start:block_end] = dset[offset:offset + block_end - block_start]
+                        shard_start += end - start
+            # attributes as if predicted in one go
+            first = shard_files[0]
+            for key, value in first.attrs.items():
+                if key not in ['shard', 'shard_rows', 'n_rows_total']:
+                    out.attrs[key] = value
+            out.attrs['n_bases_removed'] = max(int(h5.attrs['n_bases_removed']) for h5 in shard_files)
+            for name in first:
+                if isinstance(first[name], h5py.Group) and name in out:
+                    out[name].attrs.update(first[name].attrs)
+    finally:
+        for h5 in shard_files:
+            h5.close()
@@ -72,10 +72,12 @@ class HelixerExportControllerBase(object):
             self.h5[h5_group + mat_info.key][start:end] = mat_info.matrix
         self.h5.flush()
 
-    def _add_data_attrs(self):
+    def _add_data_attrs(self, fix_reverse_strand_padding=False):
         attrs = {
             'timestamp': str(datetime.datetime.now()),
-            'input_path': self.input_path
+            'input_path': self.input_path,
+            # marks minus strand chunks as written with the padding first, so it needn't be moved at read-in
+            'reverse_strand_padding_fixed': fix_reverse_strand_padding
         }
         # get GeenuFF and Helixer commit hashes
         pwd = os.getcwd()
@@ -108,7 +110,8 @@ class HelixerFastaToH5Controller(HelixerExportControllerBase):
         def __repr__(self):
             return f'Fasta only Coordinate (seqid: {self.seqid}, len: {self.length})'
 
-    def export_fasta_to_h5(self, chunk_size, compression, multiprocess, species, write_by):
+    def export_fasta_to_h5(self, chunk_size, compression, multiprocess, species, write_by,
+                           fix_reverse_strand_padding=False):
         assert write_by >= chunk_size, ("when specifying '--write-by' it needs to be larger than "
                                         "or equal to '--subsequence-length'")
         fasta_importer = FastaImporter(None)
@@ -125,13 +128,14 @@ class HelixerFastaToH5Controller(HelixerExportControllerBase):
             coord = HelixerFastaToH5Controller.CoordinateSurrogate(seqid, seq)
             n_chunks = HelixerExportControllerBase.calc_n_chunks(coord.length, chunk_size)
             data_gen = CoordNumerifier.numerify_only_fasta(coord, chunk_size, species,
-                                                           use_multiprocess=multiprocess, write_by=write_by)
+                                                           use_multiprocess=multiprocess, write_by=write_by,
+                                                           fix_reverse_strand_padding=fix_reverse_strand_padding)
             for j, strand_res in enumerate(data_gen):
                 data, h5_coords = strand_res
                 self._save_data(data, h5_coords=h5_coords, n_chunks=n_chunks,
                                 first_round_for_coordinate=(j == 0), compression=compression)
             print(f'{i + 1} Numerified {coord} in {time.time() - start_time:.2f} secs', end='\n\n')
-        self._add_data_attrs()
+        self._add_data_attrs(fix_reverse_strand_padding)
         self.h5.close()
 
 
@@ -169,10 +173,12 @@ class HelixerExportController(HelixerExportControllerBase):
             coord_info[seqid] = (coord_id, coord_len)
         return coord_info
 
-    def _numerify_coord(self, coord, coord_features, chunk_size, one_hot, write_by, modes, multiprocess):
+    def _numerify_coord(self, coord, coord_features, chunk_size, one_hot, write_by, modes, multiprocess,
+                        fix_reverse_strand_padding=False):
         """filtering and stats"""
         coord_data_gen = CoordNumerifier.numerify(coord, coord_features, chunk_size, one_hot,
-                                                  write_by=write_by, mode=modes, use_multiprocess=multiprocess)
+                                                  write_by=write_by, mode=modes, use_multiprocess=multiprocess,
+                                                  fix_reverse_strand_padding=fix_reverse_strand_padding)
         # the following will all be used to calculated a percentage, which is yielded but ignored until the end
         n_chunks = n_bases = n_ig_bases = n_masked_bases = 0
 
@@ -194,10 +200,16 @@ class HelixerExportController(HelixerExportControllerBase):
             yield coord_data, coord, masked_bases_perc, ig_bases_perc, h5_coord
 
     def export(self, chunk_size, one_hot=True, longest_only=True, write_by=10_000_000_000,
-               modes=('X', 'y', 'anno_meta', 'transitions'), compression='gzip', multiprocess=True):
+               modes=('X', 'y', 'anno_meta', 'transitions'), compression='gzip', multiprocess=True,
+               fix_reverse_strand_padding=False):
         coords_features = self.exporter.genome_query(longest_only=longest_only)
         print(f'\n{len(coords_features)} coordinates chosen to numerify')
         if self.match_existing:
+            # the padding layout has to be the same for all groups in one file
+            existing_fixed = bool(self.h5.attrs.get('reverse_strand_padding_fixed', False))
+            assert existing_fixed == fix_reverse_strand_padding, \
+                (f'the reverse strand padding of the existing file (fixed: {existing_fixed}) does not match the '
+                 f'requested one (fixed: {fix_reverse_strand_padding})')
             # resort coordinates to match existing
             seqids = self.h5['data/seqids'][:]
             seqid_idxs = sorted(np.unique(seqids, return_index=True)[1])  # seqid info in the h5
@@ -215,7 +227,8 @@ class HelixerExportController(HelixerExportControllerBase):
             n_chunks = HelixerExportControllerBase.calc_n_chunks(coord_len, chunk_size)
             coord = self.exporter.get_coord_by_id(coord_id)
             numerify_outputs = self._numerify_coord(coord, one_coord_features, chunk_size, one_hot, write_by=write_by,
-                                                    modes=modes, multiprocess=multiprocess)
+                                                    modes=modes, multiprocess=multiprocess,
+                                                    fix_reverse_strand_padding=fix_reverse_strand_padding)
 
             for i, (flat_data, coord, masked_bases_perc, ig_bases_perc, h5_coord) in enumerate(numerify_outputs):
                 self._save_data(flat_data, h5_coords=h5_coord, n_chunks=n_chunks, first_round_for_coordinate=(i == 0),
@@ -227,7 +240,7 @@ class HelixerExportController(HelixerExportControllerBase):
                   f'masked rate: {masked_bases_perc:.2f}%, ig rate: {ig_bases_perc:.2f}%, '
                   f'({time.time() - start_time:.2f} secs)', end='\n\n')
             n_coords_done += 1
-        self._add_data_attrs()
+        self._add_data_attrs(fix_reverse_strand_padding)
         self.h5.close()
         print('Export from geenuff db to h5 file(s) with numeric matrices finished successfully.')
         return n_writing_chunks  # for testing only atm
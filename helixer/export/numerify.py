@@ -329,13 +329,17 @@ class CoordNumerifier(object):
     """
 
     @staticmethod
-    def pad(d, chunk_size):
+    def pad(d, chunk_size, pad_start=False):
         n_seqs = len(d)
         # insert all the sequences so that 0-padding is added if needed
         shape = tuple([n_seqs, chunk_size] + list(d[0].shape[1:]))
         padded_d = np.zeros(shape, dtype=d[0].dtype)
         for j in range(n_seqs):
-            padded_d[j, :len(d[j])] = d[j]
+            if pad_start:
+                # padding first, i.e. the layout HelixerSequence otherwise creates at read-in for the minus strand
+                padded_d[j, chunk_size - len(d[j]):] = d[j]
+            else:
+                padded_d[j, :len(d[j])] = d[j]
         return padded_d
 
     @staticmethod
@@ -357,7 +361,8 @@ class CoordNumerifier(object):
         return res
 
     @staticmethod
-    def numerify_only_fasta(coord, max_len, genome, one_hot=True, use_multiprocess=False, write_by=20000000):
+    def numerify_only_fasta(coord, max_len, genome, one_hot=True, use_multiprocess=False, write_by=20000000,
+                            fix_reverse_strand_padding=False):
         """export the FASTA sequence only"""
         # passing empty features causes SplitFinder to consider noting more than splitting
         # to max length of write_by and end of sequence handling.
@@ -369,7 +374,8 @@ class CoordNumerifier(object):
                                                 use_multiprocess=use_multiprocess)
             xb = seq_numerifier.coord_to_matrices()
             for strand in ['plus', 'minus']:
-                x = CoordNumerifier.pad(xb[strand], max_len)
+                pad_start = fix_reverse_strand_padding and strand == 'minus'
+                x = CoordNumerifier.pad(xb[strand], max_len, pad_start=pad_start)
                 start_ends = CoordNumerifier.start_ends(seq_numerifier, strand)
                 start_ends += start
                 out = [MatAndInfo('X', x, 'float16')]
@@ -378,7 +384,7 @@ class CoordNumerifier(object):
 
     @staticmethod
     def numerify(coord, coord_features, max_len, one_hot=True, mode=('X', 'y', 'anno_meta', 'transitions'),
-                 write_by=5000000, use_multiprocess=True):
+                 write_by=5000000, use_multiprocess=True, fix_reverse_strand_padding=False):
         assert isinstance(max_len, int) and max_len > 0, 'what is {} of type {}'.format(max_len, type(max_len))
         coord_features = sorted(coord_features, key=lambda f: min(f.start, f.end))  # sort by ~ +strand start
         split_finder = SplitFinder(features=coord_features, write_by=write_by, coord_length=coord.length,
@@ -386,12 +392,13 @@ class CoordNumerifier(object):
         for f_set, bp_coord, h5_coord in split_finder.feature_n_coord_gen():
             for strand_res in CoordNumerifier._numerify_super_write_chunk(f_set, bp_coord, h5_coord, coord, max_len,
                                                                           one_hot, coord_features, mode,
-                                                                          use_multiprocess):
+                                                                          use_multiprocess,
+                                                                          fix_reverse_strand_padding):
                 yield strand_res
 
     @staticmethod
     def _numerify_super_write_chunk(f_set, bp_coord, h5_coord, coord, max_len, one_hot, coord_features, mode,
-                                    use_multiprocess):
+                                    use_multiprocess, fix_reverse_strand_padding=False):
         export_x = 'X' in mode
         start, end = bp_coord
 
@@ -406,10 +413,11 @@ class CoordNumerifier(object):
             xb = seq_numerifier.coord_to_matrices()
         yb, sample_weightsb, gene_lengthsb, phasessb, transitionsb = anno_numerifier.coord_to_matrices()
         for strand in ['plus', 'minus']:
+            pad_start = fix_reverse_strand_padding and strand == 'minus'
             if export_x:
-                x = CoordNumerifier.pad(xb[strand], max_len)
+                x = CoordNumerifier.pad(xb[strand], max_len, pad_start=pad_start)
             y, sample_weights, gene_lengths, phases, transitions = \
-                (CoordNumerifier.pad(x, max_len) for x in [yb[strand],
+                (CoordNumerifier.pad(x, max_len, pad_start=pad_start) for x in [yb[strand],
                                                            sample_weightsb[strand],
                                                            gene_lengthsb[strand],
                                                            phasessb[strand],
@@ -1,6 +1,17 @@
 from abc import ABC, abstractmethod
 import os
 import sys
+import copy
+import csv
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import itertools
+import collections
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import helixer.core.helpers
 
@@ -18,7 +29,6 @@ from importlib.metadata import version
 import subprocess
 import numpy as np
 import tensorflow as tf
-from sklearn.utils import shuffle
 from pprint import pprint
 from termcolor import colored
 from terminaltables import AsciiTable
@@ -28,16 +38,46 @@ from tensorflow.keras import optimizers
 from tensorflow.keras import backend as K
 from tensorflow.keras.models import load_model, Model
 from tensorflow.keras.utils import Sequence
-from tensorflow.keras.layers import Input
+from tensorflow.keras.layers import Input, Average, Dense
 from tensorflow_addons.optimizers import AdamW
 
 from helixer.prediction.Metrics import Metrics
 from helixer.core import overlap
+from helixer.core import shards
+from helixer.core import cpu_workers
+from helixer.core import model_cache
+from helixer.core.arena import CompressedArena
+from helixer.core.h5_chunks import DirectChunkReader
+from helixer.core.batch_cache import BatchCache
+from helixer.core.background import BackgroundWriter
+
+
+# the model of a large eval worker process, loaded once per process
+_large_eval_model = None
+
+
+def _init_large_eval_worker(model_path):
+    """model_path can also be a list of paths, whose models are evaluated as an ensemble"""
+    global _large_eval_model
+    for device in tf.config.list_physical_devices('GPU'):
+        # the workers share the GPUs
+        tf.config.experimental.set_memory_growth(device, True)
+    if isinstance(model_path, str):
+        _large_eval_model = load_model(model_path, compile=False)
+    else:
+        models = [load_model(path, compile=False) for path in model_path]
+        _large_eval_model = models[0] if len(models) == 1 else HelixerModel.ensemble_model(models)
+
+
+def _eval_one_species_in_worker(*args):
+    return HelixerModel.eval_one_species(*args, model=_large_eval_model)
 
 
 class ConfusionMatrixTrain(Callback):
     def __init__(self, save_model_path, train_generator, val_generator, large_eval_folder, patience, calc_H=False,
-                 report_to_nni=False, check_every_nth_batch=1_000_000, save_every_check=False):
+                 report_to_nni=False, check_every_nth_batch=1_000_000, save_every_check=False,
+                 approx_val_generator=None, approx_val_bootstrap=1000, large_eval_workers=1, full_model=None,
+                 is_chief=True):
         self.save_model_path = save_model_path
         self.save_dir = os.path.dirname(save_model_path)
         self.save_every_check = save_every_check
@@ -50,6 +90,16 @@ class ConfusionMatrixTrain(Callback):
         self.best_val_genic_f1 = 0.0
         self.checks_without_improvement = 0
         self.check_every_nth_batch = check_every_nth_batch  # high default for ~ 1 / epoch
+        # check-ins first validate on this subset and only do the full validation if there could be a new best
+        self.approx_val_generator = approx_val_generator
+        self.approx_val_bootstrap = approx_val_bootstrap
+        self.large_eval_workers = large_eval_workers
+        # when the model trained is not the one to save (i.e. when only the hat is trained on cached backbone
+        # features or when accumulating gradients), the full model is what is saved
+        self.full_model = full_model
+        # with multiple training workers, all of them validate (the model's predictions need all of them),
+        # but only the chief writes
+        self.is_chief = is_chief
         self.epoch = 0
         print(self.save_model_path, 'SAVE MODEL PATH')
 
@@ -74,43 +124,81 @@ class ConfusionMatrixTrain(Callback):
                 self.freeze_layers(i)
         return model
 
+    def model_to_save(self):
+        """the trained model, or the full model with the weights of the trained (hat) layers"""
+        if self.full_model is None:
+            return self.model
+        trained_layers = [layer for layer in self.model.layers if layer.weights]
+        full_layers = [layer for layer in self.full_model.layers if layer.weights][-len(trained_layers):]
+        for trained_layer, full_layer in zip(trained_layers, full_layers):
+            if trained_layer is not full_layer:
+                full_layer.set_weights(trained_layer.get_weights())
+        return self.full_model
+
     def check_in(self, batch=None):
-        _, _, val_genic_f1 = HelixerModel.run_metrics(self.val_generator, self.model, calc_H=self.calc_H)
-        if self.report_to_nni:
+        if self.approx_val_generator is not None:
+            approx_f1, (ci_low, ci_high) = HelixerModel.run_approx_metrics(self.approx_val_generator, self.model,
+                                                                           n_bootstrap=self.approx_val_bootstrap)
+            print(f'approximate validation: genic f1 of {approx_f1:.4f} (95% CI {ci_low:.4f} - {ci_high:.4f}) on '
+                  f'{self.approx_val_generator.n_seqs} of {self.val_generator.n_seqs} validation samples')
+            # the full validation is only needed if the upper end of the confidence interval would be a new best
+            skip_full_validation = ci_high <= self.best_val_genic_f1
+        else:
+            skip_full_validation = False
+
+        if skip_full_validation:
+            # the approximation neither counts towards the patience nor is reported to nni
+            print(f'skipping the full validation, the best genic f1 is {self.best_val_genic_f1:.4f}')
+        else:
+            self.full_validation()
+        if batch is None:
+            b_str = 'epoch_end'
+        else:
+            b_str = f'b{batch:06}'
+        if self.save_every_check and self.is_chief:
+            path = os.path.join(self.save_dir, f'model_e{self.epoch}_{b_str}.h5')
+            self.model_to_save().save(path, save_format='h5')
+            print(f'saved model at {path}')
+
+    def full_validation(self):
+        """validates on all validation samples, saves a new best model and stops training once the patience
+        is exhausted"""
+        _, _, val_genic_f1 = HelixerModel.run_metrics(self.val_generator, self.model, calc_H=self.calc_H,
+                                                      print_to_stdout=self.is_chief)
+        if self.report_to_nni and self.is_chief:
             nni.report_intermediate_result(val_genic_f1)
         if val_genic_f1 > self.best_val_genic_f1:
             self.best_val_genic_f1 = val_genic_f1
-            self.freeze_layers(self.model)
-            self.model.save(self.save_model_path, save_format='h5')
-            print('saved new best model with genic f1 of {} at {}'.format(self.best_val_genic_f1,
-                                                                          self.save_model_path))
+            model = self.freeze_layers(self.model_to_save())
+            if self.is_chief:
+                model.save(self.save_model_path, save_format='h5')
+                print('saved new best model with genic f1 of {} at {}'.format(self.best_val_genic_f1,
+                                                                              self.save_model_path))
             self.checks_without_improvement = 0
         else:
             self.checks_without_improvement += 1
             if self.checks_without_improvement >= self.patience:
                 print(f'stopping training, patience of {self.patience} without improvement exhausted')
                 self.model.stop_training = True
-        if batch is None:
-            b_str = 'epoch_end'
-        else:
-            b_str = f'b{batch:06}'
-        if self.save_every_check:
-            path = os.path.join(self.save_dir, f'model_e{self.epoch}_{b_str}.h5')
-            self.model.save(path, save_format='h5')
-            print(f'saved model at {path}')
 
     def on_train_end(self, logs=None):
+        if not self.is_chief:
+            return
         if os.path.isdir(self.large_eval_folder):
             # load best model
             best_model = load_model(self.save_model_path)
             # double check that we loaded the correct model, can be remove if confirmed this works
-            print('\nValidation set again:')
-            _, _, val_genic_f1 = HelixerModel.run_metrics(self.val_generator, best_model, print_to_stdout=True,
-                                                          calc_H=self.calc_H)
-            assert val_genic_f1 == self.best_val_genic_f1
-
-            training_species = self.train_generator.h5_file.attrs['genomes']
-            median_f1 = HelixerModel.run_large_eval(self.large_eval_folder, best_model, self.val_generator, training_species)
+            # (not possible with cached backbone features, as they are no input of the full model)
+            if 'backbone/features' not in self.val_generator.data_list_names:
+                print('\nValidation set again:')
+                _, _, val_genic_f1 = HelixerModel.run_metrics(self.val_generator, best_model, print_to_stdout=True,
+                                                              calc_H=self.calc_H)
+                assert val_genic_f1 == self.best_val_genic_f1
+
+            training_species = HelixerModel.species_of(self.train_generator.h5_files)
+            median_f1 = HelixerModel.run_large_eval(self.large_eval_folder, best_model, self.val_generator,
+                                                    training_species, model_path=self.save_model_path,
+                                                    n_workers=self.large_eval_workers)
 
             if self.report_to_nni:
                 nni.report_final_result(median_f1)
@@ -119,6 +207,90 @@ class ConfusionMatrixTrain(Callback):
             nni.report_final_result(self.best_val_genic_f1)
 
 
+class DataStallProfiler(Callback):
+    """Times every training batch, split into waiting for the data and the training step itself (requires a
+    StepTimedModel), and regularly prints percentiles of these and of the throughput, also writing them to a
+    .json or .csv file"""
+    def __init__(self, train_generator, output_path, summarize_every=100, is_chief=True, per_replica_batches=False,
+                 num_workers=1):
+        self.train_generator = train_generator
+        self.is_chief = is_chief  # only the chief writes the file
+        self.output_path = output_path
+        self.summarize_every = summarize_every
+        # with multiple workers, every replica trains on a batch of the (repeated) pipeline of its worker per step,
+        # otherwise the replicas share one batch
+        self.per_replica_batches = per_replica_batches
+        self.num_workers = num_workers
+        self.batches_per_step = 1
+        self.n_steps = 0  # of all epochs, as repeated pipelines continue across epochs
+        self.summaries = []
+        self.epoch = 0
+        self._reset()
+
+    def _reset(self):
+        self.timings = collections.defaultdict(list)
+
+    def on_train_begin(self, logs=None):
+        if self.per_replica_batches:
+            self.batches_per_step = self.model.distribute_strategy.num_replicas_in_sync // self.num_workers
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def samples_of_step(self, step):
+        """the number of samples of all workers and replicas in training step {step} (counted over all epochs)"""
+        gen = self.train_generator
+        n_batches = len(gen)
+        batch_indices = [i % n_batches for i in range(step * self.batches_per_step, (step + 1) * self.batches_per_step)]
+        return self.num_workers * sum(min(gen.batch_size, gen.n_seqs - i * gen.batch_size) for i in batch_indices)
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_start = time.time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        batch_end = time.time()
+        step_start = float(self.model.step_start.numpy())
+        n_samples = self.samples_of_step(self.n_steps)
+        self.n_steps += 1
+        self.timings['data_wait'].append(max(step_start - self.batch_start, 0.))
+        self.timings['train_step'].append(batch_end - step_start)
+        self.timings['samples_per_s'].append(n_samples / (batch_end - self.batch_start))
+        self.timings['bp_per_s'].append(n_samples * self.train_generator.chunk_size / (batch_end - self.batch_start))
+        if len(self.timings['data_wait']) >= self.summarize_every:
+            self.summarize(batch)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.timings['data_wait']:
+            self.summarize('epoch_end')
+
+    def summarize(self, batch):
+        data_wait, train_step = np.array(self.timings['data_wait']), np.array(self.timings['train_step'])
+        summary = {'epoch': self.epoch, 'batch': batch, 'n_batches': len(data_wait),
+                   'stall_fraction': float(np.sum(data_wait) / np.sum(data_wait + train_step))}
+        table = [['', 'p50', 'p90', 'p99', 'mean']]
+        for name, values in self.timings.items():
+            stats = np.percentile(values, [50, 90, 99]).tolist() + [float(np.mean(values))]
+            summary.update({f'{name}_{stat}': value for stat, value in zip(table[0][1:], stats)})
+            table.append([name] + [f'{value:.4f}' if name in ['data_wait', 'train_step'] else f'{value:,.1f}'
+                                   for value in stats])
+        print('\n', AsciiTable(table, f'data stall profile (e{self.epoch}, {batch})').table, sep='')
+        print(f'{summary["stall_fraction"] * 100:.1f}% of the time was spent waiting for data')
+        self.summaries.append(summary)
+        if self.is_chief:
+            self._write()
+        self._reset()
+
+    def _write(self):
+        if self.output_path.endswith('.json'):
+            with open(self.output_path, 'w') as f:
+                json.dump(self.summaries, f, indent=2)
+        else:
+            with open(self.output_path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=list(self.summaries[0].keys()))
+                writer.writeheader()
+                writer.writerows(self.summaries)
+
+
 class PreshuffleCallback(Callback):
     def __init__(self, train_generator):
         self.train_generator = train_generator
@@ -128,7 +300,73 @@ class PreshuffleCallback(Callback):
             self.train_generator.shuffle_data()
 
 
+class GradientAccumulationModel(Model):
+    """Functional model that splits every training batch into accumulate_steps micro batches and applies the
+    gradients summed over them in a single optimizer step, so that only one micro batch needs to fit into memory"""
+    def __init__(self, *args, accumulate_steps=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.accumulate_steps = accumulate_steps
+
+    def train_step(self, data):
+        if self.accumulate_steps == 1:
+            return super().train_step(data)
+        x, y, sample_weight = tf.keras.utils.unpack_x_y_sample_weight(data)
+        n = tf.shape(tf.nest.flatten(x)[0])[0]
+        micro_size = (n + self.accumulate_steps - 1) // self.accumulate_steps
+        n_micro = (n + micro_size - 1) // micro_size
+
+        def micro_step(i, accumulated):
+            start = i * micro_size
+            end = tf.minimum(n, start + micro_size)
+            x_i, y_i, sw_i = tf.nest.map_structure(lambda t: None if t is None else t[start:end],
+                                                   (x, y, sample_weight))
+            with tf.GradientTape() as tape:
+                y_pred = self(x_i, training=True)
+                loss = self.compute_loss(x_i, y_i, y_pred, sw_i)
+            gradients = tape.gradient(loss, self.trainable_variables)
+            # the metrics accumulate over the micro batches just as over a whole batch
+            self.compute_metrics(x_i, y_i, y_pred, sw_i)
+            # the loss is a mean over the micro batch, so its gradients are weighted by its share of the batch
+            share = tf.cast(end - start, tf.float32) / tf.cast(n, tf.float32)
+            return i + 1, [a + tf.cast(share, g.dtype) * g for a, g in zip(accumulated, gradients)]
+
+        # one micro batch after the other (parallel_iterations=1), so that their activations are not kept at once
+        _, gradients = tf.while_loop(lambda i, _: i < n_micro, micro_step,
+                                     (tf.constant(0), [tf.zeros_like(v) for v in self.trainable_variables]),
+                                     parallel_iterations=1)
+        # with a distribution strategy, this sums the gradients of all replicas, as it would without accumulating
+        self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+        return self.get_metrics_result()
+
+
+class StepTimedModel(GradientAccumulationModel):
+    """Records in step_start when the data of the current training step arrived, i.e. when the step stopped
+    waiting for its input, in seconds since the epoch"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.step_start = tf.Variable(0., dtype=tf.float64, trainable=False,
+                                      aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA)
+
+    def train_step(self, data):
+        with tf.control_dependencies([t for t in tf.nest.flatten(data) if t is not None]):
+            started = self.step_start.assign(tf.timestamp())
+        # the step itself must only start after the time was taken
+        with tf.control_dependencies([started]):
+            data = tf.nest.map_structure(lambda t: None if t is None else tf.identity(t), data)
+        return super().train_step(data)
+
+
 class HelixerSequence(Sequence):
+    # the parameters of the HelixerModel that are copied into every sequence (besides them, only the pool size of
+    # the model is used)
+    MODEL_ARGS = ['float_precision', 'class_weights', 'transition_weights', 'input_coverage', 'coverage_count',
+                  'coverage_norm', 'overlap', 'overlap_mode', 'overlap_offset', 'core_length',
+                  'stretch_transition_weights', 'coverage_weights', 'coverage_offset', 'no_utrs', 'predict_phase',
+                  'load_predictions', 'only_predictions', 'debug', 'arena_backing', 'arena_dir', 'data_cache_dir',
+                  'tf_data', 'out_of_core', 'shuffle_block_size', 'shuffle_window', 'read_ahead', 'decode_threads',
+                  'precompute_weights', 'load_threads', 'cache_val_batches', 'worker_index', 'num_workers',
+                  'shard_index', 'n_shards']
+
     def __init__(self, model, h5_files, mode, batch_size, shuffle):
         assert mode in ['train', 'val', 'test']
         # model != actual model, it's just the default values from HelixerModel,
@@ -138,10 +376,9 @@ class HelixerSequence(Sequence):
         self.mode = mode
         self.shuffle = shuffle
         self.batch_size = batch_size
-        self._cp_into_namespace(['float_precision', 'class_weights', 'transition_weights', 'input_coverage',
-                                 'coverage_count', 'coverage_norm', 'overlap', 'overlap_offset', 'core_length',
-                                 'stretch_transition_weights', 'coverage_weights', 'coverage_offset',
-                                 'no_utrs', 'predict_phase', 'load_predictions', 'only_predictions', 'debug'])
+        self._cp_into_namespace(self.MODEL_ARGS)
+        # thread pools by name and process, see _thread_pool()
+        self._thread_pools = {}
 
         if self.mode == 'test':
             assert len(self.h5_files) == 1, "predictions and eval should be applied to individual files only"
@@ -158,6 +395,11 @@ class HelixerSequence(Sequence):
         if self.core_length is None:
             self.core_length = int(self.chunk_size * 3 / 4)
 
+        # the final pooled weights can only be precomputed where they are calculated, i.e. when pooling
+        if self.precompute_weights and (self.only_predictions or self.model.pool_size == 1):
+            print('ignoring --precompute-weights, as there are no pooled sample weights to calculate')
+            self.precompute_weights = False
+
         self.data_list_names = ['data/X']
         if not self.only_predictions:
             self.data_list_names += ['data/y', 'data/sample_weights']
@@ -165,41 +407,99 @@ class HelixerSequence(Sequence):
                 self.data_list_names.append('data/predictions')
             if self.predict_phase:
                 self.data_list_names.append('data/phases')
-            if self.mode == 'train':
+            # with precomputed weights, these are already included in what is loaded as sample weights
+            if self.mode == 'train' and not self.precompute_weights:
                 if self.transition_weights is not None:
                     self.data_list_names.append('data/transitions')
                 if self.coverage_weights:
                     self.data_list_names.append('scores/by_bp')
 
+        # a prediction shard only loads (and overlaps) its share of whole contiguous ranges
+        self.shard_ranges = None
+        if self.mode == 'test' and self.n_shards > 1:
+            all_ranges = helixer.core.helpers.get_contiguous_ranges(self.h5_files[0])
+            self.shard_ranges = shards.assign_ranges(all_ranges, self.n_shards)[self.shard_index]
+
         if self.overlap:
             assert self.mode == "test", "overlapping currently only works for test (predictions & eval)"
-            # can take [0] below bc we've asserted that test means len(self.h5_files) == 1 above
-            contiguous_ranges = helixer.core.helpers.get_contiguous_ranges(self.h5_files[0])
-            self.ol_helper = overlap.OverlapSeqHelper(contiguous_ranges=contiguous_ranges,
-                                                      chunk_size=self.chunk_size,
-                                                      max_batch_size=self.batch_size,
-                                                      overlap_offset=self.overlap_offset,
-                                                      core_length=self.core_length)
+            self.ol_helper = self._overlap_helper()
 
         if self.input_coverage:
             self.data_list_names += ['evaluation/rnaseq_coverage', 'evaluation/rnaseq_spliced_coverage']
 
-        self.data_lists = [[] for _ in range(len(self.data_list_names))]
+        if self.out_of_core and self.arena_backing != 'mmap':
+            print(f'using --arena-backing mmap instead of {self.arena_backing} for --out-of-core')
+            self.arena_backing = 'mmap'
         self.data_dtypes = [self.h5_files[0][name].dtype for name in self.data_list_names]
+        # shape of a single sample, 'data/predictions' has an extra first dimension of which only [0] is used
+        self.data_sample_shapes = [self.h5_files[0][name].shape[2 if name == 'data/predictions' else 1:]
+                                   for name in self.data_list_names]
+        if self.precompute_weights:
+            # dtype and shape of the pooled weights depend on the weighting, so are taken from the first sample
+            i = self.data_list_names.index('data/sample_weights')
+            pooled_sw = self._precomputed_sample_weights(self.h5_files[0], 0, 1, np.ones(1, dtype=bool), [])
+            self.data_dtypes[i] = pooled_sw.dtype
+            self.data_sample_shapes[i] = pooled_sw.shape[1:]
+        self.data_arenas = [CompressedArena(name, dtype, backing=self.arena_backing, arena_dir=self.arena_dir)
+                            for name, dtype in zip(self.data_list_names, self.data_dtypes)]
+        # with multiple training workers, every worker only loads its share of the training samples
+        if self.mode == 'train' and self.num_workers > 1:
+            masks = []
+            for h5_file in self.h5_files:
+                mask = np.array(self._sample_mask(h5_file), dtype=bool)
+                mask[self._n_seqs_to_load(h5_file):] = False
+                masks.append(mask)
+            self._worker_shard_masks = self._worker_shard(masks, self.worker_index, self.num_workers)
+            self._shard_info = ('training worker', self.worker_index, self.num_workers)
+        elif self.shard_ranges is not None:
+            self._worker_shard_masks = [shards.shard_mask(self.shard_ranges, self.h5_files[0]['data/X'].shape[0])]
+            self._shard_info = ('prediction shard', self.shard_index, self.n_shards)
+        else:
+            self._worker_shard_masks = None
 
         self.compressor = numcodecs.blosc.Blosc(cname='blosclz', clevel=4, shuffle=2)  # use BITSHUFFLE
 
-        print(f'\nstarting to load {self.mode} data into memory..')
+        cache_path = self._data_cache_path() if self.data_cache_dir else None
+        if cache_path is not None and os.path.isdir(cache_path):
+            print(f'\nloading the {self.mode} data from the cache at {cache_path}')
+            self.data_arenas = [CompressedArena.load(os.path.join(cache_path, str(i)))
+                                for i in range(len(self.data_list_names))]
+        else:
+            print(f'\nstarting to load {self.mode} data into memory..')
 
-        for h5_file in self.h5_files:
-            self._load_one_h5(h5_file)
+            self._load_h5_files()
 
-        for name, data_list in zip(self.data_list_names, self.data_lists):
-            comp_data_size = sum([sys.getsizeof(e) for e in data_list])
-            print(f'Compressed data size of {name} is at least {comp_data_size / 2 ** 30:.4f} GB\n')
+            for arena in self.data_arenas:
+                arena.finalize()
+            if cache_path is not None:
+                self._save_to_data_cache(cache_path)
 
-        self.n_seqs = len(self.data_lists[0])
+        for name, arena in zip(self.data_list_names, self.data_arenas):
+            print(f'Compressed data size of {name} is {arena.nbytes / 2 ** 30:.4f} GB ({arena.backing})\n')
+
+        self.n_seqs = len(self.data_arenas[0])
         print(f'setting self.n_seqs to {self.n_seqs}, bc that is len of {self.data_list_names[0]}')
+        # samples are shuffled by permuting the order in which they are read, not the data itself
+        self.order = np.arange(self.n_seqs)
+        # decoded batches that are read ahead in the background, by batch index
+        self._read_ahead_futures = {}
+        self._read_ahead_lock = threading.Lock()
+        # the order of the tf.data pass whose batch the current thread decodes (see _flat_tf_dataset)
+        self._pass_order = threading.local()
+        self._template = None
+        # validation batches never change, so they can be kept in their final form after the first check-in
+        if self.mode == 'val' and self.cache_val_batches is not None:
+            self._batch_cache = BatchCache(self.cache_val_batches, cache_dir=self.arena_dir)
+        else:
+            self._batch_cache = None
+        # data that is only used to calculate other arrays in __getitem__ is decoded into per thread buffers that
+        # are reused between batches; everything else is passed on, so it needs a new array for every batch
+        self._reused_buffers = threading.local()
+        self._reused_buffer_names = set()
+        if self.read_ahead == 0:
+            self._reused_buffer_names.update(['evaluation/rnaseq_coverage', 'evaluation/rnaseq_spliced_coverage'])
+            if self.model.pool_size > 1 and not self.precompute_weights:
+                self._reused_buffer_names.add('data/sample_weights')
 
         if self.mode == "test":
             if self.class_weights is not None:
@@ -210,7 +510,87 @@ class HelixerSequence(Sequence):
                 self.transition_weights = None
 
 
-    def _load_one_h5(self, h5_file):
+    def _data_cache_key_info(self):
+        """everything that changes the loaded and compressed samples, used to key the data cache"""
+        start_time = time.time()
+        checksums = [helixer.core.helpers.md5sum(h5_file.filename) for h5_file in self.h5_files]
+        print(f'calculating the checksums of the {self.mode} h5 files took {time.time() - start_time:.2f} secs')
+        key_info = {'checksums': checksums,
+                    'mode': self.mode,
+                    'datasets': self.data_list_names,
+                    'chunk_size': self.chunk_size,
+                    'debug': self.debug,
+                    'compressor': self.compressor.get_config(),
+                    'precomputed_weights': self._precomputed_weights_info()}
+        if self._worker_shard_masks is not None:
+            key_info['worker_shard'] = list(self._shard_info[1:])
+        return key_info
+
+    def _precomputed_weights_info(self):
+        """everything the precomputed sample weights depend on"""
+        if not self.precompute_weights:
+            return None
+        return {'pool_size': self.model.pool_size,
+                'class_weights': None if self.class_weights is None else self.class_weights.tolist(),
+                'transition_weights': None if self.transition_weights is None else self.transition_weights.tolist(),
+                'stretch_transition_weights': self.stretch_transition_weights,
+                'coverage_weights': self.coverage_weights,
+                'coverage_offset': self.coverage_offset}
+
+    def _data_cache_path(self):
+        key_info = json.dumps(self._data_cache_key_info(), sort_keys=True)
+        key = hashlib.md5(key_info.encode()).hexdigest()
+        return os.path.join(self.data_cache_dir, f'{self.mode}_{key}')
+
+    def _save_to_data_cache(self, cache_path):
+        """write all arenas to the cache, so that later runs can memory map them instead of loading again"""
+        start_time = time.time()
+        os.makedirs(self.data_cache_dir, exist_ok=True)
+        # write to a temporary directory first, so that concurrent runs never see an incomplete cache
+        tmp_path = tempfile.mkdtemp(prefix=f'{os.path.basename(cache_path)}.tmp', dir=self.data_cache_dir)
+        for i, arena in enumerate(self.data_arenas):
+            arena.save(os.path.join(tmp_path, str(i)))
+        try:
+            os.rename(tmp_path, cache_path)
+            print(f'saved the {self.mode} data to the cache at {cache_path} in {time.time() - start_time:.2f} secs')
+        except OSError:
+            # another run finished writing the same cache first
+            shutil.rmtree(tmp_path)
+
+    def _load_h5_files(self):
+        """loads all datasets of all h5 files into the arenas, with --load-threads several datasets (of one or more
+        files) at a time; the arenas are still filled in file order"""
+        jobs = []
+        for h5_file in self.h5_files:
+            load_info = self._load_info(h5_file)
+            jobs += [(h5_file, name, load_info) for name in self.data_list_names]
+
+        if self.load_threads > 1:
+            pool = self._thread_pool('load', self.load_threads)
+            pending = collections.deque()
+            for h5_file, name, load_info in jobs:
+                future = pool.submit(lambda *args: list(self._load_one_dataset(*args)), h5_file, name, load_info)
+                pending.append((name, load_info, time.time(), future))
+                # limits how much is loaded but not yet in its arena
+                if len(pending) > self.load_threads:
+                    name, load_info, start_time, future = pending.popleft()
+                    self._extend_arena(name, future.result(), load_info, start_time)
+            while pending:
+                name, load_info, start_time, future = pending.popleft()
+                self._extend_arena(name, future.result(), load_info, start_time)
+        else:
+            for h5_file, name, load_info in jobs:
+                self._extend_arena(name, self._load_one_dataset(h5_file, name, load_info), load_info, time.time())
+
+    def _extend_arena(self, name, encoded_blocks, load_info, start_time):
+        arena = self.data_arenas[self.data_list_names.index(name)]
+        for encoded in encoded_blocks:
+            arena.extend(encoded)
+        print(f'Data loading of {load_info["n_seqs"] - load_info["n_masked"]} (total so far {len(arena)}) '
+              f'samples of {name} into memory took {time.time() - start_time:.2f} secs')
+
+    def _load_info(self, h5_file):
+        """what to load from h5_file (which samples, where to fix the padding)"""
         print(f'For h5 starting with species = {h5_file["data/species"][0]}:')
         x_dset = h5_file['data/X']
         print(f'x shape: {x_dset.shape}')
@@ -218,62 +598,182 @@ class HelixerSequence(Sequence):
             y_dset = h5_file['data/y']
             print(f'y shape: {y_dset.shape}')
 
+        n_seqs = self._n_seqs_to_load(h5_file)
+        mask = self._sample_mask(h5_file)
+        n_masked = x_dset.shape[0] - np.sum(mask)
+        if self.mode == "train" or self.mode == 'val':
+            print(f'\nmasking {n_masked} completely un-annotated or completely erroneous sequences')
+        if self._worker_shard_masks is not None:
+            mask = self._worker_shard_masks[self.h5_files.index(h5_file)]
+            n_masked = x_dset.shape[0] - np.sum(mask)
+            print(f'loading {np.sum(mask)} of the samples as {self._shard_info[0]} {self._shard_info[1]} '
+                  f'of {self._shard_info[2]}')
+
+        # files exported with the padding already at the start of minus strand chunks need no fix for 'data/'
+        # (the evaluation and scores datasets are always added afterwards in the original layout)
+        padding_fixed = bool(h5_file.attrs.get('reverse_strand_padding_fixed', False))
+        fix_padding_names = ['scores/by_bp', 'evaluation/rnaseq_coverage', 'evaluation/rnaseq_spliced_coverage']
+        if not padding_fixed:
+            fix_padding_names += ['data/X', 'data/sample_weights', 'data/y', 'data/phases', 'data/predictions',
+                                  'data/transitions']
+        return {'n_seqs': n_seqs, 'mask': mask, 'n_masked': n_masked, 'fix_padding_names': fix_padding_names}
+
+    @staticmethod
+    def _worker_shard(masks, worker_index, num_workers):
+        """masks (one per file) of the samples a training worker loads, given the masks of all loadable samples:
+        every num_workers-th sample counting over all files, and equally many for every worker, as all workers
+        have to train for the same number of steps"""
+        n_per_worker = sum(int(np.sum(mask)) for mask in masks) // num_workers
+        shard_masks = []
+        n_before = 0
+        for mask in masks:
+            idxs = np.where(mask)[0]
+            ranks = n_before + np.arange(len(idxs))
+            keep = np.logical_and(ranks % num_workers == worker_index, ranks // num_workers < n_per_worker)
+            shard_mask = np.zeros(len(mask), dtype=bool)
+            shard_mask[idxs[keep]] = True
+            shard_masks.append(shard_mask)
+            n_before += len(idxs)
+        return shard_masks
+
+    def _n_seqs_to_load(self, h5_file):
         if self.debug:
             # so that total sequences between all files add to ~1000
-            n_seqs = max(1000 // len(self.h5_files), 1)
-        else:
-            n_seqs = x_dset.shape[0]
+            return max(1000 // len(self.h5_files), 1)
+        return h5_file['data/X'].shape[0]
 
+    def _sample_mask(self, h5_file):
         if self.mode == "train" or self.mode == 'val':
-            mask = np.logical_and(h5_file['data/is_annotated'],
-                                  h5_file['data/err_samples'])
-            n_masked = x_dset.shape[0] - np.sum(mask)
-            print(f'\nmasking {n_masked} completely un-annotated or completely erroneous sequences')
+            return np.logical_and(h5_file['data/is_annotated'], h5_file['data/err_samples'])
+        return np.ones(h5_file['data/X'].shape[0], dtype=bool)
 
+    def _sample_strata(self):
+        """stratum (species and whether fully intergenic) of every loaded sample, in the order of the arenas"""
+        strata = []
+        for h5_file in self.h5_files:
+            loaded = self._sample_mask(h5_file)[:self._n_seqs_to_load(h5_file)]
+            species = h5_file['data/species'][:len(loaded)][loaded]
+            if 'fully_intergenic_samples' in h5_file['data'].keys():
+                fully_intergenic = h5_file['data/fully_intergenic_samples'][:len(loaded)][loaded]
+            else:
+                fully_intergenic = np.zeros(len(species), dtype=bool)
+            strata += [f'{sp}_{ig}' for sp, ig in zip(species, fully_intergenic)]
+        assert len(strata) == self.n_seqs, 'strata do not match the loaded samples'
+        return np.unique(strata, return_inverse=True)[1]
+
+    def stratified_subset(self, fraction, seed=0):
+        """sequence of a fixed random fraction of the samples, stratified by species and by whether they are
+        fully intergenic; the compressed data is shared with this sequence"""
+        assert not self.shuffle and not self.overlap, 'subsets are only meant for validation'
+        strata = self._sample_strata()
+        rng = np.random.RandomState(seed)
+        chosen = []
+        for stratum in np.unique(strata):
+            idxs = np.where(strata == stratum)[0]
+            chosen.append(rng.choice(idxs, max(1, int(round(len(idxs) * fraction))), replace=False))
+        subset = copy.copy(self)
+        subset.order = np.sort(np.concatenate(chosen))  # in order, for the locality of the reads
+        subset.n_seqs = len(subset.order)
+        subset._read_ahead_futures = {}
+        subset._read_ahead_lock = threading.Lock()
+        subset._pass_order = threading.local()
+        subset._template = None
+        if self._batch_cache is not None:
+            subset._batch_cache = BatchCache(self._batch_cache.backing, cache_dir=self._batch_cache.cache_dir)
+        return subset
+
+    def cache_backbone_features(self, backbone, backing='memory'):
+        """runs the frozen backbone once over all samples and keeps its output (float16, compressed) in an arena
+        in memory or on disk; batches then have these features instead of the raw input (--cache-backbone-features)"""
+        start_time = time.time()
+        if backing == 'disk':
+            arena_backing = 'mmap'
         else:
-            mask = np.ones(h5_file['data/X'].shape[0], dtype=bool)
-            n_masked = 0
-
+            arena_backing = 'shm' if self.arena_backing == 'shm' else 'memory'
+        arena = CompressedArena('backbone/features', np.float16, backing=arena_backing, arena_dir=self.arena_dir)
+        n_bp = self.chunk_size - self.chunk_size % self.model.pool_size
+        for start in range(0, self.n_seqs, self.batch_size):
+            h5_indices = np.arange(start, min(start + self.batch_size, self.n_seqs))
+            X = self._decode_one('data/X', h5_indices)[:, :n_bp]
+            features = np.asarray(backbone.predict_on_batch(X), dtype=np.float16)
+            arena.extend([self.compressor.encode(f) for f in features])
+        arena.finalize()
+        self.data_list_names.append('backbone/features')
+        self.data_dtypes.append(np.dtype(np.float16))
+        self.data_sample_shapes.append(features.shape[1:])
+        self.data_arenas.append(arena)
+        print(f'cached the backbone features of the {self.mode} data in {time.time() - start_time:.2f} secs, '
+              f'compressed size is {arena.nbytes / 2 ** 30:.4f} GB ({arena.backing})')
+
+    def _hat_input(self, features, X):
+        """input of a hat trained on cached backbone features, i.e. the features and, if used, the coverage"""
+        if not self.input_coverage:
+            return features
+        return [features, X[:, :features.shape[1] * self.model.pool_size, 4:]]
+
+    def _load_one_dataset(self, h5_file, name, load_info):
+        """yields the compressed samples of dataset {name} of h5_file block by block"""
+        n_seqs, mask, fix_padding_names = load_info['n_seqs'], load_info['mask'], load_info['fix_padding_names']
         # load at most ~2338 uncompressed samples for the standard subsequence length of 21384 at a time in memory
         # this is chunk size/subsequence length dependent to not overflow RAM for when using longer subsequences
         max_at_once = min((50_000_000 // self.chunk_size) + 1, n_seqs)
-        for name, data_list in zip(self.data_list_names, self.data_lists):
-            start_time_dset = time.time()
-            for offset in range(0, n_seqs, max_at_once):
-                step_mask = mask[offset:offset + max_at_once]
-                if name == 'data/predictions':
-                    data_slice = h5_file[name][0, offset:offset + max_at_once][step_mask]  # only use one prediction for now
-                else:
-                    data_slice = h5_file[name][offset:offset + max_at_once][step_mask]
-                if name in ['data/X', 'data/sample_weights', 'data/y', 'data/phases', 'data/predictions',
-                            'data/transitions', 'scores/by_bp', 'evaluation/rnaseq_coverage',
-                            'evaluation/rnaseq_spliced_coverage']:
-                    data_slice = self._fix_reverse_strand_padding(self.chunk_size,
-                                                                  h5_file['data/start_ends'][offset:offset + max_at_once][step_mask],
-                                                                  data_slice)
-                if self.no_utrs and name == 'data/y':
-                    HelixerSequence._zero_out_utrs(self.chunk_size, )
-                data_list.extend([self.compressor.encode(e) for e in data_slice])
-            print(f'Data loading of {n_seqs - n_masked} (total so far {len(data_list)}) samples of {name} '
-                  f'into memory took {time.time() - start_time_dset:.2f} secs')
+        for offset in range(0, n_seqs, max_at_once):
+            step_mask = mask[offset:offset + max_at_once]
+            if name == 'data/sample_weights' and self.precompute_weights:
+                data_slice = self._precomputed_sample_weights(h5_file, offset, offset + max_at_once, step_mask,
+                                                              fix_padding_names)
+            else:
+                data_slice = self._read_slice(h5_file, name, offset, offset + max_at_once, step_mask,
+                                              fix_padding_names)
+            if self.no_utrs and name == 'data/y':
+                HelixerSequence._zero_out_utrs(self.chunk_size, )
+            if self.load_threads > 1:
+                yield list(self._thread_pool('load_decode', self.load_threads).map(self.compressor.encode,
+                                                                                   data_slice))
+            else:
+                yield [self.compressor.encode(e) for e in data_slice]
+
+    def _read_slice(self, h5_file, name, start, end, step_mask, fix_padding_names):
+        """the unmasked samples of h5_file[name][start:end], with the padding fixed if necessary"""
+        prefix = (0,) if name == 'data/predictions' else ()  # only use one prediction for now
+        if self.load_threads > 1 and DirectChunkReader.supports(h5_file[name], prefix):
+            # the chunks are decompressed in parallel, instead of by h5py
+            rows = np.arange(start, start + len(step_mask))[step_mask]
+            data_slice = DirectChunkReader(h5_file[name], prefix).read(rows, self._thread_pool('load_decode',
+                                                                                               self.load_threads))
+        elif name == 'data/predictions':
+            data_slice = h5_file[name][0, start:end][step_mask]
+        else:
+            data_slice = h5_file[name][start:end][step_mask]
+        if name in fix_padding_names:
+            data_slice = self._fix_reverse_strand_padding(self.chunk_size,
+                                                          h5_file['data/start_ends'][start:end][step_mask],
+                                                          data_slice)
+        return data_slice
+
+    def _precomputed_sample_weights(self, h5_file, start, end, step_mask, fix_padding_names):
+        """the final pooled sample weights of the unmasked samples of h5_file[start:end], as in _generic_get_item"""
+        y, sw, transitions, coverage_scores = [
+            self._read_slice(h5_file, name, start, end, step_mask, fix_padding_names) if used else None
+            for name, used in [('data/y', True), ('data/sample_weights', True),
+                               ('data/transitions', self.mode == 'train' and self.transition_weights is not None),
+                               ('scores/by_bp', self.mode == 'train' and self.coverage_weights)]]
+        overhang = self.chunk_size % self.model.pool_size
+        if overhang:
+            y, sw, transitions, coverage_scores = [None if e is None else e[:, :-overhang]
+                                                   for e in [y, sw, transitions, coverage_scores]]
+        return self._pooled_sample_weights(self._mk_timestep_pools_class_last(y), sw, transitions, coverage_scores)
 
     @staticmethod
     def _fix_reverse_strand_padding(chunk_size, starts_ends, data_slice):
-        # function from Tony
-        out = []
-        for se, data in zip(starts_ends, data_slice):
-            start = se[0]
-            end = se[1]
-
-            if start > end and start - end < chunk_size:  # If reverse and padded
-                idx = start - end
-                valid = data[:idx]  # Valid is at the start
-                padding = data[idx:]  # Followed by padding
-                fixed_data = np.concatenate((padding, valid))  # Move padding to the start of block
-                out.append(fixed_data)
-            else:
-                out.append(data)
-        return out
+        """moves the padding of padded minus strand chunks from the end to the start (in place)"""
+        # only the last chunk of each minus strand sequence can be padded, so just those few get touched
+        lengths = starts_ends[:, 0] - starts_ends[:, 1]
+        padded = np.where(np.logical_and(lengths > 0, lengths < chunk_size))[0]
+        for i in padded:
+            # valid data is at the start, followed by padding; rolling moves the padding to the start of the block
+            data_slice[i] = np.roll(data_slice[i], -lengths[i], axis=0)
+        return data_slice
 
     @staticmethod
     def _zero_out_utrs(y):
@@ -284,15 +784,63 @@ class HelixerSequence(Sequence):
 
     def shuffle_data(self):
         start_time = time.time()
-        self.data_lists = shuffle(*self.data_lists)
+        if self.out_of_core:
+            self.order = self._block_shuffled_order(self.n_seqs, self.shuffle_block_size, self.shuffle_window)
+        else:
+            self.order = np.random.permutation(self.n_seqs)
+        with self._read_ahead_lock:
+            # batches read ahead in the old order are of no use anymore
+            self._read_ahead_futures = {}
         print(f'Reshuffled {self.mode} data in {time.time() - start_time:.2f} secs')
 
+    @staticmethod
+    def _block_shuffled_order(n_seqs, block_size, window):
+        """Random order that reads from only `window` contiguous blocks of `block_size` samples at a time.
+
+        The order of the blocks is shuffled, and then the samples of every `window` consecutive
+        blocks (in the shuffled order) are shuffled together.
+        """
+        block_starts = np.random.permutation(np.arange(0, n_seqs, block_size))
+        order = []
+        for i in range(0, len(block_starts), window):
+            window_idxs = np.concatenate([np.arange(start, min(start + block_size, n_seqs))
+                                          for start in block_starts[i:i + window]])
+            order.append(np.random.permutation(window_idxs))
+        return np.concatenate(order)
+
     def _cp_into_namespace(self, names):
         """Moves class properties from self.model into this class for brevity"""
         for name in names:
             self.__dict__[name] = self.model.__dict__[name]
 
+    def _decode_batch(self, batch_idx):
+        """decoded samples of all datasets of one batch"""
+        names = self.data_list_names
+        if 'backbone/features' in names and not self.input_coverage:
+            # the cached features are all the input, see _hat_input()
+            names = [name for name in names if name != 'data/X']
+        return {name: self.get_batch_of_one_dataset(name, batch_idx) for name in names}
+
+    def _read_ahead_batch(self, batch_idx):
+        """decoded batch, while the following --read-ahead batches are decoded in the background"""
+        with self._read_ahead_lock:
+            executor = self._thread_pool('read_ahead', self.read_ahead)
+            for i in range(batch_idx, min(batch_idx + self.read_ahead + 1, len(self))):
+                if i not in self._read_ahead_futures:
+                    self._read_ahead_futures[i] = executor.submit(self._decode_batch, i)
+            future = self._read_ahead_futures.pop(batch_idx)
+            # drop what was read ahead but will not be asked for anymore (batches are requested about in order)
+            for i in [i for i in self._read_ahead_futures if i < batch_idx - self.read_ahead]:
+                del self._read_ahead_futures[i]
+        return future.result()
+
     def _get_batch_data(self, batch_idx):
+        # tf.data decodes in parallel already, and reads ahead by batch index would mix up its passes
+        if self.read_ahead > 0 and getattr(self._pass_order, 'order', None) is None:
+            decoded_batch = self._read_ahead_batch(batch_idx)
+        else:
+            decoded_batch = self._decode_batch(batch_idx)
+
         batch = []
         # batch must have one thing for everything unpacked by __getitem__ (and in order)
         for name in ['data/X', 'data/y', 'data/sample_weights', 'data/transitions', 'data/phases',
@@ -300,46 +848,105 @@ class HelixerSequence(Sequence):
             if name not in self.data_list_names:
                 batch.append(None)
             else:
-                decoded_list = self.get_batch_of_one_dataset(name, batch_idx)
+                decoded = decoded_batch.get(name)
 
                 # append coverage to X directly, might be clearer elsewhere once working, but this needs little code...
                 if name == 'data/X' and self.input_coverage:
-                    decode_coverage = self.get_batch_of_one_dataset('evaluation/rnaseq_coverage', batch_idx)
-                    decode_coverage = [self._cov_norm(x.reshape(-1, self.coverage_count)).astype(np.float16) for x in decode_coverage]
-                    decode_spliced = self.get_batch_of_one_dataset('evaluation/rnaseq_spliced_coverage', batch_idx)
-                    decode_spliced = [self._cov_norm(x.reshape(-1, self.coverage_count)).astype(np.float16) for x in decode_spliced]
-                    decoded_list = [np.concatenate((x, y, z), axis=1) for x, y, z in
-                                    zip(decoded_list, decode_coverage, decode_spliced)]
-
-                decoded = np.stack(decoded_list, axis=0)
+                    decode_coverage = decoded_batch['evaluation/rnaseq_coverage']
+                    decode_coverage = self._cov_norm(decode_coverage.reshape(len(decoded), -1, self.coverage_count))
+                    decode_spliced = decoded_batch['evaluation/rnaseq_spliced_coverage']
+                    decode_spliced = self._cov_norm(decode_spliced.reshape(len(decoded), -1, self.coverage_count))
+                    decoded = np.concatenate((decoded, decode_coverage.astype(np.float16),
+                                              decode_spliced.astype(np.float16)), axis=2)
+
                 if self.overlap and name == 'data/X':
                     decoded = self.ol_helper.make_input(batch_idx, decoded)
 
+                # the frozen backbone already ran on X, see cache_backbone_features()
+                if name == 'data/X' and 'backbone/features' in decoded_batch:
+                    decoded = self._hat_input(decoded_batch['backbone/features'], decoded)
+
                 batch.append(decoded)
 
         return tuple(batch)
 
-    def get_batch_of_one_dataset(self, name, batch_idx):
-        """returns single batch (the Nth where N=batch_idx) from dataset '{name}'"""
-        # setup indices based on overlapping or not
-        if self.overlap:
-            h5_indices = self.ol_helper.h5_indices_of_batch(batch_idx)
+    def _overlap_helper(self):
+        # can take [0] below bc we've asserted that test means len(self.h5_files) == 1 above
+        if self.shard_ranges is not None:
+            contiguous_ranges = shards.loaded_ranges(self.shard_ranges)
         else:
-            end = min(self.n_seqs, (batch_idx + 1) * self.batch_size)
-            h5_indices = np.arange(batch_idx * self.batch_size, end)
+            contiguous_ranges = helixer.core.helpers.get_contiguous_ranges(self.h5_files[0])
+        if self.overlap_mode == 'boundary':
+            return overlap.BoundarySeqHelper(contiguous_ranges=contiguous_ranges,
+                                             chunk_size=self.chunk_size,
+                                             max_batch_size=self.batch_size,
+                                             core_length=self.core_length)
+        return overlap.OverlapSeqHelper(contiguous_ranges=contiguous_ranges,
+                                        chunk_size=self.chunk_size,
+                                        max_batch_size=self.batch_size,
+                                        overlap_offset=self.overlap_offset,
+                                        core_length=self.core_length)
+
+    def set_batch_size(self, batch_size):
+        """changes the batch size (the maximum number of rows of the model input) for the loaded data, e.g. for
+        --autotune-batch-size"""
+        self.batch_size = batch_size
+        if self.overlap:
+            self.ol_helper = self._overlap_helper()
+
+    def h5_indices_of_batch(self, batch_idx):
+        """the indices of the (loaded) subsequences the batch batch_idx predicts"""
+        if self.overlap:
+            return self.ol_helper.h5_indices_of_batch(batch_idx)
+        order = getattr(self._pass_order, 'order', None)
+        if order is None:
+            order = self.order
+        end = min(len(order), (batch_idx + 1) * self.batch_size)
+        return order[batch_idx * self.batch_size:end]
+
+    def n_chunks_of_batch(self, batch_idx):
+        """the number of subsequences the batch batch_idx predicts (without the context for overlapping)"""
+        if self.overlap:
+            return self.ol_helper.n_chunks_of_batch(batch_idx)
+        return len(self.h5_indices_of_batch(batch_idx))
 
-        return self._decode_one(name, h5_indices)
+    def get_batch_of_one_dataset(self, name, batch_idx):
+        """returns single batch (the Nth where N=batch_idx) from dataset '{name}'"""
+        return self._decode_one(name, self.h5_indices_of_batch(batch_idx))
 
     def _decode_one(self, name, h5_indices):
         """decode batch delineated by h5_indices from compressed data originally from dataset {name}"""
         i = self.data_list_names.index(name)
-        dtype = self.data_dtypes[i]
-        data_list = self.data_lists[i]
-        decoded_list = [np.frombuffer(self.compressor.decode(data_list[idx]), dtype=dtype)
-                        for idx in h5_indices]
-        if len(decoded_list[0]) > self.chunk_size:
-            decoded_list = [e.reshape(self.chunk_size, -1) for e in decoded_list]
-        return decoded_list
+        arena = self.data_arenas[i]
+        decoded = self._batch_array(name, len(h5_indices), self.data_dtypes[i], self.data_sample_shapes[i])
+
+        def decode(j):
+            # blosc decompresses straight into the batch array (and releases the GIL while doing so)
+            self.compressor.decode(arena[h5_indices[j]], out=decoded[j])
+
+        if self.decode_threads > 1 and len(h5_indices) > 1:
+            list(self._thread_pool('decode', self.decode_threads).map(decode, range(len(h5_indices))))
+        else:
+            for j in range(len(h5_indices)):
+                decode(j)
+        return decoded
+
+    def _batch_array(self, name, n, dtype, sample_shape):
+        """array to decode a batch of n samples into, reused between batches where possible"""
+        if name not in self._reused_buffer_names:
+            return np.empty((n,) + sample_shape, dtype=dtype)
+        buffer = getattr(self._reused_buffers, name, None)
+        if buffer is None or len(buffer) < n:
+            buffer = np.empty((max(n, self.batch_size),) + sample_shape, dtype=dtype)
+            setattr(self._reused_buffers, name, buffer)
+        return buffer[:n]
+
+    def _thread_pool(self, name, max_workers):
+        """thread pool of the current process (as forked worker processes do not inherit the threads)"""
+        key = (name, os.getpid())
+        if key not in self._thread_pools:
+            self._thread_pools[key] = ThreadPoolExecutor(max_workers=max_workers)
+        return self._thread_pools[key]
 
     def _cov_norm(self, x):
         method = self.coverage_norm
@@ -452,56 +1059,166 @@ class HelixerSequence(Sequence):
     def __getitem__(self, idx):
         pass
 
+    def _batch_with_order(self, batch_idx, order):
+        """the batch batch_idx (as from __getitem__) of the samples in the given order instead of self.order"""
+        self._pass_order.order = order
+        try:
+            return self[batch_idx]
+        finally:
+            self._pass_order.order = None
+
+    def _batch_template(self):
+        """a batch of a single sample (the first batch when overlapping), for the structure, dtypes and ranks of
+        all batches; only decoded once"""
+        if self._template is None:
+            self._template = self[0] if self.overlap else self._batch_with_order(0, self.order[:1])
+        return self._template
+
+    def _flat_tf_dataset(self):
+        """tf.data pipeline yielding the flattened output of __getitem__, batches are prepared by parallel calls"""
+        template = tf.nest.flatten(self._batch_template())
+        dtypes = [tf.as_dtype(e.dtype) for e in template]
+        # every pass (e.g. of .repeat() or a new iterator of keras for the next epoch) reshuffles self.order, so each
+        # batch is decoded in the order of its own pass, however far ahead tf.data prepares batches;
+        # pass id -> [order, batches not yet decoded], dropped once all batches of the pass are decoded
+        pass_orders = {}
+        pass_orders_lock = threading.Lock()
+        pass_ids = itertools.count()
+
+        def get_flat_batch(pass_and_idx):
+            pass_id, idx = (int(i) for i in pass_and_idx)
+            batch = self._batch_with_order(idx, pass_orders[pass_id][0])
+            with pass_orders_lock:
+                pass_orders[pass_id][1] -= 1
+                if pass_orders[pass_id][1] == 0:
+                    del pass_orders[pass_id]
+            return [np.asarray(e, dtype=t.dtype) for e, t in zip(tf.nest.flatten(batch), template)]
+
+        def load_batch(pass_and_idx):
+            flat = tf.numpy_function(get_flat_batch, [pass_and_idx], dtypes)
+            for tensor, t in zip(flat, template):
+                tensor.set_shape([None] * t.ndim)
+            return tuple(flat)
+
+        def batch_indices():
+            # shuffle when (re-)starting the iteration, i.e. before anything of the epoch is prefetched
+            if self.shuffle:
+                self.shuffle_data()
+            pass_id = next(pass_ids)
+            with pass_orders_lock:
+                pass_orders[pass_id] = [self.order.copy(), len(self)]
+            for idx in range(len(self)):
+                yield pass_id, idx
+
+        dataset = tf.data.Dataset.from_generator(batch_indices,
+                                                 output_signature=tf.TensorSpec(shape=(2,), dtype=tf.int64))
+        # the order only needs to be kept when it matters, i.e. for validation and test
+        dataset = dataset.map(load_batch, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not self.shuffle)
+        dataset = dataset.prefetch(tf.data.AUTOTUNE)
+        options = tf.data.Options()
+        # every replica / worker gets its part of each batch, the batches themselves are not sharded
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+        return dataset.with_options(options)
+
+    def as_tf_dataset(self):
+        """the data as tf.data.Dataset, e.g. for model.fit, with the same batches as this Sequence"""
+        # tf.data would stack lists into one tensor, so multiple inputs / outputs are passed as tuples
+        structure = self._lists_to_tuples(self._batch_template())
+        return self._flat_tf_dataset().map(lambda *flat: tf.nest.pack_sequence_as(structure, list(flat)))
+
+    @staticmethod
+    def _lists_to_tuples(structure):
+        if isinstance(structure, (list, tuple)):
+            return tuple(HelixerSequence._lists_to_tuples(e) for e in structure)
+        return structure
+
+    def iter_batches(self):
+        """yields all batches in order, prepared in parallel with tf.data if --tf-data is set
+        (or from the batch cache with --cache-val-batches once it is complete)"""
+        if self._batch_cache is None:
+            yield from self._iter_batches()
+        elif self._batch_cache.complete:
+            yield from self._batch_cache
+        else:
+            # a previous iteration might have been stopped early
+            self._batch_cache.clear()
+            for batch in self._iter_batches():
+                self._batch_cache.append(batch)
+                yield batch
+            self._batch_cache.complete = True
+
+    def _iter_batches(self):
+        # without batches (e.g. a prediction shard without sequences) there is no template for tf.data either
+        if not self.tf_data or len(self) == 0:
+            for batch_idx in range(len(self)):
+                yield self[batch_idx]
+        else:
+            # restore the exact structure (lists!) from __getitem__ as tf.data turns lists into tuples
+            structure = self._batch_template()
+            for flat in self._flat_tf_dataset().as_numpy_iterator():
+                yield tf.nest.pack_sequence_as(structure, list(flat))
+
+    def _pooled_sample_weights(self, y, sw, transitions, coverage_scores):
+        """pools the sample weights and, in training, weights them by class, transitions and coverage;
+        y is expected to be pooled already, everything else not"""
+        pool_size = self.model.pool_size
+        sw = sw.reshape((sw.shape[0], -1, pool_size))
+        sw = np.logical_not(np.any(sw == 0, axis=2)).astype(np.int8)
+
+        if self.mode == 'train':
+            if self.class_weights is not None:
+                # class weights are additive for the individual timestep predictions
+                # giving even more weight to transition points
+                # class weights without pooling not supported yet
+                # cw = np.array([1.0, 1.2, 1.0, 0.8], dtype=np.float32)
+                cls_arrays = [np.any((y[:, :, :, col] == 1), axis=2) for col in range(4)]
+                cls_arrays = np.stack(cls_arrays, axis=2).astype(np.int8)
+                # add class weights to applicable timesteps
+                cw_arrays = np.multiply(cls_arrays, np.tile(self.class_weights, y.shape[:2] + (1,)))
+                cw = np.sum(cw_arrays, axis=2)
+                sw = np.multiply(cw, sw)
+
+            # todo, while now compressed, the following is still 1:1 with LSTM model... --> HelixerModel
+            if self.transition_weights is not None:
+                transitions = self._mk_timestep_pools_class_last(transitions)
+                # more reshaping and summing  up transition weights for multiplying with sample weights
+                sw_t = self.compress_tw(transitions)
+                sw = np.multiply(sw_t, sw)
+
+            if self.coverage_weights:
+                coverage_scores = coverage_scores.reshape((coverage_scores.shape[0], -1, pool_size))
+                # maybe offset coverage scores [0,1] by small number (bc RNAseq has issues too), default 0.0
+                if self.coverage_offset > 0.:
+                    coverage_scores = np.add(coverage_scores, self.coverage_offset)
+                coverage_scores = np.mean(coverage_scores, axis=2)
+                sw = np.multiply(coverage_scores, sw)
+        return sw
+
     def _generic_get_item(self, idx):
         """covers the data preprocessing (reshape, trim, weighting, etc.) common to all models"""
         X, y, sw, transitions, phases, _, coverage_scores = self._get_batch_data(idx)
         pool_size = self.model.pool_size
 
         if pool_size > 1:
-            if X.shape[1] % pool_size != 0:
+            if self.chunk_size % pool_size != 0:
                 # clip to maximum size possible with the pooling length
-                overhang = X.shape[1] % pool_size
-                X = X[:, :-overhang]
+                overhang = self.chunk_size % pool_size
+                if 'backbone/features' not in self.data_list_names:  # else X is clipped already
+                    X = X[:, :-overhang]
                 if not self.only_predictions:
                     y = y[:, :-overhang]
-                    sw = sw[:, :-overhang]
                     if self.predict_phase:
                         phases = phases[:, :-overhang]
-                    if self.mode == 'train' and self.transition_weights is not None:
-                        transitions = transitions[:, :-overhang]
+                    if not self.precompute_weights:
+                        sw = sw[:, :-overhang]
+                        if self.mode == 'train' and self.transition_weights is not None:
+                            transitions = transitions[:, :-overhang]
 
             if not self.only_predictions:
                 y = self._mk_timestep_pools_class_last(y)
-                sw = sw.reshape((sw.shape[0], -1, pool_size))
-                sw = np.logical_not(np.any(sw == 0, axis=2)).astype(np.int8)
-
-            if self.mode == 'train':
-                if self.class_weights is not None:
-                    # class weights are additive for the individual timestep predictions
-                    # giving even more weight to transition points
-                    # class weights without pooling not supported yet
-                    # cw = np.array([1.0, 1.2, 1.0, 0.8], dtype=np.float32)
-                    cls_arrays = [np.any((y[:, :, :, col] == 1), axis=2) for col in range(4)]
-                    cls_arrays = np.stack(cls_arrays, axis=2).astype(np.int8)
-                    # add class weights to applicable timesteps
-                    cw_arrays = np.multiply(cls_arrays, np.tile(self.class_weights, y.shape[:2] + (1,)))
-                    cw = np.sum(cw_arrays, axis=2)
-                    sw = np.multiply(cw, sw)
-
-                # todo, while now compressed, the following is still 1:1 with LSTM model... --> HelixerModel
-                if self.transition_weights is not None:
-                    transitions = self._mk_timestep_pools_class_last(transitions)
-                    # more reshaping and summing  up transition weights for multiplying with sample weights
-                    sw_t = self.compress_tw(transitions)
-                    sw = np.multiply(sw_t, sw)
-
-                if self.coverage_weights:
-                    coverage_scores = coverage_scores.reshape((coverage_scores.shape[0], -1, pool_size))
-                    # maybe offset coverage scores [0,1] by small number (bc RNAseq has issues too), default 0.0
-                    if self.coverage_offset > 0.:
-                        coverage_scores = np.add(coverage_scores, self.coverage_offset)
-                    coverage_scores = np.mean(coverage_scores, axis=2)
-                    sw = np.multiply(coverage_scores, sw)
+                # precomputed weights are loaded already pooled and weighted
+                if not self.precompute_weights:
+                    sw = self._pooled_sample_weights(y, sw, transitions, coverage_scores)
 
             if self.predict_phase and not self.only_predictions:
                 y_phase = self._mk_timestep_pools_class_last(phases)
@@ -517,14 +1234,30 @@ class HelixerModel(ABC):
         self.parser = argparse.ArgumentParser()
         self.parser.add_argument('-d', '--data-dir', type=str, default=None)
         self.parser.add_argument('-s', '--save-model-path', type=str, default='./best_model.h5')
-        self.parser.add_argument('--large-eval-folder', type=str, default='', help=argparse.SUPPRESS)
+        self.parser.add_argument('--large-eval-folder', type=str, default='',
+                                 help='folder with one h5 file per species ({species}.h5) to evaluate the best model '
+                                      'on at the end of training, or on after --eval')
+        self.parser.add_argument('--large-eval-workers', type=int, default=1,
+                                 help='number of worker processes (each with a copy of the model) evaluating '
+                                      'the species of --large-eval-folder in parallel')
         # training params
         self.parser.add_argument('-e', '--epochs', type=int, default=10000)
         self.parser.add_argument('-b', '--batch-size', type=int, default=8)
         self.parser.add_argument('--val-test-batch-size', type=int, default=32)
+        self.parser.add_argument('--accumulate-steps', type=int, default=1,
+                                 help='sum the gradients of this many batches (of --batch-size) before every '
+                                      'optimizer step, for larger effective batch sizes with the same memory')
         self.parser.add_argument('--loss', type=str, default='')
         self.parser.add_argument('--patience', type=int, default=3)
         self.parser.add_argument('--check-every-nth-batch', type=int, default=1_000_000)
+        self.parser.add_argument('--approx-val-fraction', type=float, default=None,
+                                 help='validate on a fixed, stratified (by species and fully intergenic or not) '
+                                      'fraction of the validation data first, and on all of it only if the upper end '
+                                      'of the 95%% confidence interval of the genic f1 could be a new best; only '
+                                      'full validations count towards the --patience and are reported to nni')
+        self.parser.add_argument('--approx-val-bootstrap', type=int, default=1000,
+                                 help='number of bootstrap samples (of validation batches) for the confidence '
+                                      'interval of --approx-val-fraction')
         self.parser.add_argument('--optimizer', type=str, default='adamw')
         self.parser.add_argument('--clip-norm', type=float, default=3.0)
         self.parser.add_argument('--learning-rate', type=float, default=3e-4)
@@ -540,15 +1273,60 @@ class HelixerModel(ABC):
         self.parser.add_argument('--load-predictions', action='store_true', help=argparse.SUPPRESS)  # bc no models that can use this are available
         self.parser.add_argument('--resume-training', action='store_true')
         # testing / predicting
-        self.parser.add_argument('-l', '--load-model-path', type=str, default='')
+        self.parser.add_argument('-l', '--load-model-path', type=str, nargs='+', default=[''],
+                                 help='model to resume training from or to predict / evaluate with; several models '
+                                      'predict / evaluate as an ensemble, averaging their outputs for every batch')
+        self.parser.add_argument('--shared-backbone', action='store_true',
+                                 help='with several --load-model-path that only differ from their first dense layer '
+                                      'on (e.g. fine tuned from the same model): run the shared layers before (the '
+                                      'backbone) once per batch and write the predictions of every model to '
+                                      'head<i>/predictions(_phase) instead of averaging them')
         self.parser.add_argument('-t', '--test-data', type=str, default='')
         self.parser.add_argument('-p', '--prediction-output-path', type=str, default='predictions.h5')
+        self.parser.add_argument('--shard', type=str, default=None,
+                                 help='i/N: predict only the i-th (counting from 0) of N shards of the test data, '
+                                      'each having whole sequences (contiguous ranges), balanced by the number of '
+                                      'subsequences; scripts/merge_prediction_shards.py assembles the predictions of '
+                                      'all shards')
         self.parser.add_argument('--compression', default='gzip', help='compression used for datasets in predictions '
-                                                                       'h5 file. One of "lzf" or "gzip" (default)')
+                                                                       'h5 file. One of "lzf", "gzip" (default) '
+                                                                       'or "none"')
+        self.parser.add_argument('--compression-level', type=int, default=4,
+                                 help='gzip compression level (0-9) of the predictions h5 file')
+        self.parser.add_argument('--prediction-chunk-rows', type=int, default=1,
+                                 help='number of subsequences per chunk of the datasets in the predictions h5 file; '
+                                      'more rows per chunk are quicker to write and to read in large blocks')
+        self.parser.add_argument('--write-queue-size', type=int, default=4,
+                                 help='number of predicted batches that can wait to be compressed and written by a '
+                                      'background thread while the next batches are predicted (0: no background '
+                                      'writing)')
+        self.parser.add_argument('--autotune-batch-size', action='store_true',
+                                 help='before predicting, time the first batches with growing (doubling) '
+                                      '--val-test-batch-size and predict with the one that has the most bases per '
+                                      'second within --autotune-memory-limit')
+        self.parser.add_argument('--autotune-max-batch-size', type=int, default=1024,
+                                 help='largest --val-test-batch-size tried by --autotune-batch-size')
+        self.parser.add_argument('--autotune-memory-limit', type=float, default=None,
+                                 help='GB of (GPU or, without, main) memory that the prediction may use at peak with '
+                                      'the batch size chosen by --autotune-batch-size (default: 80%% of the main '
+                                      'memory, on GPU only limited by the GPU memory)')
+        self.parser.add_argument('--compiled-model-cache', action='store_true',
+                                 help='predict with a compiled form (SavedModel) of the model, which is exported '
+                                      'next to the (first) --load-model-path (or, if that is not writable, to the '
+                                      'cache directory of the user) on the first use and keyed by the md5 sum of '
+                                      'the model file(s); later predictions start quicker as the model is neither '
+                                      'rebuilt nor traced again. Only used on a single device (one GPU or CPU), '
+                                      'with several GPUs the keras model is replicated on them instead')
         self.parser.add_argument('--eval', action='store_true')
         self.parser.add_argument('--overlap', action="store_true",
                                  help="will improve prediction quality at 'chunk' ends by creating and overlapping "
                                       "sliding-window predictions (with proportional increase in time usage)")
+        self.parser.add_argument('--overlap-mode', type=str, default='full', choices=['full', 'boundary'],
+                                 help="'full': sliding windows every --overlap-offset over the whole sequence; "
+                                      "'boundary': every subsequence is predicted once and only the ends beyond "
+                                      "--core-length are replaced by the predictions of one extra window centered "
+                                      "on each junction of consecutive subsequences (~1.5x the time of no "
+                                      "overlapping with the default --core-length, less with a longer one)")
         self.parser.add_argument('--overlap-offset', type=int, default=None,
                                  help="distance to 'step' between predicting subsequences when overlapping "
                                       "(default: subsequence_length / 2)")
@@ -561,14 +1339,81 @@ class HelixerModel(ABC):
         self.parser.add_argument('--gpu-id', type=int, default=-1,
                                  help='sets GPU index, use if you want to train on one GPU on a multi-GPU machine '
                                       'without a job scheduler system')
+        self.parser.add_argument('--intra-op-threads', type=int, default=0,
+                                 help='number of threads TensorFlow uses within one operation (e.g. a matrix '
+                                      'multiplication); 0 lets TensorFlow choose from the available cores')
+        self.parser.add_argument('--inter-op-threads', type=int, default=0,
+                                 help='number of threads TensorFlow uses to run independent operations in parallel; '
+                                      '0 lets TensorFlow choose from the available cores')
+        self.parser.add_argument('--cpu-inference', action='store_true',
+                                 help='predict on CPU only: ignore GPUs, set --intra-op-threads and '
+                                      '--inter-op-threads (unless given) from the cores this process may use '
+                                      'and --autotune-batch-size; whether TensorFlow uses oneDNN is logged, it '
+                                      'can only be enabled with TF_ENABLE_ONEDNN_OPTS=1 before starting')
+        self.parser.add_argument('--multi-worker', action='store_true',
+                                 help='train data parallel on several machines (workers) with '
+                                      'MultiWorkerMirroredStrategy, configured by the TF_CONFIG environment variable '
+                                      'or by --worker-hosts and --worker-index; every worker loads its share of the '
+                                      'training data and only the chief (worker 0) writes the model')
+        self.parser.add_argument('--worker-hosts', type=str, default=None,
+                                 help='comma separated host:port of all workers for --multi-worker, the same on '
+                                      'every worker (instead of TF_CONFIG)')
+        self.parser.add_argument('--worker-index', type=int, default=0,
+                                 help='index of this worker in --worker-hosts')
         self.parser.add_argument('--workers', type=int, default=1,
-                                 help='number of threads used to fetch input data for training; '
-                                      'consider setting to match the number of GPUs')
+                                 help='number of threads (or processes with --use-multiprocessing) used to fetch '
+                                      'input data for training; consider setting to match the number of GPUs')
+        self.parser.add_argument('--use-multiprocessing', action='store_true',
+                                 help='fetch input data for training with worker processes instead of threads; '
+                                      'best combined with --arena-backing shm or mmap')
+        self.parser.add_argument('--arena-backing', type=str, default='memory', choices=['memory', 'shm', 'mmap'],
+                                 help='where the compressed data is kept: in private memory, in POSIX shared memory '
+                                      'or in a memory mapped file in --arena-dir; the latter two are shared with '
+                                      'worker processes without copying')
+        self.parser.add_argument('--arena-dir', type=str, default=None,
+                                 help='directory for the memory mapped files of --arena-backing mmap '
+                                      '(default: system temporary directory)')
+        self.parser.add_argument('--out-of-core', action='store_true',
+                                 help='for data larger than RAM: keep the compressed data in memory mapped files in '
+                                      '--arena-dir (or --data-cache-dir) on disk, shuffle block wise and read ahead')
+        self.parser.add_argument('--shuffle-block-size', type=int, default=512,
+                                 help='number of contiguous samples that are read together when shuffling with '
+                                      '--out-of-core')
+        self.parser.add_argument('--shuffle-window', type=int, default=8,
+                                 help='number of (randomly chosen) blocks whose samples are shuffled together with '
+                                      '--out-of-core')
+        self.parser.add_argument('--read-ahead', type=int, default=None,
+                                 help='number of batches that are decoded ahead in the background '
+                                      '(default: 4 with --out-of-core, else 0)')
+        self.parser.add_argument('--decode-threads', type=int, default=4,
+                                 help='number of threads decompressing the samples of a batch in parallel')
+        self.parser.add_argument('--precompute-weights', action='store_true',
+                                 help='calculate the final pooled sample weights (incl. class and transition '
+                                      'weights) once when loading the data instead of for every batch')
+        self.parser.add_argument('--load-threads', type=int, default=4,
+                                 help='number of threads loading the h5 files: several datasets and files are read '
+                                      'at a time and gzip compressed chunks are decompressed in parallel')
+        self.parser.add_argument('--cache-val-batches', type=str, default=None, choices=['memory', 'disk'],
+                                 help='keep the validation batches in their final form after the first check-in, '
+                                      'in memory or in (memory mapped) files in --arena-dir, so that later check-ins '
+                                      'only need the forward passes')
+        self.parser.add_argument('--tf-data', action='store_true',
+                                 help='feed the data through a tf.data pipeline that prepares batches in parallel '
+                                      'and prefetches them, instead of through the keras Sequence (and --workers)')
+        self.parser.add_argument('--data-cache-dir', type=str, default=None,
+                                 help='directory to cache the loaded and compressed data in; later runs with the '
+                                      'same h5 files and data relevant settings memory map the cache instead of '
+                                      'loading the h5 files again')
         # misc flags
         self.parser.add_argument('--save-every-check', action='store_true')
         self.parser.add_argument('--nni', action='store_true')
         self.parser.add_argument('-v', '--verbose', action='store_true')
         self.parser.add_argument('--debug', action='store_true')
+        self.parser.add_argument('--profile-data-path', type=str, default=None,
+                                 help='time every training batch (waiting for data vs. training step) and write '
+                                      'percentiles of these and of the throughput to this .json or .csv file')
+        self.parser.add_argument('--profile-every', type=int, default=100,
+                                 help='number of batches summarized at a time with --profile-data-path')
         tuner = self.parser.add_argument_group('fine tuning',
                                                'experimental parameters for training (a) final layer(s) '
                                                'of the model on target species (or other small dataset) '
@@ -588,6 +1433,12 @@ class HelixerModel(ABC):
                            help='None, linear or log (recommended); how coverage will be normalized before inputting')
         tuner.add_argument('--post-coverage-hidden-layer', action='store_true',
                            help='adds extra dense layer between concatenating coverage and final output layer')
+        tuner.add_argument('--cache-backbone-features', type=str, default=None, choices=['memory', 'disk'],
+                           help='use with --fine-tune to run the frozen layers just once over the training and '
+                                'validation data and keep their output (float16, compressed) in memory or in '
+                                '--arena-dir, so that only the new final layer(s) run while fine tuning; the '
+                                'features are computed in inference mode, i.e. without the dropout of the frozen '
+                                'layers (e.g. --dropout1 and --dropout2)')
 
         self.coverage_count = None
 
@@ -598,7 +1449,7 @@ class HelixerModel(ABC):
         args = vars(self.parser.parse_args(args=self.cli_args))
 
         # hack to deprecate a few args
-        for arg in ['large_eval_folder', 'cpus', 'stretch_transition_weights', 'coverage_weights', 'coverage_offset',
+        for arg in ['cpus', 'stretch_transition_weights', 'coverage_weights', 'coverage_offset',
                     'calculate_uncertainty', 'no_utrs', 'load_predictions']:
             default = self.parser.get_default(arg)
             if args[arg] != default:
@@ -609,6 +1460,9 @@ class HelixerModel(ABC):
                 args[arg] = default
 
         self.__dict__.update(args)
+        # load_model_path is the first (usually only) model, the others are only for ensembles
+        self.load_model_paths = self.load_model_path
+        self.load_model_path = self.load_model_paths[0]
 
         if self.nni:
             hyperopt_args = nni.get_next_parameter()
@@ -646,6 +1500,23 @@ class HelixerModel(ABC):
 
         assert not (not self.testing and self.test_data)
         assert not (self.resume_training and (not self.load_model_path or not self.data_dir))
+        assert len(self.load_model_paths) == 1 or self.testing, 'ensembles of models are only for predictions / eval'
+        if self.shard is not None:
+            self.shard_index, self.n_shards = shards.parse_shard(self.shard)
+            assert self.only_predictions, '--shard is only for predictions, not for training or --eval'
+        else:
+            self.shard_index, self.n_shards = 0, 1
+        if self.cpu_inference:
+            assert self.only_predictions, '--cpu-inference is only for predictions, not for training or --eval'
+            self.autotune_batch_size = True
+        if self.autotune_batch_size:
+            assert self.only_predictions, '--autotune-batch-size is only for predictions, not for training or --eval'
+        if self.compiled_model_cache:
+            # whether there is more than one device (and the cache is skipped) is only known in run()
+            assert self.only_predictions, '--compiled-model-cache is only for predictions, not for training or --eval'
+        if self.shared_backbone:
+            assert len(self.load_model_paths) > 1 and self.only_predictions, \
+                '--shared-backbone is for predicting with several models (--load-model-path), not for --eval'
 
         self.class_weights = eval(self.class_weights)
         if not isinstance(self.class_weights, (list, np.ndarray, type(None))):
@@ -662,6 +1533,28 @@ class HelixerModel(ABC):
         if type(self.transition_weights) is list:
             self.transition_weights = np.array(self.transition_weights, dtype=np.float32)
 
+        if self.read_ahead is None:
+            self.read_ahead = 4 if self.out_of_core else 0
+
+        if self.worker_hosts:
+            os.environ['TF_CONFIG'] = json.dumps({'cluster': {'worker': self.worker_hosts.split(',')},
+                                                  'task': {'type': 'worker', 'index': self.worker_index}})
+            self.multi_worker = True
+        if self.multi_worker:
+            assert not self.testing, '--multi-worker is only for training'
+            self.worker_index, self.num_workers = self.multi_worker_info()
+            if not self.tf_data:
+                print('using --tf-data, as every worker feeds its share of the data through its own pipeline')
+                self.tf_data = True
+        else:
+            self.worker_index, self.num_workers = 0, 1
+        # the chief writes the checkpoints, logs etc. for all workers
+        self.is_chief = self.worker_index == 0
+
+        if self.cache_backbone_features is not None:
+            assert self.resume_training and self.fine_tune, \
+                '--cache-backbone-features is only possible when fine tuning from scratch (--fine-tune)'
+
         if self.verbose:
             print(colored('HelixerModel config: ', 'yellow'))
             pprint(args)
@@ -669,34 +1562,83 @@ class HelixerModel(ABC):
         # this extracts the pool size from the model file without initializing it or any resources
         # this then sets the pool size to the one inferred from the loaded model
         if self.load_model_path:
-            import json
             with h5py.File(self.load_model_path, "r") as f:
                 config = json.loads(f.attrs["model_config"])["config"]
                 for layer in config["layers"]:
                     if layer['name'] == 'reshape_hat':
                         self.pool_size = layer['config']['target_shape'][1]  # target shape: [-1, pool_size, n_classes]
 
+    @staticmethod
+    def multi_worker_info():
+        """index of this worker and the number of workers from TF_CONFIG, the chief (if any) has index 0"""
+        tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+        assert 'cluster' in tf_config and 'task' in tf_config, \
+            'TF_CONFIG (or --worker-hosts) is required for --multi-worker'
+        chiefs = tf_config['cluster'].get('chief', [])
+        workers = chiefs + tf_config['cluster'].get('worker', [])
+        task_type, task_index = tf_config['task']['type'], tf_config['task']['index']
+        assert task_type in ['chief', 'worker'], f'unsupported task type {task_type} for --multi-worker'
+        if task_type == 'worker':
+            task_index += len(chiefs)
+        return task_index, len(workers)
+
     def generate_callbacks(self, train_generator):
-        callbacks = [ConfusionMatrixTrain(self.save_model_path, train_generator, self.gen_validation_data(),
+        val_generator = self.gen_validation_data()
+        if self.backbone_model is not None:
+            val_generator.cache_backbone_features(self.backbone_model, self.cache_backbone_features)
+        if self.approx_val_fraction is not None:
+            approx_val_generator = val_generator.stratified_subset(self.approx_val_fraction)
+        else:
+            approx_val_generator = None
+        callbacks = [ConfusionMatrixTrain(self.save_model_path, train_generator, val_generator,
                                           self.large_eval_folder, self.patience, calc_H=self.calculate_uncertainty,
                                           report_to_nni=self.nni, check_every_nth_batch=self.check_every_nth_batch,
-                                          save_every_check=self.save_every_check),
-                     PreshuffleCallback(train_generator)]
+                                          save_every_check=self.save_every_check,
+                                          approx_val_generator=approx_val_generator,
+                                          approx_val_bootstrap=self.approx_val_bootstrap,
+                                          large_eval_workers=self.large_eval_workers,
+                                          full_model=self.full_model, is_chief=self.is_chief)]
+        if not self.tf_data:
+            # the tf.data pipeline shuffles by itself when starting each epoch
+            callbacks.append(PreshuffleCallback(train_generator))
+        if self.profile_data_path:
+            callbacks.append(DataStallProfiler(train_generator, self.profile_data_path,
+                                               summarize_every=self.profile_every, is_chief=self.is_chief,
+                                               per_replica_batches=self.multi_worker, num_workers=self.num_workers))
         return callbacks
 
     def set_resources(self):
+        if self.cpu_inference:
+            n_cpus = len(cpu_workers.available_cpus())
+            intra_op_threads, inter_op_threads = cpu_workers.tf_threads(n_cpus)
+            self.intra_op_threads = self.intra_op_threads or intra_op_threads
+            self.inter_op_threads = self.inter_op_threads or inter_op_threads
+        # thread pools have to be configured before TensorFlow starts up
+        if self.intra_op_threads > 0:
+            tf.config.threading.set_intra_op_parallelism_threads(self.intra_op_threads)
+        if self.inter_op_threads > 0:
+            tf.config.threading.set_inter_op_parallelism_threads(self.inter_op_threads)
         gpu_devices = tf.config.experimental.list_physical_devices('GPU')
         for device in gpu_devices:
             tf.config.experimental.set_memory_growth(device, True)
 
         K.set_floatx(self.float_precision)
-        if self.gpu_id > -1:
+        if self.cpu_inference:
+            tf.config.set_visible_devices([], 'GPU')
+            print(colored(f'CPU inference on {n_cpus} cores with {self.intra_op_threads} intra-op and '
+                          f'{self.inter_op_threads} inter-op threads', 'green'))
+            # TensorFlow reads TF_ENABLE_ONEDNN_OPTS when it is imported, i.e. before this
+            if not cpu_workers.onednn_enabled():
+                print(colored('TensorFlow does not use oneDNN, set TF_ENABLE_ONEDNN_OPTS=1 before starting to use it '
+                              'where TensorFlow was built with it', 'yellow'))
+        elif self.gpu_id > -1:
             tf.config.set_visible_devices([gpu_devices[self.gpu_id]], 'GPU')
 
     def gen_training_data(self):
         SequenceCls = self.sequence_cls()
-        return SequenceCls(model=self, h5_files=self.h5_trains, mode='train', batch_size=self.batch_size,
-                           shuffle=True)
+        # every batch is split into --accumulate-steps micro batches of --batch-size by the model
+        return SequenceCls(model=self, h5_files=self.h5_trains, mode='train',
+                           batch_size=self.batch_size * self.accumulate_steps, shuffle=True)
 
     def gen_validation_data(self):
         SequenceCls = self.sequence_cls()
@@ -721,7 +1663,47 @@ class HelixerModel(ABC):
         return genic_metrics['precision'], genic_metrics['recall'], genic_metrics['f1']
 
     @staticmethod
-    def run_large_eval(folder, model, generator, training_species, print_to_stdout=False, calc_H=False):
+    def run_approx_metrics(generator, model, n_bootstrap=1000):
+        """genic f1 on (a subset of) the validation data, with a bootstrapped 95% confidence interval"""
+        start = time.time()
+        metrics_calculator = Metrics(generator, print_to_stdout=False, keep_batch_cms=True)
+        metrics = metrics_calculator.calculate_metrics(model)
+        genic_f1 = metrics['genic_base_wise']['genic']['f1']
+        if np.isnan(genic_f1):
+            genic_f1 = 0.0
+        ci = Metrics.bootstrap_genic_f1(metrics_calculator.batch_genic_cms, n_bootstrap=n_bootstrap)
+        print('\napproximate metrics calculation took: {:.2f} minutes'.format(int(time.time() - start) / 60))
+        return genic_f1, ci
+
+    @staticmethod
+    def species_of(h5_files):
+        """names of all species in the h5 files"""
+        species = np.unique(np.concatenate([h5_file['data/species'][:] for h5_file in h5_files]))
+        return [s.decode() for s in species]
+
+    @staticmethod
+    def eval_one_species(sequence_cls, model_args, eval_file_name, batch_size, print_to_stdout, calc_H, model):
+        """metrics of the model on the validation-like data of one species"""
+        h5_eval = h5py.File(eval_file_name, 'r')
+        gen = sequence_cls(model=model_args, h5_files=[h5_eval], mode='val', batch_size=batch_size, shuffle=False)
+        perf_one_species = HelixerModel.run_metrics(gen, model, print_to_stdout=print_to_stdout, calc_H=calc_H)
+        h5_eval.close()
+        return perf_one_species
+
+    @staticmethod
+    def _picklable_args(helixer_model):
+        """the parameters of a HelixerModel that sequences use, for sequences in other processes (the model itself
+        has open files etc.)"""
+        return argparse.Namespace(**{name: getattr(helixer_model, name)
+                                     for name in HelixerSequence.MODEL_ARGS + ['pool_size']})
+
+    @staticmethod
+    def run_large_eval(folder, model, generator, training_species, print_to_stdout=False, calc_H=False,
+                       model_path=None, n_workers=1):
+        """Evaluates the model on every species ({folder}/{species}.h5) with the validation settings. With
+        n_workers > 1, the species are evaluated in that many worker processes, each loading the model from
+        model_path (a list of paths for an ensemble) once. The loaded data of every species is cached with
+        --data-cache-dir."""
         def print_table(results, table_name, training_species):
             table = [['Name', 'Precision', 'Recall', 'F1-Score']]
             for name, values in results:
@@ -730,26 +1712,35 @@ class HelixerModel(ABC):
                 table.append([name] + [f'{v:.4f}' for v in values])
             print('\n', AsciiTable(table, table_name).table, sep='')
 
-        results = []
         training_species = [s.lower() for s in training_species]
-        eval_file_names = glob.glob(f'{folder}/*.h5')
-        for i, eval_file_name in enumerate(eval_file_names):
-            h5_eval = h5py.File(eval_file_name, 'r')
-            species_name = os.path.basename(eval_file_name).split('.')[0]
-            print(f'\nEvaluating with a sample of {species_name} ({i + 1}/{len(eval_file_names)})')
-
+        eval_file_names = sorted(glob.glob(f'{folder}/*.h5'))
+        species_names = [os.path.basename(eval_file_name).split('.')[0] for eval_file_name in eval_file_names]
+        jobs = []
+        for eval_file_name in eval_file_names:
             # possibly adjust batch size based on sample length, which could be flexible
             # assume the given batch size is for 20k length
-            sample_len = h5_eval['data/X'].shape[1]
+            with h5py.File(eval_file_name, 'r') as h5_eval:
+                sample_len = h5_eval['data/X'].shape[1]
             adjusted_batch_size = int(generator.batch_size * (20000 / sample_len))
-            print(f'adjusted batch size is {adjusted_batch_size}')
-
             # use exactly the data generator that is used during validation
-            GenCls = generator.__class__
-            gen = GenCls(model=generator.model, h5_file=h5_eval, mode='val',
-                         batch_size=adjusted_batch_size, shuffle=False)
-            perf_one_species = HelixerModel.run_metrics(gen, model, print_to_stdout=print_to_stdout, calc_H=calc_H)
-            results.append([species_name, perf_one_species])
+            jobs.append((generator.__class__, generator.model, eval_file_name, adjusted_batch_size,
+                         print_to_stdout, calc_H))
+
+        if n_workers > 1:
+            assert model_path is not None, 'the worker processes need the path of the model to load it'
+            print(f'\nEvaluating {len(jobs)} species with {n_workers} worker processes')
+            jobs = [(job[0], HelixerModel._picklable_args(job[1])) + job[2:] for job in jobs]
+            # spawn, as forking a process with an initialized tensorflow is not safe
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_init_large_eval_worker, initargs=(model_path,)) as executor:
+                perfs = list(executor.map(_eval_one_species_in_worker, *zip(*jobs)))
+        else:
+            perfs = []
+            for i, (species_name, job) in enumerate(zip(species_names, jobs)):
+                print(f'\nEvaluating with a sample of {species_name} ({i + 1}/{len(jobs)})')
+                print(f'adjusted batch size is {job[3]}')
+                perfs.append(HelixerModel.eval_one_species(*job, model=model))
+        results = [[species_name, perf] for species_name, perf in zip(species_names, perfs)]
         # print results in tables sorted alphabetically and by f1
         results_by_name = sorted(results, key=lambda r: r[0])
         results_by_f1 = sorted(results, key=lambda r: r[1][2], reverse=True)
@@ -758,7 +1749,7 @@ class HelixerModel(ABC):
 
         # print one number summaries
         f1_scores = np.array([r[1][2] for r in results])
-        in_train = np.array([r[0].lower() in training_species for r in results], dtype=np.bool)
+        in_train = np.array([r[0].lower() in training_species for r in results], dtype=bool)
         table = [['Metric', 'All', 'Training', 'Evaluation']]
         for name, func in zip(['Median F1', 'Average F1', 'Stddev F1'], [np.median, np.mean, np.std]):
             table.append([name, f'{func(f1_scores):.4f}',
@@ -884,89 +1875,195 @@ class HelixerModel(ABC):
                 print('Fully correct test seqs: {:.2f}%\n'.format(
                     n_test_correct_seqs / self.shape_test[0] * 100))
 
+    def _autotuned_batch_size(self, model, test_sequence):
+        """times the prediction of the first two batches with doubling batch sizes, from 4 up to
+        --autotune-max-batch-size, and sets the one with the most bases per second; stops at the first batch size
+        that is slower than the best so far, runs out of memory or exceeds --autotune-memory-limit"""
+        on_gpu = bool(tf.config.list_logical_devices('GPU'))
+        if self.autotune_memory_limit is not None:
+            memory_limit = self.autotune_memory_limit * 2 ** 30
+        elif on_gpu:
+            memory_limit = None
+        else:
+            memory_limit = 0.8 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        # on CPU, a batch size needs the memory the process has before the autotuning (data and model) plus what
+        # it grows by while predicting with the batch size (the peak RSS would include e.g. the data loading)
+        base_memory = None if on_gpu else cpu_workers.resident_memory()
+
+        print(colored('Autotuning the batch size for prediction', 'green'))
+        best_batch_size, best_speed = None, 0
+        batch_size = 4
+        while batch_size <= self.autotune_max_batch_size:
+            try:
+                test_sequence.set_batch_size(batch_size)
+            except AssertionError:
+                batch_size *= 2  # too small to overlap
+                continue
+            if on_gpu:
+                tf.config.experimental.reset_memory_stats('GPU:0')
+            memory_before = None if base_memory is None else cpu_workers.resident_memory()
+            batch_indices = range(min(2, len(test_sequence)))
+            batches = [test_sequence[i] for i in batch_indices]
+            n_bases = sum(test_sequence.n_chunks_of_batch(i) for i in batch_indices) * test_sequence.chunk_size
+            try:
+                for batch in batches:
+                    model.predict_on_batch(batch)  # not timed, the prediction function is traced for new shapes
+                start_time = time.time()
+                predictions = [model.predict_on_batch(batch) for batch in batches]
+                speed = n_bases / (time.time() - start_time)
+            except tf.errors.ResourceExhaustedError:
+                print(f'batch size {batch_size}: out of memory')
+                break
+            if on_gpu:
+                memory = tf.config.experimental.get_memory_info('GPU:0')['peak']
+            elif base_memory is not None:
+                # with the batches and their predictions still in memory
+                memory = base_memory + max(cpu_workers.resident_memory() - memory_before, 0)
+            else:
+                memory = None
+            del batches, predictions
+            if memory is None:
+                print(f'batch size {batch_size}: {speed:,.0f} bp/s')
+                memory = 0  # unknown, only out of memory errors stop the autotuning
+            else:
+                print(f'batch size {batch_size}: {speed:,.0f} bp/s, memory {memory / 2 ** 30:.2f} GB')
+            if memory_limit is not None and memory > memory_limit:
+                print(f'batch size {batch_size}: above the memory limit of {memory_limit / 2 ** 30:.2f} GB')
+                break
+            if speed < best_speed:
+                break
+            best_batch_size, best_speed = batch_size, speed
+            if len(test_sequence) == 1:
+                break  # all data is in one batch already
+            batch_size *= 2
+        if best_batch_size is None:
+            best_batch_size = self.val_test_batch_size
+        test_sequence.set_batch_size(best_batch_size)
+        print(colored(f'Predicting with batch size {best_batch_size}', 'green'))
+        return best_batch_size
+
     def _make_predictions(self, model):
         # loop through batches and continuously expand output dataset as everything might
         # not fit in memory
         pred_out = h5py.File(self.prediction_output_path, 'w')
         test_sequence = self.gen_test_data()
-
-        for batch_index in range(len(test_sequence)):
-            if self.verbose:
-                print(batch_index, '/', len(test_sequence), end='\r')
-            if not self.only_predictions:
-                input_data = test_sequence[batch_index][0]
-            else:
-                input_data = test_sequence[batch_index]
-            try:
-                predictions = model.predict_on_batch(input_data)
-            except Exception as e:
-                print(colored('Errors at prediction often result from exhausting the GPU RAM.'
-                              'Your RAM requirement depends on subsequence_length x (val_test_)batch_size.'
-                              'That and the network size (can be changed during training but not inference).',
-                              'red'))
-                raise e
-            if isinstance(predictions, list):
-                # when we have two outputs, one is for phase
-                # is dependent on the model with which you predict for Helixer.py
-                # so even though we don't pass in --predict-phase as true, it gets predicted
-                output_names = ['predictions', 'predictions_phase']
-            else:
-                # if we just had one output
-                predictions = (predictions,)
-                output_names = ['predictions']
-
-            for dset_name, pred_dset in zip(output_names, predictions):
-                # join last two dims when predicting one hot labels
-                pred_dset = pred_dset.reshape(pred_dset.shape[:2] + (-1,))
-                # reshape when predicting more than one point at a time
-                label_dim = 4
-                if pred_dset.shape[2] != label_dim:
-                    n_points = pred_dset.shape[2] // label_dim
-                    pred_dset = pred_dset.reshape(
-                        pred_dset.shape[0],
-                        pred_dset.shape[1] * n_points,
-                        label_dim,
-                    )
-                    # add 0-padding if needed
-                    n_removed = self.shape_test[1] - pred_dset.shape[1]
-                    if n_removed > 0:
-                        zero_padding = np.zeros((pred_dset.shape[0], n_removed, pred_dset.shape[2]),
-                                                dtype=pred_dset.dtype)
-                        pred_dset = np.concatenate((pred_dset, zero_padding), axis=1)
-                else:
-                    n_removed = 0  # just to avoid crashing with Unbound Local Error setting attrs for dCNN
-
-                if self.overlap:
-                    pred_dset = test_sequence.ol_helper.overlap_predictions(batch_index, pred_dset)
-
-                # prepare h5 dataset and save the predictions to disk
-                pred_dset = pred_dset.astype(np.float16)
-                if batch_index == 0:
-                    old_len = 0
-                    pred_out.create_dataset(dset_name,
-                                            data=pred_dset,
-                                            maxshape=(None,) + pred_dset.shape[1:],
-                                            chunks=(1,) + pred_dset.shape[1:],
-                                            dtype='float16',
-                                            compression=self.compression,
-                                            shuffle=True)
+        if self.autotune_batch_size and len(test_sequence) > 0:
+            self.val_test_batch_size = self._autotuned_batch_size(model, test_sequence)
+        written = {'end': 0, 'n_removed': 0}
+
+        def write(batch_index, predictions):
+            written['n_removed'], n_rows = self._write_predictions(pred_out, test_sequence, batch_index,
+                                                                   predictions, written['end'])
+            written['end'] += n_rows
+
+        # the predictions are post processed, compressed and written in the background while the next batch
+        # is predicted
+        with BackgroundWriter(write, max_queued=self.write_queue_size) as writer:
+            for batch_index, batch in enumerate(test_sequence.iter_batches()):
+                if self.verbose:
+                    print(batch_index, '/', len(test_sequence), end='\r')
+                if not self.only_predictions:
+                    input_data = batch[0]
                 else:
-                    old_len = pred_out[dset_name].shape[0]
-                    pred_out[dset_name].resize(old_len + pred_dset.shape[0], axis=0)
-                pred_out[dset_name][old_len:] = pred_dset
+                    input_data = batch
+                try:
+                    predictions = model.predict_on_batch(input_data)
+                except Exception as e:
+                    print(colored('Errors at prediction often result from exhausting the GPU RAM.'
+                                  'Your RAM requirement depends on subsequence_length x (val_test_)batch_size.'
+                                  'That and the network size (can be changed during training but not inference).',
+                                  'red'))
+                    raise e
+                writer.submit(batch_index, predictions)
+        # the datasets are created at the final size, only in debug mode not all of it is predicted
+        def trim(_, obj):
+            if isinstance(obj, h5py.Dataset) and obj.shape[0] > written['end']:
+                obj.resize(written['end'], axis=0)
+        pred_out.visititems(trim)
 
         # add model config and other attributes to predictions
         h5_model = h5py.File(self.load_model_path, 'r')
         pred_out.attrs['model_config'] = h5_model.attrs['model_config']
-        pred_out.attrs['n_bases_removed'] = n_removed
+        pred_out.attrs['n_bases_removed'] = written['n_removed']
         pred_out.attrs['test_data_path'] = self.test_data
-        pred_out.attrs['model_path'] = self.load_model_path
+        if test_sequence.shard_ranges is not None:
+            # which rows of the test data this shard predicted, see shards.merge_shards()
+            pred_out.attrs['shard'] = self.shard
+            pred_out.attrs['shard_rows'] = np.array([[r['start_i'], r['end_i']] for r in test_sequence.shard_ranges],
+                                                    dtype=np.int64).reshape((-1, 2))
+            pred_out.attrs['n_rows_total'] = self.h5_tests[0]['data/X'].shape[0]
+        pred_out.attrs['model_path'] = ','.join(self.load_model_paths)
+        if self.shared_backbone:
+            for i, load_model_path in enumerate(self.load_model_paths):
+                pred_out[f'head{i}'].attrs['model_path'] = load_model_path
+                if i < len(self.loaded_model_hashes):
+                    pred_out[f'head{i}'].attrs['model_md5sum'] = self.loaded_model_hashes[i]
+        else:
+            pred_out.attrs['ensemble_size'] = len(self.load_model_paths)
         pred_out.attrs['timestamp'] = str(datetime.datetime.now())
         if hasattr(self, 'loaded_model_hash'):
             pred_out.attrs['model_md5sum'] = self.loaded_model_hash
         pred_out.close()
         h5_model.close()
 
+    def _write_predictions(self, pred_out, test_sequence, batch_index, predictions, start):
+        """reshapes (and overlaps) the predictions of one batch and writes them to the datasets of pred_out from
+        row start on, returns the number of bases removed by the pooling and the number of rows written"""
+        if not isinstance(predictions, list):
+            # if we just had one output
+            predictions = [predictions]
+        # the outputs of all heads one after another with --shared-backbone
+        n_heads = len(self.load_model_paths) if self.shared_backbone else 1
+        if len(predictions) // n_heads == 2:
+            # when we have two outputs, one is for phase
+            # is dependent on the model with which you predict for Helixer.py
+            # so even though we don't pass in --predict-phase as true, it gets predicted
+            output_names = ['predictions', 'predictions_phase']
+        else:
+            output_names = ['predictions']
+        if self.shared_backbone:
+            output_names = [f'head{i}/{name}' for i in range(n_heads) for name in output_names]
+
+        for dset_name, pred_dset in zip(output_names, predictions):
+            # join last two dims when predicting one hot labels
+            pred_dset = pred_dset.reshape(pred_dset.shape[:2] + (-1,))
+            # reshape when predicting more than one point at a time
+            label_dim = 4
+            if pred_dset.shape[2] != label_dim:
+                n_points = pred_dset.shape[2] // label_dim
+                pred_dset = pred_dset.reshape(
+                    pred_dset.shape[0],
+                    pred_dset.shape[1] * n_points,
+                    label_dim,
+                )
+                # add 0-padding if needed
+                n_removed = self.shape_test[1] - pred_dset.shape[1]
+                if n_removed > 0:
+                    zero_padding = np.zeros((pred_dset.shape[0], n_removed, pred_dset.shape[2]),
+                                            dtype=pred_dset.dtype)
+                    pred_dset = np.concatenate((pred_dset, zero_padding), axis=1)
+            else:
+                n_removed = 0  # just to avoid crashing with Unbound Local Error setting attrs for dCNN
+
+            if self.overlap:
+                pred_dset = test_sequence.ol_helper.overlap_predictions(batch_index, pred_dset)
+
+            # prepare h5 dataset (at its final size) and save the predictions to disk
+            pred_dset = pred_dset.astype(np.float16)
+            if dset_name not in pred_out:
+                n_rows = test_sequence.n_seqs  # the same with overlapping, which restores the original chunks
+                compression = None if self.compression == 'none' else self.compression
+                pred_out.create_dataset(dset_name,
+                                        shape=(n_rows,) + pred_dset.shape[1:],
+                                        maxshape=(None,) + pred_dset.shape[1:],
+                                        chunks=(min(self.prediction_chunk_rows, n_rows),) + pred_dset.shape[1:],
+                                        dtype='float16',
+                                        compression=compression,
+                                        compression_opts=self.compression_level if compression == 'gzip' else None,
+                                        shuffle=compression is not None)
+            pred_out[dset_name][start:start + pred_dset.shape[0]] = pred_dset
+        return n_removed, pred_dset.shape[0]
+
     def _print_model_info(self, model):
         pwd = os.getcwd()
         os.chdir(os.path.dirname(__file__))
@@ -980,10 +2077,15 @@ class HelixerModel(ABC):
             print(f'Current Helixer version: {version("helixer")}')
 
         try:
-            if os.path.isfile(self.load_model_path):
-                cmd = ['md5sum', self.load_model_path]
-                self.loaded_model_hash = subprocess.check_output(cmd).strip().decode()
-                print(f'Md5sum of the loaded model: {self.loaded_model_hash}')
+            hashes = self.loaded_model_hashes = []
+            for load_model_path in self.load_model_paths:
+                if os.path.isfile(load_model_path):
+                    cmd = ['md5sum', load_model_path]
+                    hashes.append(subprocess.check_output(cmd).strip().decode())
+                    print(f'Md5sum of the loaded model: {hashes[-1]}')
+            if hashes:
+                # comma separated for ensembles, like scripts/ensemble.py
+                self.loaded_model_hash = ','.join(hashes)
         except subprocess.CalledProcessError:
             print('An error occurred while running a subprocess, unable to record loaded_model_hash')
             self.loaded_model_hash = 'error'
@@ -997,8 +2099,18 @@ class HelixerModel(ABC):
 
     def run(self):
         def load_model_strategy():
+            models = [load_one_model(load_model_path) for load_model_path in self.load_model_paths]
+            if self.shared_backbone:
+                print(f'Predicting with {len(models)} heads on a shared backbone')
+                return self.shared_backbone_model(models)
+            if len(models) > 1:
+                print(f'Predicting with an ensemble of {len(models)} models')
+                return self.ensemble_model(models)
+            return models[0]
+
+        def load_one_model(load_model_path):
             if not self.input_coverage:
-                model = load_model(self.load_model_path)
+                model = load_model(load_model_path)
             else:
                 # for whatever reason, the fine-tuning method is not saving the full model
                 # in an entirely valid h5 file (depending on if you ask h5py or h5ls). puh.
@@ -1012,7 +2124,7 @@ class HelixerModel(ABC):
                     layer.trainable = False
 
                 model = self.insert_coverage_before_hat(oldmodel, dense_at)
-                model.load_weights(self.load_model_path)
+                model.load_weights(load_model_path)
             return model
 
         self.set_resources()
@@ -1028,12 +2140,17 @@ class HelixerModel(ABC):
 
         # we're training, not eval nor predict
         if not self.testing:
-            strategy = tf.distribute.MirroredStrategy(
-                cross_device_ops=tf.distribute.ReductionToOneDevice(reduce_to_device="gpu:0"))
+            if self.multi_worker:
+                # configured by TF_CONFIG, which is also what worker_index and num_workers come from
+                strategy = tf.distribute.MultiWorkerMirroredStrategy()
+                print(f'Worker {self.worker_index} of {self.num_workers}')
+            else:
+                strategy = tf.distribute.MirroredStrategy(
+                    cross_device_ops=tf.distribute.ReductionToOneDevice(reduce_to_device="gpu:0"))
             print('Number of devices: {}'.format(strategy.num_replicas_in_sync))
             # SunGridEngine doesn't set visible devices properly sometimes, so one should use
             # --gpu-id <id> when using only one GPU to train
-            if strategy.num_replicas_in_sync > 1:
+            if strategy.num_replicas_in_sync > 1 or self.multi_worker:
                 with strategy.scope():
                     model = self.create_train_model()
                     self.set_optimizer()
@@ -1045,20 +2162,41 @@ class HelixerModel(ABC):
             self._print_model_info(model)
 
             train_generator = self.gen_training_data()
-            model.fit(train_generator,
+            if self.backbone_model is not None:
+                train_generator.cache_backbone_features(self.backbone_model, self.cache_backbone_features)
+            steps_per_epoch = None
+            if self.multi_worker:
+                # every worker feeds (just) its own share of the data to its replicas, so that the datasets are
+                # neither sharded nor split any further; all shares have the same number of batches
+                train_data = strategy.distribute_datasets_from_function(
+                    lambda _: train_generator.as_tf_dataset().repeat())
+                steps_per_epoch = len(train_generator) // (strategy.num_replicas_in_sync // self.num_workers)
+            elif self.tf_data:
+                train_data = train_generator.as_tf_dataset()
+            else:
+                train_data = train_generator
+            model.fit(train_data,
                       epochs=self.epochs,
+                      steps_per_epoch=steps_per_epoch,
                       workers=self.workers,
+                      use_multiprocessing=self.use_multiprocessing,
                       callbacks=self.generate_callbacks(train_generator),
                       verbose=True)
         else:
             assert self.test_data.endswith('.h5'), 'Need a h5 test data file when loading a model'
-            assert self.load_model_path.endswith('.h5'), 'Need a h5 model file'
+            assert all(path.endswith('.h5') for path in self.load_model_paths), 'Need h5 model files'
 
             strategy = tf.distribute.MirroredStrategy()
             print('Number of devices: {}'.format(strategy.num_replicas_in_sync))
             if strategy.num_replicas_in_sync > 1:
+                if self.compiled_model_cache:
+                    # the compiled model predicts on one device only, the keras model is replicated
+                    print(colored(f'ignoring --compiled-model-cache with {strategy.num_replicas_in_sync} devices, '
+                                  f'predicting with the keras model replicated on all of them', 'yellow'))
                 with strategy.scope():
                     model = load_model_strategy()
+            elif self.compiled_model_cache:
+                model = self._compiled_model(load_model_strategy)
             else:
                 # use no strategy if there is no replication to avoid warnings from the dataset not being tf.data
                 model = load_model_strategy()
@@ -1070,9 +2208,12 @@ class HelixerModel(ABC):
                 _, _, _ = HelixerModel.run_metrics(test_generator, model, calc_H=self.calculate_uncertainty)
                 if self.large_eval_folder:
                     assert self.data_dir != '', 'need training data of the model for training genome names'
-                    training_species = h5py.File(os.path.join(self.data_dir, 'training_data.h5'), 'r').attrs['genomes']
+                    h5_trains = [h5py.File(f, 'r') for f in glob.glob(os.path.join(self.data_dir, 'training_data*h5'))]
+                    training_species = HelixerModel.species_of(h5_trains)
                     _ = HelixerModel.run_large_eval(self.large_eval_folder, model, test_generator, training_species,
-                                                    print_to_stdout=True, calc_H=self.calculate_uncertainty)
+                                                    print_to_stdout=True, calc_H=self.calculate_uncertainty,
+                                                    model_path=self.load_model_paths,
+                                                    n_workers=self.large_eval_workers)
             else:
                 if os.path.isfile(self.prediction_output_path):
                     print(f'{self.prediction_output_path} already exists and will be overwritten.')
@@ -1080,7 +2221,79 @@ class HelixerModel(ABC):
             for h5_test in self.h5_tests:
                 h5_test.close()
 
+    def _compiled_model(self, load_model_strategy):
+        """the model from the --compiled-model-cache, exported there from the .h5 model(s) on the first use"""
+        mode = 'shared_backbone' if self.shared_backbone else ''
+        model_paths = list(self.load_model_paths)
+        if self.input_coverage:
+            # the architecture comes from the pretrained model
+            mode += '+coverage'
+            model_paths.append(self.pretrained_model_path)
+        paths = model_cache.cache_paths(model_paths, mode)
+        path = next((path for path in paths if os.path.isdir(path)), None)
+        if path is None:
+            model = load_model_strategy()
+            for path in paths:
+                start_time = time.time()
+                try:
+                    model_cache.export(model, path)
+                    break
+                except OSError as e:
+                    # e.g. a read only model directory
+                    print(colored(f'could not export the compiled model to {path}: {e}', 'yellow'))
+            else:
+                print(colored('predicting with the keras model', 'yellow'))
+                return model
+            print(f'exported the compiled model to {path} in {time.time() - start_time:.2f} secs')
+        start_time = time.time()
+        model = model_cache.CompiledModel(path)
+        print(f'loaded the compiled model {path} in {time.time() - start_time:.2f} secs')
+        return model
+
+    @staticmethod
+    def ensemble_model(models):
+        """one model that runs all models on the same input and averages each of their outputs (softmax), so that
+        an ensemble is predicted in a single pass over the data"""
+        for model in models[1:]:
+            assert model.input_shape == models[0].input_shape and model.output_shape == models[0].output_shape, \
+                f'all models of an ensemble need the same inputs and outputs, not {models[0].input_shape} -> ' \
+                f'{models[0].output_shape} and {model.input_shape} -> {model.output_shape}'
+        inputs = [Input(shape=inp.shape[1:], dtype=inp.dtype, name=inp.name) for inp in models[0].inputs]
+        outputs = []
+        for i, model in enumerate(models):
+            # the models are nested as layers and need distinct names
+            model._name = f'ensemble_member_{i}'
+            member_outputs = model(inputs if len(inputs) > 1 else inputs[0])
+            outputs.append(member_outputs if isinstance(member_outputs, list) else [member_outputs])
+        averaged = [Average(name=f'ensemble_average_{j}')(list(output)) for j, output in enumerate(zip(*outputs))]
+        return Model(inputs, averaged if len(averaged) > 1 else averaged[0], name='ensemble')
+
+    @staticmethod
+    def shared_backbone_model(models):
+        """one model that runs the backbone shared by all models once and each of their hats on its output. The
+        hat of a model starts at its first dense layer (where fine tuning replaces the layers). The outputs are
+        those of the first model, then those of the second and so on."""
+        def hat_at(model):
+            return next(layer for layer in model.layers if isinstance(layer, Dense))
+
+        backbone = Model(models[0].inputs, hat_at(models[0]).input, name='backbone')
+        for i, model in enumerate(models[1:], start=1):
+            other = Model(model.inputs, hat_at(model).input)
+            shared = len(other.weights) == len(backbone.weights) and all(
+                np.array_equal(w, w_other) for w, w_other in zip(backbone.get_weights(), other.get_weights()))
+            assert shared, f'model {i} does not share the backbone (everything before the first dense layer) ' \
+                           f'of model 0, predict with the models separately'
+        inputs = [Input(shape=inp.shape[1:], dtype=inp.dtype, name=inp.name) for inp in models[0].inputs]
+        features = backbone(inputs if len(inputs) > 1 else inputs[0])
+        outputs = []
+        for i, model in enumerate(models):
+            head_outputs = Model(hat_at(model).input, model.outputs, name=f'head_{i}')(features)
+            outputs += head_outputs if isinstance(head_outputs, list) else [head_outputs]
+        return Model(inputs, outputs, name='shared_backbone')
+
     def create_train_model(self):
+        # only set when training just the hat on cached backbone features (or accumulating gradients)
+        self.backbone_model, self.full_model = None, None
         if self.resume_training:
             if not self.fine_tune and not self.fine_tune_resume:
                 model = load_model(self.load_model_path, compile=False)
@@ -1120,11 +2333,35 @@ class HelixerModel(ABC):
                         model = Model(inp, output)
                     else:
                         model = self.insert_coverage_before_hat(oldmodel, dense_at)
+                    if self.cache_backbone_features is not None:
+                        model = self.create_hat_model(oldmodel, dense_at, model)
 
         else:
             model = self.model()
+
+        if self.accumulate_steps > 1 or self.profile_data_path:
+            # the model trained only differs in its train_step, so the plain model (with the same layers) is saved
+            if self.full_model is None:
+                self.full_model = model
+            model_cls = StepTimedModel if self.profile_data_path else GradientAccumulationModel
+            model = model_cls(model.inputs, model.outputs, accumulate_steps=self.accumulate_steps)
         return model
 
+    def create_hat_model(self, oldmodel, dense_at, full_model):
+        """the new final layer(s) on their own, taking the output of the frozen layers (the backbone) as input;
+        their weights are copied into full_model for every checkpoint"""
+        # the same layer the hat is attached to in full_model
+        backbone_at = dense_at - 2 if self.input_coverage else dense_at - 1
+        self.backbone_model = Model(oldmodel.input, oldmodel.layers[backbone_at].output)
+        self.full_model = full_model
+
+        features = Input(shape=self.backbone_model.output.shape[1:], dtype=self.float_precision,
+                         name='backbone_features')
+        if not self.input_coverage:
+            return Model(features, self.model_hat((features, None)))
+        coverage = Input(shape=(None, self.coverage_count * 2), dtype=self.float_precision, name='coverage_input')
+        return Model([features, coverage], self.model_hat((features, coverage)))
+
     def set_optimizer(self):
         if self.optimizer.lower() == 'adam':
             self.optimizer = optimizers.Adam(learning_rate=self.learning_rate, clipnorm=self.clip_norm)
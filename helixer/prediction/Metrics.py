@@ -248,11 +248,14 @@ class ConfusionMatrixPhase(ConfusionMatrix):
 
 
 class Metrics:
-    def __init__(self, generator, print_to_stdout=True, skip_uncertainty=True):
+    def __init__(self, generator, print_to_stdout=True, skip_uncertainty=True, keep_batch_cms=False):
         np.set_printoptions(suppress=True)  # do not use scientific notation for the print out
         self.generator = generator
         self.print_to_stdout = print_to_stdout
         self.skip_uncertainty = skip_uncertainty
+        # the genic confusion matrix of every single batch, e.g. for bootstrapping
+        self.keep_batch_cms = keep_batch_cms
+        self.batch_genic_cms = []
         self.cm_genic = ConfusionMatrixGenic(skip_uncertainty=self.skip_uncertainty)
         self.cm_phase = ConfusionMatrix(['no_phase', 'phase_0', 'phase_1', 'phase_2'],
                                         skip_uncertainty=self.skip_uncertainty)
@@ -271,10 +274,9 @@ class Metrics:
         return y_true, y_pred, sw
 
     def calculate_metrics(self, model):
-        for batch_idx in range(len(self.generator)):
+        for batch_idx, inputs in enumerate(self.generator.iter_batches()):
             print(batch_idx, '/', len(self.generator) - 1, end="\r")
 
-            inputs = self.generator[batch_idx]
             if len(inputs) == 2 and type(inputs[0]) is list:
                 mode = 'dialated_conv'
                 (X, sw), y_true = inputs
@@ -305,7 +307,12 @@ class Metrics:
                 sw_copy = sw.copy()
                 if self.generator.overlap:
                     y_true, y_pred, sw_copy = self._overlap_all_data(batch_idx, y_true, y_pred, sw_copy)
-                cm.count_and_calculate_one_batch(y_true, y_pred, sw_copy)
+                if self.keep_batch_cms and cm is self.cm_genic:
+                    cm_before = cm.cm.copy()
+                    cm.count_and_calculate_one_batch(y_true, y_pred, sw_copy)
+                    self.batch_genic_cms.append(cm.cm - cm_before)
+                else:
+                    cm.count_and_calculate_one_batch(y_true, y_pred, sw_copy)
 
         # data contains cms + metric
         for metric_name, (cm, (_, _)) in data.items():
@@ -314,3 +321,25 @@ class Metrics:
                 cm._print_results(scores)
             all_scores[metric_name] = scores
         return all_scores
+
+    @staticmethod
+    def genic_f1(cms):
+        """genic f1 (as in ConfusionMatrixGenic) of each of the confusion matrices stacked in cms"""
+        cms = np.asarray(cms, dtype=np.float64)
+        genic = [1, 2, 3]  # utr, exon, intron
+        tp = sum(cms[..., c, c] for c in genic)
+        fp = sum(np.sum(cms[..., :, c], axis=-1) - cms[..., c, c] for c in genic)
+        fn = sum(np.sum(cms[..., c, :], axis=-1) - cms[..., c, c] for c in genic)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f1 = np.where(tp > 0, 2 * tp / (2 * tp + fp + fn), 0.)
+        return f1
+
+    @staticmethod
+    def bootstrap_genic_f1(batch_cms, n_bootstrap=1000, confidence=0.95, seed=0):
+        """confidence interval of the genic f1 by resampling the batches (with their confusion matrices)"""
+        batch_cms = np.asarray(batch_cms, dtype=np.float64)
+        rng = np.random.RandomState(seed)
+        resampled = rng.randint(0, len(batch_cms), size=(n_bootstrap, len(batch_cms)))
+        f1s = Metrics.genic_f1(np.stack([batch_cms[idxs].sum(axis=0) for idxs in resampled]))
+        alpha = (1 - confidence) / 2
+        return np.quantile(f1s, alpha), np.quantile(f1s, 1 - alpha)
@@ -1,10 +1,14 @@
 import os
+import json
 from shutil import copy
 from sklearn.metrics import precision_recall_fscore_support as f1_scores
 from sklearn.metrics import accuracy_score
 import numpy as np
 import pytest
 import h5py
+import tensorflow as tf
+from tensorflow.keras.layers import Input, Dense, Activation, Conv1D
+from tensorflow.keras.models import Model
 
 import geenuff
 from geenuff.tests.test_geenuff import mk_memory_session
@@ -16,11 +20,21 @@ from geenuff.base import types
 from helixer.core.controller import HelixerController
 from helixer.core import helpers
 from helixer.core import overlap
+from helixer.core.arena import CompressedArena
+from helixer.core.h5_chunks import DirectChunkReader
+from helixer.core.batch_cache import BatchCache
+from helixer.core.background import BackgroundWriter
+from helixer.core import shards
+from helixer.core import cpu_workers
+from helixer.core import model_cache
 from helixer.export import numerify
 from helixer.export.numerify import SequenceNumerifier, AnnotationNumerifier, Stepper, AMBIGUITY_DECODE
 from helixer.export.exporter import HelixerExportController, HelixerFastaToH5Controller
-from helixer.prediction.Metrics import ConfusionMatrix, ConfusionMatrixGenic
+from helixer.prediction.Metrics import ConfusionMatrix, ConfusionMatrixGenic, Metrics
 from helixer.prediction.LSTMModel import LSTMSequence
+from helixer.prediction.HelixerModel import HelixerModel, HelixerSequence, GradientAccumulationModel
+from helixer.prediction.HelixerModel import ConfusionMatrixTrain, StepTimedModel, DataStallProfiler
+from helixer.prediction.HybridModel import HybridModel, HybridSequence
 from helixer.evaluation import rnaseq
 
 TMP_DB = 'testdata/tmp/dummy.sqlite3'
@@ -413,6 +427,33 @@ def test_coord_numerifier_and_h5_gen_minus_strand():
     assert np.array_equal(sample_weights[1][:50], sample_weight_expect[200:250])
 
 
+def test_reverse_strand_padding_fixed_at_export():
+    """Tests that padding the minus strand at export matches moving the padding at read-in"""
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=200, one_hot=True, longest_only=False)
+    f = h5py.File(H5_OUT_FILE, 'r')
+    assert not f.attrs['reverse_strand_padding_fixed']
+    start_ends = f['/data/start_ends'][:]
+    keys = ['X', 'y', 'sample_weights', 'phases', 'transitions']
+    legacy = {key: HelixerSequence._fix_reverse_strand_padding(200, start_ends, f['/data/' + key][:])
+              for key in keys}
+    f.close()
+
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=200, one_hot=True, longest_only=False, fix_reverse_strand_padding=True)
+    f = h5py.File(H5_OUT_FILE, 'r')
+    assert f.attrs['reverse_strand_padding_fixed']
+    assert np.array_equal(f['/data/start_ends'][:], start_ends)
+    for key in keys:
+        assert np.array_equal(f['/data/' + key][:], legacy[key]), key
+    # the padding (no sequence) of the padded minus strand chunk is now at the start
+    x_minus_padded = f['/data/X'][29]
+    assert start_ends[29][0] - start_ends[29][1] == 155
+    assert np.all(x_minus_padded[:45] == 0)
+    assert np.all(np.sum(x_minus_padded[45:], axis=1) > 0)
+    f.close()
+
+
 def test_numerify_with_end_neg1():
     def check_one(coord, is_plus_strand, expect, maskexpect):
         numerifier = AnnotationNumerifier(coord=coord,
@@ -818,6 +859,27 @@ def test_confusion_matrix():
     assert np.allclose(acc_true, cm._total_accuracy())
 
 
+def test_bootstrapped_genic_f1():
+    """tests the vectorized genic f1 and its bootstrapped confidence interval over batches"""
+    cm = ConfusionMatrixGenic()
+    batch_cms = [np.random.randint(0, 100, size=(4, 4)) for _ in range(10)] + [np.zeros((4, 4), dtype=int)]
+    for batch_cm in batch_cms:
+        cm.cm += batch_cm.astype(np.uint64)
+    assert np.isclose(Metrics.genic_f1(cm.cm), cm._get_scores()['genic']['f1'])
+    # also for stacked confusion matrices
+    batch_f1s = []
+    for batch_cm in batch_cms:
+        single_cm = ConfusionMatrixGenic()
+        single_cm.cm += batch_cm.astype(np.uint64)
+        batch_f1s.append(single_cm._get_scores()['genic']['f1'])
+    assert np.allclose(Metrics.genic_f1(batch_cms), batch_f1s)
+    low, high = Metrics.bootstrap_genic_f1(batch_cms, n_bootstrap=500)
+    assert low <= high
+    # identical batches leave nothing to vary
+    low, high = Metrics.bootstrap_genic_f1([batch_cms[0]] * 5, n_bootstrap=100)
+    assert np.isclose(low, high) and np.isclose(low, Metrics.genic_f1(batch_cms[0]))
+
+
 def test_gene_lengths():
     """Tests the '/data/gene_lengths' array"""
     _, controller, _ = setup_dummyloci()
@@ -1271,6 +1333,707 @@ def test_predictions_realdata():
                     assert np.all(np.argmax(inputpred, axis=1) == pre_hint['category'])
 
 
+# loading and predicting
+def mk_sequence_data(path, n_seqs=10, chunk_size=90, seqids=None):
+    """writes an h5 file with the datasets of exported data (with a few masked bases and transitions), the first
+    value of X of every sample is its index; seqids are those of every sample (by default all of one sequence),
+    i.e. they make the contiguous ranges"""
+    rng = np.random.RandomState(0)
+    X = np.eye(4, dtype=np.float16)[rng.randint(0, 4, size=(n_seqs, chunk_size))]
+    X[:, 0, 0] = np.arange(n_seqs)
+    seqids = np.array([b'seq'] * n_seqs if seqids is None else seqids)
+    starts = np.array([np.sum(seqids[:i] == seqid) * chunk_size for i, seqid in enumerate(seqids)])
+    with h5py.File(path, 'w') as h5:
+        h5.create_dataset('data/X', data=X, chunks=(1, chunk_size, 4), compression='gzip', shuffle=True)
+        h5.create_dataset('data/y', data=np.eye(4, dtype=np.int8)[rng.randint(0, 4, size=(n_seqs, chunk_size))],
+                          chunks=(1, chunk_size, 4), compression='gzip', shuffle=True)
+        h5.create_dataset('data/sample_weights', data=(rng.rand(n_seqs, chunk_size) > 0.02).astype(np.int8),
+                          chunks=(1, chunk_size), compression='gzip')
+        h5.create_dataset('data/transitions', data=(rng.rand(n_seqs, chunk_size, 6) < 0.02).astype(np.int8),
+                          chunks=(1, chunk_size, 6), compression='gzip')
+        h5.create_dataset('data/is_annotated', data=np.ones(n_seqs, dtype=bool))
+        h5.create_dataset('data/err_samples', data=np.ones(n_seqs, dtype=bool))
+        h5.create_dataset('data/fully_intergenic_samples', data=np.zeros(n_seqs, dtype=bool))
+        h5.create_dataset('data/species', data=np.array([b'dummy'] * n_seqs, dtype='S25'))
+        h5.create_dataset('data/seqids', data=seqids.astype('S50'))
+        h5.create_dataset('data/start_ends', data=np.stack([starts, starts + chunk_size], axis=1))
+    return X
+
+
+def mk_hybrid_model_file(path, *args):
+    """saves a small, untrained HybridModel to path, e.g. for predictions"""
+    hybrid_model = HybridModel(cli_args=['--data-dir', os.path.dirname(path), '--units', '4', '--filter-depth', '4',
+                                         '--kernel-size', '3'] + list(args))
+    hybrid_model.model().save(path)
+
+
+def mk_sequence(tmp_path, mode='train', batch_size=4, shuffle=False, args=(), **data_kwargs):
+    """a HybridSequence of data from mk_sequence_data() with the settings of a HybridModel from args (and a model
+    from mk_hybrid_model_file() for the test mode)"""
+    data_path = str(tmp_path / f'{mode}_data.h5')
+    mk_sequence_data(data_path, **data_kwargs)
+    if mode == 'test':
+        model_path = str(tmp_path / 'model.h5')
+        if not os.path.exists(model_path):
+            mk_hybrid_model_file(model_path)
+        cli_args = ['--load-model-path', model_path, '--test-data', data_path]
+    else:
+        cli_args = ['--data-dir', str(tmp_path)]
+    hybrid_model = HybridModel(cli_args=cli_args + list(args))
+    return HybridSequence(hybrid_model, [h5py.File(data_path, 'r')], mode, batch_size, shuffle)
+
+
+def assert_same_batches(batches, other_batches):
+    """asserts that both iterables (e.g. sequences) have the same batches, i.e. equal arrays in the same places"""
+    batches, other_batches = list(batches), list(other_batches)
+    assert len(batches) == len(other_batches)
+    for batch, other_batch in zip(batches, other_batches):
+        flat, other_flat = tf.nest.flatten(batch), tf.nest.flatten(other_batch)
+        assert len(flat) == len(other_flat)
+        assert all(np.array_equal(a, b) for a, b in zip(flat, other_flat))
+
+
+def mk_small_model(n_outputs=2, output_names=None, inp=None, backbone_output=None):
+    """a small model with n_outputs softmax outputs (e.g. genic and phase) on a backbone, by default a Dense layer on
+    a new input; models built on the same inp and backbone_output share the backbone"""
+    if inp is None:
+        inp = Input(shape=(None, 4), name='main_input')
+        backbone_output = Dense(8)(inp)
+    output_names = output_names or [None] * n_outputs
+    return Model(inp, [Activation('softmax', name=name)(Dense(4)(backbone_output)) for name in output_names])
+
+
+def test_compressed_arena():
+    """tests that samples come back unchanged from every arena backing, also after pickling (as for workers)"""
+    import pickle
+    import numcodecs
+    compressor = numcodecs.blosc.Blosc(cname='blosclz', clevel=4, shuffle=2)
+    data = np.random.randint(0, 2, size=(10, 1000, 4)).astype(np.int8)
+    for backing in ['memory', 'shm', 'mmap']:
+        arena = CompressedArena('data/y', data.dtype, backing=backing)
+        # added in two blocks, as when loading in steps
+        arena.extend([compressor.encode(e) for e in data[:4]])
+        arena.extend([compressor.encode(e) for e in data[4:]])
+        assert len(arena) == 10
+        arena.finalize()
+        assert len(arena) == 10
+        assert arena.nbytes == arena.offsets[-1]
+        # as written to and memory mapped from the data cache
+        arena.save(H5_OUT_FOLDER + 'arena')
+        cached = CompressedArena.load(H5_OUT_FOLDER + 'arena')
+        assert cached.name == 'data/y' and cached.dtype == data.dtype
+        for a in [arena, pickle.loads(pickle.dumps(arena)), cached, pickle.loads(pickle.dumps(cached))]:
+            for i in range(10):
+                decoded = np.frombuffer(compressor.decode(a[i]), dtype=np.int8).reshape(1000, 4)
+                assert np.array_equal(decoded, data[i])
+        if backing == 'shm':
+            # only the creating arena unlinks the shared memory, also after it was attached to in this process
+            import gc
+            from multiprocessing import shared_memory
+            name = arena._shm.name
+            del arena, a
+            gc.collect()
+            with pytest.raises(FileNotFoundError):
+                shared_memory.SharedMemory(name=name)
+
+
+def test_direct_chunk_reader():
+    """tests that rows read as raw chunks and decompressed outside of h5py equal those read via h5py"""
+    from concurrent.futures import ThreadPoolExecutor
+    data = np.random.randint(0, 100, size=(2, 12, 500, 4)).astype(np.float16)
+    data[:, 3:6] = 0.  # well compressible rows
+    rows = np.array([0, 2, 3, 7, 11])
+    with h5py.File(H5_OUT_FOLDER + 'direct_chunks.h5', 'w') as f:
+        for compression, shuffle in [('gzip', True), ('gzip', False), (None, True), ('lzf', True)]:
+            key = f'{compression}_{shuffle}'
+            f.create_dataset(key, data=data[0], chunks=(1, 500, 4), compression=compression, shuffle=shuffle)
+            if compression == 'lzf':
+                assert not DirectChunkReader.supports(f[key])
+                continue
+            reader = DirectChunkReader(f[key])
+            for pool in [None, ThreadPoolExecutor(3)]:
+                assert np.array_equal(reader.read(rows, pool), f[key][rows])
+        # rows of the first entry, as for data/predictions
+        f.create_dataset('predictions', data=data, chunks=(1, 1, 500, 4), compression='gzip', shuffle=True)
+        assert not DirectChunkReader.supports(f['predictions'])
+        assert np.array_equal(DirectChunkReader(f['predictions'], (0,)).read(rows), data[0, rows])
+        # not chunked by row
+        f.create_dataset('by_block', data=data[0], chunks=(4, 500, 4), compression='gzip')
+        assert not DirectChunkReader.supports(f['by_block'])
+
+
+def test_batch_cache():
+    """tests that batches come back from the cache with unchanged arrays and the same (list vs tuple) structure"""
+    batches = [(np.random.rand(2, 10, 4), [np.random.rand(2, 5, 2, 4), np.ones((2, 5, 2, 4))], np.ones((2, 5))),
+               (np.random.rand(1, 10, 4), [np.random.rand(1, 5, 2, 4), np.ones((1, 5, 2, 4))], np.zeros((1, 5))),
+               np.random.rand(3, 10, 4)]
+    for backing in ['memory', 'disk']:
+        cache = BatchCache(backing, cache_dir=H5_OUT_FOLDER)
+        for batch in batches:
+            cache.append(batch)
+        assert len(cache) == 3
+        for _ in range(2):
+            for batch, cached in zip(batches, cache):
+                assert isinstance(cached, type(batch))
+                if isinstance(batch, tuple):
+                    assert type(cached[1]) is list
+                    assert all(np.array_equal(a, b) for a, b in zip([batch[0], *batch[1], batch[2]],
+                                                                    [cached[0], *cached[1], cached[2]]))
+                else:
+                    assert np.array_equal(batch, cached)
+        cache.clear()
+        assert len(cache) == 0 and not cache.complete
+
+
+def test_background_writer():
+    """tests that the background writer writes in order and passes on errors"""
+    for max_queued in [0, 1, 4]:
+        written = []
+        with BackgroundWriter(written.append, max_queued=max_queued) as writer:
+            for i in range(20):
+                writer.submit(i)
+        assert written == list(range(20))
+
+    def write(i):
+        if i == 3:
+            raise ValueError('failed writing')
+        written.append(i)
+
+    for max_queued in [0, 2]:
+        written = []
+        with pytest.raises(ValueError):
+            with BackgroundWriter(write, max_queued=max_queued) as writer:
+                for i in range(20):
+                    writer.submit(i)
+        assert written == [0, 1, 2]
+
+
+def test_block_shuffled_order():
+    """tests that the out-of-core order is a permutation that reads from only a few blocks at a time"""
+    for n_seqs, block_size, window in [(1000, 32, 4), (1001, 32, 4), (10, 32, 4), (100, 1, 1)]:
+        order = HelixerSequence._block_shuffled_order(n_seqs, block_size, window)
+        assert np.array_equal(np.sort(order), np.arange(n_seqs))
+        if n_seqs % block_size:
+            continue  # the windows are only aligned if all blocks are full
+        samples_per_window = block_size * window
+        for start in range(0, n_seqs, samples_per_window):
+            blocks = np.unique(order[start:start + samples_per_window] // block_size)
+            assert len(blocks) <= window
+
+
+def test_worker_shard():
+    """tests that the training workers load disjoint, equally large shares of the loadable samples"""
+    rng = np.random.RandomState(0)
+    masks = [rng.rand(n) > 0.3 for n in [17, 1, 40]]
+    n_loadable = sum(np.sum(mask) for mask in masks)
+    for num_workers in [1, 2, 3, 7]:
+        shards = [HelixerSequence._worker_shard(masks, i, num_workers) for i in range(num_workers)]
+        for i in range(len(masks)):
+            n_loaded = np.sum([shard[i] for shard in shards], axis=0)
+            # every sample is loaded by at most one worker, and only if loadable at all
+            assert np.all(n_loaded <= masks[i])
+        n_per_worker = [sum(np.sum(mask) for mask in shard) for shard in shards]
+        assert n_per_worker == [n_loadable // num_workers] * num_workers
+        # the same shares every time
+        again = HelixerSequence._worker_shard(masks, 0, num_workers)
+        assert all(np.array_equal(a, b) for a, b in zip(shards[0], again))
+
+
+def test_data_cache(tmp_path):
+    """tests that the loaded data comes back unchanged from the data cache, which is keyed by the content of the h5
+    files and by the options changing what is loaded"""
+    cache_dir = str(tmp_path / 'data_cache')
+    n_loads = []
+    load_h5_files = HelixerSequence._load_h5_files
+    HelixerSequence._load_h5_files = lambda self: n_loads.append(1) or load_h5_files(self)
+    try:
+        # the same data in another file is cached already, other data and other weights are not
+        for name, args, data_kwargs, cached in [('a', [], {}, False),
+                                                ('b', [], {}, True),
+                                                ('c', [], {'n_seqs': 12}, False),
+                                                ('d', ['--precompute-weights'], {}, False),
+                                                ('e', ['--precompute-weights', '--class-weights', '[1, 2, 1, 1]'], {},
+                                                 False),
+                                                ('f', ['--precompute-weights'], {}, True)]:
+            os.makedirs(tmp_path / name / 'uncached')
+            n_loads_before = len(n_loads)
+            seq = mk_sequence(tmp_path / name, args=['--data-cache-dir', cache_dir] + args, **data_kwargs)
+            assert (len(n_loads) == n_loads_before) == cached
+            assert_same_batches(seq, mk_sequence(tmp_path / name / 'uncached', args=args, **data_kwargs))
+    finally:
+        HelixerSequence._load_h5_files = load_h5_files
+    # one cache per key, without any left over temporary directories
+    assert len(os.listdir(cache_dir)) == 4
+
+
+def test_batch_decoding(tmp_path):
+    """tests that batches decoded in parallel, into arrays reused between batches where possible, equal batches
+    decoded one sample at a time, also when kept while the next batches are decoded"""
+    os.makedirs(tmp_path / 'parallel')
+    seq = mk_sequence(tmp_path / 'parallel', n_seqs=11, args=['--decode-threads', '3'])
+    assert 'data/sample_weights' in seq._reused_buffer_names
+    X = seq.h5_files[0]['data/X'][:]
+    batches = list(seq)
+    for i, (X_batch, _, _) in enumerate(batches):
+        assert np.array_equal(X_batch, X[i * 4:(i + 1) * 4])
+    reference = mk_sequence(tmp_path, n_seqs=11, args=['--decode-threads', '1'])
+    assert_same_batches(batches, (reference[i] for i in range(len(reference))))
+
+
+def test_precomputed_weights(tmp_path):
+    """tests that the pooled sample weights precomputed at load time equal those computed for every batch"""
+    transition_weights = ['--transition-weights', '[1, 12, 3, 1, 12, 3]']
+    for i, (mode, args) in enumerate([('train', ['--class-weights', '[0.5, 2, 1, 1.5]'] + transition_weights),
+                                      ('train', transition_weights + ['--stretch-transition-weights', '2']),
+                                      ('val', [])]):
+        os.makedirs(tmp_path / str(i) / 'precomputed')
+        seq = mk_sequence(tmp_path / str(i) / 'precomputed', mode=mode, args=args + ['--precompute-weights'])
+        # the raw sample weights and transitions are not needed anymore
+        assert 'data/transitions' not in seq.data_list_names
+        assert_same_batches(seq, mk_sequence(tmp_path / str(i), mode=mode, args=args))
+        if mode == 'train':
+            # weighted, not just masked
+            assert len(np.unique(np.concatenate([sw.ravel() for _, _, sw in seq]))) > 2
+
+
+def test_concurrent_loading(tmp_path):
+    """tests that loading several files and datasets at a time (with direct chunk reads) gives the same samples, in
+    file order, as loading them one after another"""
+    paths = [str(tmp_path / f'training_data{i}.h5') for i in range(2)]
+    for path, n_seqs in zip(paths, [7, 12]):
+        mk_sequence_data(path, n_seqs=n_seqs)
+        with h5py.File(path, 'a') as h5:
+            h5['data/err_samples'][2] = False
+    seqs = []
+    for load_threads in ['1', '3']:
+        hybrid_model = HybridModel(cli_args=['--data-dir', str(tmp_path), '--load-threads', load_threads])
+        seqs.append(HybridSequence(hybrid_model, [h5py.File(path, 'r') for path in paths], 'train', 4, False))
+    assert_same_batches(*seqs)
+    # without the masked samples
+    indices = np.concatenate([X[:, 0, 0] for X, _, _ in seqs[1]]).astype(int).tolist()
+    assert indices == [0, 1] + list(range(3, 7)) + [0, 1] + list(range(3, 12))
+
+
+def test_cached_val_batches(tmp_path):
+    """tests that validation batches come from the batch cache, unchanged, once a pass over all of them is done"""
+    for backing in ['memory', 'disk']:
+        os.makedirs(tmp_path / backing)
+        seq = mk_sequence(tmp_path / backing, mode='val', n_seqs=10,
+                          args=['--cache-val-batches', backing, '--arena-dir', str(tmp_path / backing)])
+        expected = [seq[i] for i in range(len(seq))]
+        # a pass stopped early is not cached
+        next(seq.iter_batches())
+        assert not seq._batch_cache.complete
+        assert_same_batches(seq.iter_batches(), expected)
+        assert seq._batch_cache.complete and len(seq._batch_cache) == len(seq)
+
+        def no_decoding(*args):
+            raise AssertionError('decoded a cached batch again')
+
+        seq.get_batch_of_one_dataset = no_decoding
+        for _ in range(2):
+            assert_same_batches(seq.iter_batches(), expected)
+
+
+def test_prediction_shards(tmp_path):
+    """tests that shards get whole contiguous ranges, balanced by chunks, and merge back to the original order"""
+    lengths = [13, 13, 1, 1, 1, 1, 40, 2, 7]
+    contiguous_ranges = []
+    cumulative = 0
+    for length in lengths:
+        contiguous_ranges.append({'is_plus_strand': True, 'start_i': cumulative, 'end_i': cumulative + length})
+        cumulative += length
+    assert [len(r) for r in shards.assign_ranges(contiguous_ranges, 3)] == [1, 2, 6]
+    assert [sum(r['end_i'] - r['start_i'] for r in shard)
+            for shard in shards.assign_ranges(contiguous_ranges, 3)] == [40, 20, 19]
+    predictions = np.random.rand(cumulative, 6, 4).astype(np.float16)
+    for n_shards in [1, 2, 3, 12]:
+        assigned = shards.assign_ranges(contiguous_ranges, n_shards)
+        paths = []
+        for i, shard_ranges in enumerate(assigned):
+            mask = shards.shard_mask(shard_ranges, cumulative)
+            loaded = shards.loaded_ranges(shard_ranges)
+            assert sum(r['end_i'] - r['start_i'] for r in loaded) == np.sum(mask)
+            paths.append(str(tmp_path / f'shard_{i}.h5'))
+            with h5py.File(paths[-1], 'w') as h5:
+                if np.any(mask):  # shards without any range have no datasets
+                    h5.create_dataset('predictions', data=predictions[mask], chunks=(1, 6, 4), compression='gzip')
+                h5.attrs.update({'shard': f'{i}/{n_shards}', 'n_rows_total': cumulative, 'n_bases_removed': 0,
+                                 'test_data_path': 'test.h5', 'model_path': 'model.h5',
+                                 'shard_rows': np.array([[r['start_i'], r['end_i']] for r in shard_ranges],
+                                                        dtype=np.int64).reshape((-1, 2))})
+        shards.merge_shards(paths[::-1], str(tmp_path / 'merged.h5'))
+        with h5py.File(tmp_path / 'merged.h5', 'r') as merged:
+            assert np.array_equal(merged['predictions'][:], predictions)
+            assert 'shard' not in merged.attrs
+    with pytest.raises(AssertionError):
+        shards.merge_shards(paths[:-1], str(tmp_path / 'incomplete.h5'))
+
+
+def test_empty_prediction_shard(tmp_path):
+    """tests that with more shards than contiguous ranges, the shards without any predict nothing, and that all
+    partial predictions merge to the predictions of the whole file"""
+    data_path = str(tmp_path / 'test_data.h5')
+    mk_sequence_data(data_path, n_seqs=6, seqids=[b'a'] * 4 + [b'b'] * 2)
+    model_path = str(tmp_path / 'model.h5')
+    mk_hybrid_model_file(model_path)
+    for args in [[], ['--overlap'], ['--overlap', '--overlap-mode', 'boundary'], ['--overlap', '--tf-data'],
+                 ['--autotune-batch-size']]:
+        paths = []
+        for shard in [None, '0/3', '1/3', '2/3']:
+            paths.append(str(tmp_path / f'predictions_{shard is not None and shard[0]}.h5'))
+            cli_args = ['--load-model-path', model_path, '--test-data', data_path, '--val-test-batch-size', '8',
+                        '--prediction-output-path', paths[-1]] + args
+            HybridModel(cli_args=cli_args + (['--shard', shard] if shard else [])).run()
+        with h5py.File(paths[-1], 'r') as empty:
+            assert 'predictions' not in empty and len(empty.attrs['shard_rows']) == 0
+        shards.merge_shards(paths[1:], str(tmp_path / 'merged.h5'))
+        with h5py.File(paths[0], 'r') as whole, h5py.File(tmp_path / 'merged.h5', 'r') as merged:
+            if 'boundary' in args:
+                # the junction windows packed into one row depend on which sequences are predicted together
+                assert whole['predictions'].shape == merged['predictions'].shape
+            else:
+                assert np.array_equal(whole['predictions'][:], merged['predictions'][:])
+
+
+def test_background_prediction_writing(tmp_path):
+    """tests that predictions written in the background are those written right away, and that an error while
+    writing stops the predictions"""
+    data_path = str(tmp_path / 'test_data.h5')
+    mk_sequence_data(data_path, n_seqs=20, seqids=[b'a'] * 12 + [b'b'] * 8)
+    model_path = str(tmp_path / 'model.h5')
+    mk_hybrid_model_file(model_path, '--predict-phase')
+    for args in [[], ['--overlap']]:
+        paths = []
+        for write_queue_size in ['0', '1', '4']:
+            paths.append(str(tmp_path / f'predictions_{write_queue_size}.h5'))
+            HybridModel(cli_args=['--load-model-path', model_path, '--test-data', data_path, '--val-test-batch-size',
+                                  '8', '--prediction-output-path', paths[-1], '--write-queue-size',
+                                  write_queue_size] + args).run()
+        with h5py.File(paths[0], 'r') as written:
+            for path in paths[1:]:
+                with h5py.File(path, 'r') as written_in_background:
+                    for name in ['predictions', 'predictions_phase']:
+                        assert np.array_equal(written[name][:], written_in_background[name][:])
+
+    hybrid_model = HybridModel(cli_args=['--load-model-path', model_path, '--test-data', data_path,
+                                         '--val-test-batch-size', '4', '--prediction-output-path',
+                                         str(tmp_path / 'failed.h5')])
+    write_predictions = hybrid_model._write_predictions
+    written_batches = []
+
+    def fail_at_third_batch(pred_out, test_sequence, batch_index, predictions, start):
+        if batch_index == 2:
+            raise OSError('disk full')
+        written_batches.append(batch_index)
+        return write_predictions(pred_out, test_sequence, batch_index, predictions, start)
+
+    hybrid_model._write_predictions = fail_at_third_batch
+    with pytest.raises(OSError):
+        hybrid_model.run()
+    assert written_batches == [0, 1]
+
+
+def test_prediction_datasets(tmp_path):
+    """tests that the prediction datasets have their final size, chunk geometry and compression, and the same
+    predictions for every chunk geometry"""
+    data_path = str(tmp_path / 'test_data.h5')
+    mk_sequence_data(data_path, n_seqs=10, seqids=[b'a'] * 6 + [b'b'] * 4)
+    model_path = str(tmp_path / 'model.h5')
+    mk_hybrid_model_file(model_path, '--predict-phase')
+    expected = None
+    for args, chunk_rows, compression in [([], 1, 'gzip'),
+                                          (['--prediction-chunk-rows', '4', '--compression', 'lzf'], 4, 'lzf'),
+                                          (['--prediction-chunk-rows', '64', '--compression', 'none'], 10, None),
+                                          (['--prediction-chunk-rows', '4', '--overlap', '--val-test-batch-size',
+                                            '8'], 4, 'gzip')]:
+        path = str(tmp_path / 'predictions.h5')
+        HybridModel(cli_args=['--load-model-path', model_path, '--test-data', data_path, '--val-test-batch-size',
+                              '3', '--prediction-output-path', path] + args).run()
+        with h5py.File(path, 'r') as h5:
+            for name in ['predictions', 'predictions_phase']:
+                assert h5[name].shape == (10, 90, 4)
+                assert h5[name].chunks == (chunk_rows, 90, 4)
+                assert h5[name].compression == compression
+            if expected is None:
+                expected = h5['predictions'][:]
+            elif '--overlap' not in args:
+                assert np.array_equal(h5['predictions'][:], expected)
+    # in debug mode only 3 batches are predicted, the datasets are trimmed to them
+    HybridModel(cli_args=['--load-model-path', model_path, '--test-data', data_path, '--val-test-batch-size', '3',
+                          '--prediction-output-path', path, '--debug']).run()
+    with h5py.File(path, 'r') as h5:
+        assert h5['predictions'].shape == h5['predictions_phase'].shape == (9, 90, 4)
+        assert np.array_equal(h5['predictions'][:], expected[:9])
+
+
+def test_autotuned_batch_size(tmp_path):
+    """tests that the batch size with the best throughput is chosen, within the memory limit"""
+    import time
+    import mmap
+
+    class FakeModel(object):
+        """takes the time of a batch size from seconds_of_batch, runs out of memory above max_batch_size and
+        predicts mb_per_sample MB per sample"""
+        def __init__(self, seconds_of_batch, max_batch_size=None, mb_per_sample=0):
+            self.seconds_of_batch = seconds_of_batch
+            self.max_batch_size = max_batch_size
+            self.mb_per_sample = mb_per_sample
+
+        def predict_on_batch(self, batch):
+            if self.max_batch_size is not None and len(batch) > self.max_batch_size:
+                raise tf.errors.ResourceExhaustedError(None, None, 'out of memory')
+            time.sleep(self.seconds_of_batch(len(batch)))
+            # in newly mapped memory, as the allocator might reuse what earlier tests freed (and is still resident)
+            predictions = np.frombuffer(mmap.mmap(-1, max(len(batch) * self.mb_per_sample * 2 ** 20, 1)),
+                                        dtype=np.int8)
+            predictions[:] = 1
+            return predictions
+
+    test_sequence = mk_sequence(tmp_path, mode='test', n_seqs=64, batch_size=8, args=['--val-test-batch-size', '12'])
+    hybrid_model = test_sequence.model
+    hybrid_model.autotune_max_batch_size = 32
+    # fixed costs per batch, the largest batch size is the fastest
+    assert hybrid_model._autotuned_batch_size(FakeModel(lambda n: 0.02 + 0.0005 * n), test_sequence) == 32
+    assert test_sequence.batch_size == 32 and len(test_sequence) == 2
+    # above 16 it gets slower
+    assert hybrid_model._autotuned_batch_size(FakeModel(lambda n: 0.02 if n <= 16 else 0.2), test_sequence) == 16
+    # out of memory above 8
+    assert hybrid_model._autotuned_batch_size(FakeModel(lambda n: 0.01, max_batch_size=8), test_sequence) == 8
+    if cpu_workers.resident_memory() is not None:
+        # the two timed batches of 16 predict 32 MB, above the limit; the memory the process had before counts
+        hybrid_model.autotune_memory_limit = (cpu_workers.resident_memory() + 24 * 2 ** 20) / 2 ** 30
+        assert hybrid_model._autotuned_batch_size(FakeModel(lambda n: 0.02 + 0.0005 * n, mb_per_sample=1),
+                                                  test_sequence) == 8
+        # not even the smallest batch size fits, the default is kept
+        hybrid_model.autotune_memory_limit = cpu_workers.resident_memory() / 2 ** 30 / 2
+        assert hybrid_model._autotuned_batch_size(FakeModel(lambda n: 0.01), test_sequence) == 12
+
+
+def test_cpu_workers():
+    """tests that the CPU workers get disjoint cores, covering all of them, and their share of the sequences"""
+    cpus = list(range(2, 12))
+    for n_workers in [1, 3, 10]:
+        cpu_sets = cpu_workers.split_cpus(cpus, n_workers)
+        assert len(cpu_sets) == n_workers
+        assert sum(cpu_sets, []) == cpus
+        assert max(len(c) for c in cpu_sets) - min(len(c) for c in cpu_sets) <= 1
+    with pytest.raises(AssertionError):
+        cpu_workers.split_cpus(cpus, 11)
+    cmd = cpu_workers.worker_command(['--test-data', 'test.h5'], 1, 3, 4, 'shard_1.h5')
+    assert cmd[cmd.index('--shard') + 1] == '1/3'
+    assert cmd[cmd.index('--prediction-output-path') + 1] == 'shard_1.h5'
+    assert cmd[cmd.index('--intra-op-threads') + 1] == '4'
+    assert '--shard' not in cpu_workers.worker_command([], 0, 1, 4, 'predictions.h5')
+    env = cpu_workers.worker_env(4)
+    assert env['OMP_NUM_THREADS'] == '4' and env['CUDA_VISIBLE_DEVICES'] == ''
+    # enabled before TensorFlow is imported in the worker, unless set otherwise
+    assert env['TF_ENABLE_ONEDNN_OPTS'] == os.environ.get('TF_ENABLE_ONEDNN_OPTS', '1')
+
+
+def test_tf_dataset_passes(tmp_path):
+    """tests that every pass through the repeated tf.data pipeline (as for multi-worker training) yields every sample
+    exactly once, and unchanged, with and without reshuffling in between"""
+    for shuffle in [False, True]:
+        os.makedirs(tmp_path / str(shuffle))
+        seq = mk_sequence(tmp_path / str(shuffle), batch_size=3, shuffle=shuffle, n_seqs=11, args=['--tf-data'])
+        X_expected = seq.h5_files[0]['data/X'][:]
+        n_passes = 6
+        counts = np.zeros(seq.n_seqs, dtype=int)
+        indices = []
+        for X, y, sw in seq.as_tf_dataset().repeat().take(len(seq) * n_passes).as_numpy_iterator():
+            assert X.shape[0] == y.shape[0] == sw.shape[0]
+            for x in X:
+                i = int(x[0, 0])
+                assert np.array_equal(x, X_expected[i])
+                counts[i] += 1
+                indices.append(i)
+        assert np.all(counts == n_passes)
+        if not shuffle:
+            assert indices == list(range(seq.n_seqs)) * n_passes
+
+
+def test_approximate_validation(tmp_path):
+    """tests that check-ins that skip the full validation neither count towards the patience nor save a model"""
+    val_generator = mk_sequence(tmp_path, mode='val', n_seqs=20, batch_size=4)
+    save_model_path = str(tmp_path / 'best_model.h5')
+    callback = ConfusionMatrixTrain(save_model_path, None, val_generator, '', patience=1,
+                                    approx_val_generator=val_generator.stratified_subset(0.5), approx_val_bootstrap=10)
+    model = val_generator.model.model()
+    callback.set_model(model)
+    # no f1 can be a new best
+    callback.best_val_genic_f1 = 2.
+    for _ in range(3):
+        callback.check_in()
+    assert callback.checks_without_improvement == 0 and not model.stop_training
+    assert not os.path.exists(save_model_path)
+    # any f1 is
+    callback.best_val_genic_f1 = -1.
+    callback.check_in()
+    assert os.path.exists(save_model_path) and 0. <= callback.best_val_genic_f1 <= 1.
+
+
+def test_picklable_args(tmp_path):
+    """tests that a sequence of the parameters of a model sent to another process equals one of the model itself"""
+    import pickle
+    seq = mk_sequence(tmp_path, mode='val', n_seqs=6)
+    model_args = pickle.loads(pickle.dumps(HelixerModel._picklable_args(seq.model)))
+    assert_same_batches(seq, HybridSequence(model_args, seq.h5_files, 'val', seq.batch_size, False))
+
+
+def test_cached_backbone_features(tmp_path):
+    """tests that batches have the cached features of the backbone as input, without X being decoded anymore"""
+    seq = mk_sequence(tmp_path, n_seqs=6, batch_size=4)
+    inp = Input(shape=(None, 4))
+    backbone = Model(inp, Conv1D(8, 3, padding='same')(inp))
+    expected = [backbone.predict_on_batch(seq[i][0]) for i in range(len(seq))]
+    seq.cache_backbone_features(backbone)
+    decoded_names = set()
+    get_batch_of_one_dataset = seq.get_batch_of_one_dataset
+    seq.get_batch_of_one_dataset = lambda name, idx: decoded_names.add(name) or get_batch_of_one_dataset(name, idx)
+    for i in range(len(seq)):
+        features, y, sw = seq[i]
+        assert np.allclose(features, expected[i], rtol=1e-2, atol=1e-2)
+    assert 'backbone/features' in decoded_names and 'data/X' not in decoded_names
+
+
+def test_gradient_accumulation():
+    """tests that accumulating the gradients of (uneven) micro batches gives the same update as the whole batch"""
+    def mk_model():
+        return mk_small_model(output_names=['genic', 'phase'])
+
+    rng = np.random.RandomState(0)
+    X = rng.rand(7, 10, 4).astype(np.float32)
+    y = [np.eye(4, dtype=np.float32)[rng.randint(0, 4, size=(7, 10))] for _ in range(2)]
+    sw = rng.randint(0, 3, size=(7, 10)).astype(np.float32)
+    initial_weights = mk_model().get_weights()
+    weights, histories = [], []
+    for accumulate_steps in [1, 3]:
+        model = mk_model()
+        model.set_weights(initial_weights)
+        if accumulate_steps > 1:
+            model = GradientAccumulationModel(model.inputs, model.outputs, accumulate_steps=accumulate_steps)
+        model.compile(optimizer=tf.keras.optimizers.SGD(learning_rate=0.1), loss=['categorical_crossentropy'] * 2,
+                      loss_weights=[0.8, 0.2], sample_weight_mode='temporal', weighted_metrics=['accuracy'])
+        history = model.fit(X, y, sample_weight=sw, batch_size=7, epochs=2, shuffle=False, verbose=0)
+        weights.append(model.get_weights())
+        histories.append(history.history)
+    for w_whole, w_accumulated in zip(*weights):
+        assert np.allclose(w_whole, w_accumulated, atol=1e-6)
+    # also the losses and metrics of every epoch
+    assert histories[0].keys() == histories[1].keys() and len(histories[0]) == 5
+    for name in histories[0]:
+        assert np.allclose(histories[0][name], histories[1][name], atol=1e-5)
+
+
+def test_data_stall_profiler(tmp_path):
+    """tests the samples counted per training step, also for repeated per replica pipelines of several workers, and
+    the summaries written during training"""
+    seq = mk_sequence(tmp_path, n_seqs=10, batch_size=4)  # batches of 4, 4 and 2 samples
+    profiler = DataStallProfiler(seq, str(tmp_path / 'profile.json'))
+    assert [profiler.samples_of_step(step) for step in range(6)] == [4, 4, 2] * 2
+    # 2 workers with 2 replicas each, every step takes 2 batches of each pipeline, continuing across epochs
+    profiler = DataStallProfiler(seq, str(tmp_path / 'profile.json'), per_replica_batches=True, num_workers=2)
+    profiler.batches_per_step = 2
+    assert [profiler.samples_of_step(step) for step in range(3)] == [2 * (4 + 4), 2 * (2 + 4), 2 * (4 + 2)]
+
+    model = seq.model.model()
+    model = StepTimedModel(model.inputs, model.outputs)
+    model.compile(optimizer='adam', loss='categorical_crossentropy', sample_weight_mode='temporal')
+    profiler = DataStallProfiler(seq, str(tmp_path / 'profile.json'), summarize_every=2)
+    model.fit(seq, epochs=2, callbacks=[profiler], verbose=0)
+    with open(tmp_path / 'profile.json') as f:
+        summaries = json.load(f)
+    assert [(summary['epoch'], summary['batch'], summary['n_batches']) for summary in summaries] == \
+        [(0, 1, 2), (0, 'epoch_end', 1), (1, 1, 2), (1, 'epoch_end', 1)]
+    for summary in summaries:
+        assert 0. <= summary['stall_fraction'] <= 1.
+        assert summary['bp_per_s_mean'] > summary['samples_per_s_mean'] > 0.
+
+
+def test_ensemble_model():
+    """tests that an ensemble predicts the average of every output of its models"""
+    X = np.random.RandomState(0).rand(3, 10, 4).astype(np.float32)
+    models = [mk_small_model() for _ in range(3)]
+    expected = [np.mean(preds, axis=0) for preds in zip(*[model.predict_on_batch(X) for model in models])]
+    ensemble = HelixerModel.ensemble_model(models)
+    for ensemble_preds, expected_preds in zip(ensemble.predict_on_batch(X), expected):
+        assert np.allclose(ensemble_preds, expected_preds, atol=1e-6)
+    # the outputs need to match
+    inp = Input(shape=(None, 4))
+    with pytest.raises(AssertionError):
+        HelixerModel.ensemble_model([models[0], Model(inp, Dense(4)(inp))])
+
+
+def test_shared_backbone_model():
+    """tests that the heads on a shared backbone predict the same as the models they come from"""
+    inp = Input(shape=(None, 4), name='main_input')
+    backbone_output = Conv1D(8, 3, padding='same')(inp)
+    X = np.random.RandomState(0).rand(3, 10, 4).astype(np.float32)
+    models = [mk_small_model(inp=inp, backbone_output=backbone_output) for _ in range(3)]
+    expected = [preds for model in models for preds in model.predict_on_batch(X)]
+    multi_head = HelixerModel.shared_backbone_model(models)
+    assert len(multi_head.outputs) == 6
+    for head_preds, expected_preds in zip(multi_head.predict_on_batch(X), expected):
+        assert np.allclose(head_preds, expected_preds, atol=1e-6)
+    # a model with other backbone weights is refused
+    other_inp = Input(shape=(None, 4))
+    other = Model(other_inp, Activation('softmax')(Dense(4)(Conv1D(8, 3, padding='same')(other_inp))))
+    with pytest.raises(AssertionError):
+        HelixerModel.shared_backbone_model([models[0], other])
+
+
+def test_compiled_model_cache(tmp_path):
+    """tests that a compiled model predicts like the keras model and that the cache is keyed by the model file"""
+    inp = Input(shape=(None, 4), name='main_input')
+    x = Conv1D(8, 3, padding='same')(inp)
+    X = np.random.RandomState(0).rand(3, 10, 4).astype(np.float32)
+    paths = []
+    for n_outputs in [1, 2]:
+        model = mk_small_model(n_outputs, inp=inp, backbone_output=x)
+        model_path = str(tmp_path / 'model.h5')
+        model.save(model_path)
+        path = model_cache.cache_paths([model_path])[0]
+        paths.append(path)
+        assert path.startswith(str(tmp_path)) and not os.path.exists(path)
+        model_cache.export(model, path)
+        model_cache.export(model, path)  # e.g. by another process at the same time, the first export is kept
+        compiled = model_cache.CompiledModel(path)
+        assert compiled.count_params() == model.count_params()
+        expected = model.predict_on_batch(X)
+        preds = compiled.predict_on_batch(X)
+        assert type(preds) is type(expected)
+        for compiled_preds, expected_preds in zip(preds if n_outputs > 1 else [preds],
+                                                  expected if n_outputs > 1 else [expected]):
+            assert np.allclose(compiled_preds, expected_preds, atol=1e-6)
+        # any batch size and length
+        preds = compiled.predict_on_batch(X[:1, :7])
+        assert (preds[0] if n_outputs > 1 else preds).shape == (1, 7, 4)
+    # another model file, another cache, also for the same file(s) combined differently
+    assert paths[0] != paths[1]
+    assert model_cache.cache_paths([model_path, model_path]) != model_cache.cache_paths([model_path, model_path],
+                                                                                        'shared_backbone')
+    # no temporary export directories are left behind
+    assert not [name for name in os.listdir(tmp_path) if name.startswith('.')]
+
+    # where the model directory is not writable (here: something else is in the way), the compiled model is
+    # exported to and then found in the cache directory of the user
+    user_cache_dir = model_cache.USER_CACHE_DIR
+    model_cache.USER_CACHE_DIR = str(tmp_path / 'user_cache')
+    try:
+        model_path = str(tmp_path / 'hybrid_model.h5')
+        mk_hybrid_model_file(model_path)
+        next_to_model, in_user_cache = model_cache.cache_paths([model_path])
+        open(next_to_model, 'w').close()
+        hybrid_model = HybridModel(cli_args=['--load-model-path', model_path, '--test-data', 'test.h5',
+                                             '--compiled-model-cache'])
+        for _ in range(2):
+            compiled = hybrid_model._compiled_model(lambda: tf.keras.models.load_model(model_path))
+            assert isinstance(compiled, model_cache.CompiledModel) and compiled.path == in_user_cache
+    finally:
+        model_cache.USER_CACHE_DIR = user_cache_dir
+
+
 # overlapping
 def test_ol_length_in_matches_out_sub_batch():
     """test that predictions length matches input length, after sliding window preds and overlapping, in sub batch"""
@@ -1410,6 +2173,7 @@ def test_ol_overlap_seq_helper():
             raw_preds = ol_helper.make_input(batch_idx,
                                              data_batch=dummy_xpred[ol_helper.h5_indices_of_batch(batch_idx)])
             ol_preds = ol_helper.overlap_predictions(batch_idx, raw_preds)
+            assert len(ol_preds) == ol_helper.n_chunks_of_batch(batch_idx)
             preds_out.append(ol_preds)
         fin_predictions = np.concatenate(preds_out)
         print(fin_predictions.shape, dummy_xpred.shape)
@@ -1441,6 +2205,36 @@ def test_ol_overlap_seq_helper():
     cmp_one(dummy_xpred, contiguous_ranges)
 
 
+def test_ol_boundary_seq_helper():
+    """no bit of sequence is added / lost when only re-predicting the chunk junctions, and batches fit"""
+
+    def mk_cb(start_i, end_i):
+        return {"is_plus_strand": True, "start_i": start_i, "end_i": end_i}
+
+    for core_length, batch_size in [(150, 8), (176, 8), (100, 5), (20, 32)]:
+        for lengths in [[1, 2, 3, 30, 1], [7] * 5, list(range(1, 20))]:
+            contiguous_ranges = []
+            cumulative = 0
+            for i in lengths:
+                contiguous_ranges.append(mk_cb(cumulative, cumulative + i))
+                cumulative += i
+            dummy_xpred = np.random.rand(cumulative, 200, 4)
+            ol_helper = overlap.BoundarySeqHelper(contiguous_ranges=contiguous_ranges, chunk_size=200,
+                                                  max_batch_size=batch_size, core_length=core_length)
+            preds_out = []
+            for batch_idx in range(ol_helper.adjusted_epoch_length()):
+                data_batch = dummy_xpred[ol_helper.h5_indices_of_batch(batch_idx)]
+                # predictions identical to the input, as if from a perfect model
+                raw_preds = ol_helper.make_input(batch_idx, data_batch=data_batch)
+                assert raw_preds.shape[0] <= batch_size
+                assert raw_preds.shape[1:] == (200, 4)
+                ol_preds = ol_helper.overlap_predictions(batch_idx, raw_preds)
+                assert np.allclose(ol_helper.subset_input(batch_idx, data_batch), ol_preds)
+                assert len(ol_preds) == ol_helper.n_chunks_of_batch(batch_idx)
+                preds_out.append(ol_preds)
+            assert np.allclose(np.concatenate(preds_out), dummy_xpred)
+
+
 def test_direct_fasta_export():
     fasta_controller = HelixerFastaToH5Controller('testdata/dummyloci.fa', FASTA_OUT_FILE)
     fasta_controller.export_fasta_to_h5(chunk_size=400, compression='gzip', multiprocess=True,
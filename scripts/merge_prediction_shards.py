@@ -0,0 +1,20 @@
+#! /usr/bin/env python3
+"""Assembles the partial prediction files of all shards (HybridModel.py --shard i/N) into one predictions file
+with the rows in the original order of the test data, as if predicted in one go."""
+
+import argparse
+from helixer.core.shards import merge_shards
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-p', '--prediction-files', nargs='+', required=True,
+                        help='the prediction files of all shards, in any order')
+    parser.add_argument('-po', '--prediction-output-path', type=str, default='predictions.h5')
+    args = parser.parse_args()
+    merge_shards(args.prediction_files, args.prediction_output_path)
+    print(f'merged {len(args.prediction_files)} shards into {args.prediction_output_path}')
+
+
+if __name__ == '__main__':
+    main()